@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput and latency of the agent pipeline.
+
+    python3 bench/pipeline.py [--duration S] [--files-per-sec N] [--packets-per-sec N] [--json]
+
+Runs the real daemon.py from a scratch copy of the agent against:
+  - a file storm: new files written at --files-per-sec into a temp tree
+    that the daemon watches,
+  - a fake net_mon.bin that writes --packets-per-sec binary flow
+    records (one packet each) to the daemon, like the C monitor does,
+  - a stub hub on localhost that decrypts bulk uploads and acknowledges
+    every event with 201, optionally after --hub-delay seconds.
+
+Capture-to-ack latency runs from the moment a file is written or a
+record leaves the fake monitor to the moment the stub hub acknowledges
+it. CPU and RSS are sampled from /proc for the daemon process only.
+Needs the agent's own requirements (watchdog, requests, cryptography).
+"""
+import argparse
+import base64
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import yaml
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+AGENT_DIR = Path(__file__).resolve().parent.parent
+SKIP_FILES = {"gui.py", "package_agent.py", "test.py"}
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Stands in for net_mon.bin: flow records at a fixed rate, last_seen = time written
+FAKE_NET_MON = r'''#!/usr/bin/env python3
+import os, signal, struct, sys, threading, time
+RECORD = struct.Struct("=BBBxIIIHHIQQQ")
+rate = float(os.environ["BENCH_PACKETS_PER_SEC"])
+duration = float(os.environ["BENCH_DURATION"])
+stop = threading.Event()
+signal.signal(signal.SIGTERM, lambda *a: stop.set())
+if "--control" in sys.argv:
+    threading.Thread(target=lambda: [None for _ in sys.stdin], daemon=True).start()
+out = sys.stdout.buffer
+sent, started = 0, time.monotonic()
+while rate > 0 and not stop.is_set():
+    elapsed = time.monotonic() - started
+    if elapsed >= duration:
+        break
+    due = int(elapsed * rate) - sent
+    now = time.time_ns()
+    out.write(b"".join(RECORD.pack(2, 0x12, 1, 1, 0x0a000001, 0x0a000002, 40000 + (sent + i) % 20000,
+                                   443, 1, 60, now, now) for i in range(due)))
+    out.flush()
+    sent += due
+    time.sleep(0.01)
+with open(os.environ["BENCH_COUNT_FILE"], "w") as f:
+    f.write(str(sent))
+stop.wait()
+'''
+
+
+class StubHub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, api_key, delay):
+        super().__init__(("127.0.0.1", 0), HubHandler)
+        self.aead = AESGCM(base64.urlsafe_b64decode(api_key))
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.acked = {}       # capture key -> (source, latency seconds)
+        self.events = 0       # every acknowledged event, duplicates included
+        self.batches = 0
+        self.first_ack = None
+        self.last_ack = None
+
+    def record(self, events, now):
+        with self.lock:
+            self.batches += 1
+            self.events += len(events)
+            self.first_ack = self.first_ack or now
+            self.last_ack = now
+            for event in events:
+                capture = capture_time(event)
+                if capture is not None and capture[0] not in self.acked:
+                    self.acked[capture[0]] = (capture[1], now - capture[2])
+
+
+class HubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        raw = base64.urlsafe_b64decode(body)
+        events = json.loads(self.server.aead.decrypt(raw[:12], raw[12:], None))
+        if not isinstance(events, list):
+            events = [events]
+        self.server.record(events, time.time())
+        reply = json.dumps({"status": "success",
+                            "results": [{"id": e.get("id"), "status": 201} for e in events]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+def capture_time(event):
+    """(unique key, source, epoch seconds captured) for a benchmark event, None for anything else."""
+    if event.get("event_type") == "file":
+        name = os.path.basename(event.get("details", {}).get("path", ""))
+        stem = name.split(".")[0]
+        return (stem, "file", int(stem) / 1e9) if stem.isdigit() else None
+    if event.get("event_type") == "network" and event.get("record") == "flow":
+        seen = datetime.fromisoformat(event["last_seen"]).timestamp()
+        return (f"{event['src_port']}-{event['last_seen']}", "network", seen)
+    return None
+
+
+def file_storm(root, rate, duration, dirs, stop):
+    """Write new files at `rate`/s spread over `dirs` subdirectories; returns via the list it fills."""
+    subdirs = [root / f"d{i:03d}" for i in range(dirs)]
+    for d in subdirs:
+        d.mkdir()
+    written, started = [0], time.monotonic()
+    def run():
+        while rate > 0 and not stop.is_set():
+            elapsed = time.monotonic() - started
+            if elapsed >= duration:
+                break
+            for _ in range(int(elapsed * rate) - written[0]):
+                ns = time.time_ns()
+                with open(subdirs[written[0] % dirs] / f"{ns}.dat", "wb") as f:
+                    f.write(b"x" * 512)
+                written[0] += 1
+            time.sleep(0.01)
+    thread = threading.Thread(target=run, name="file-storm", daemon=True)
+    thread.start()
+    return thread, written
+
+
+class ProcSampler:
+    """CPU seconds and peak RSS of one process, from /proc every `interval` seconds."""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.cpu = 0.0
+        self.rss_peak = 0
+        self.rss_samples = []
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{self.pid}/statm") as f:
+                rss = int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            return
+        self.cpu = (int(fields[11]) + int(fields[12])) / CLK_TCK  # utime + stime
+        self.rss_peak = max(self.rss_peak, rss)
+        self.rss_samples.append(rss)
+
+    def _run(self):
+        while not self.stop.wait(self.interval):
+            self.sample()
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def write_agent(workdir, args, hub_url, api_key, storm_dir):
+    for src in AGENT_DIR.glob("*.py"):
+        if src.name not in SKIP_FILES:
+            shutil.copy(src, workdir / src.name)
+    net_mon = workdir / "net_mon.bin"
+    net_mon.write_text(FAKE_NET_MON)
+    net_mon.chmod(0o755)
+    (workdir / "events").mkdir()
+    agent_yaml = {
+        "hub_url": hub_url,
+        "device_id": "bench",
+        "device_name": "bench",
+        "api_key": api_key,
+        "file_monitor": {"enabled": args.files_per_sec > 0, "paths": [str(storm_dir)],
+                         "coalesce_window": args.coalesce_window},
+        "network_monitor": {"enabled": args.packets_per_sec > 0, "output": "binary", "stats_interval": 0},
+        "process_attribution": {"enabled": False},
+        "file_hashing": {"enabled": args.hash},
+        "sender": {"concurrency": args.concurrency},
+        "runtime": {"json_backend": args.backend, "log_events": False, "config_poll_interval": 0},
+        "metrics": {"listen": "", "health_interval": 0},
+    }
+    with open(workdir / "agent.yaml", "w") as f:
+        yaml.dump(agent_yaml, f, sort_keys=False)
+
+
+def wait_for(predicate, timeout, step=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(step)
+    return predicate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of synthetic load")
+    parser.add_argument("--files-per-sec", type=float, default=200)
+    parser.add_argument("--packets-per-sec", type=float, default=2000)
+    parser.add_argument("--dirs", type=int, default=16, help="subdirectories the file storm spreads over")
+    parser.add_argument("--coalesce-window", type=float, default=0.5)
+    parser.add_argument("--hash", action="store_true", help="enable file_hashing")
+    parser.add_argument("--concurrency", type=int, default=4, help="sender.concurrency")
+    parser.add_argument("--backend", default="auto", choices=("auto", "json", "orjson"))
+    parser.add_argument("--hub-delay", type=float, default=0.0, help="seconds the stub hub waits per batch")
+    parser.add_argument("--drain-timeout", type=float, default=30.0,
+                        help="seconds to wait for outstanding acks after the load stops")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory and daemon log")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    api_key = base64.urlsafe_b64encode(os.urandom(32)).decode("ascii")
+    hub = StubHub(api_key, args.hub_delay)
+    threading.Thread(target=hub.serve_forever, name="stub-hub", daemon=True).start()
+
+    workdir = Path(tempfile.mkdtemp(prefix="agent-bench-"))
+    storm_dir = workdir / "storm"
+    storm_dir.mkdir()
+    count_file = workdir / "net_mon.count"
+    write_agent(workdir, args, f"http://127.0.0.1:{hub.server_address[1]}", api_key, storm_dir)
+
+    env = dict(os.environ, BENCH_PACKETS_PER_SEC=str(args.packets_per_sec),
+               BENCH_DURATION=str(args.duration), BENCH_COUNT_FILE=str(count_file))
+    log = open(workdir / "daemon.log", "wb")
+    proc = subprocess.Popen([sys.executable, str(workdir / "daemon.py")], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+    sampler = ProcSampler(proc.pid)
+    stop = threading.Event()
+    try:
+        ready = b"Started monitoring path" if args.files_per_sec > 0 else b"Daemon started"
+        if not wait_for(lambda: ready in (workdir / "daemon.log").read_bytes() or proc.poll() is not None, 15):
+            raise SystemExit(f"daemon did not start, see {workdir / 'daemon.log'}")
+        if proc.poll() is not None:
+            raise SystemExit(f"daemon exited with {proc.returncode}, see {workdir / 'daemon.log'}")
+        cpu_start, started = sampler.cpu, time.time()
+        storm, written = file_storm(storm_dir, args.files_per_sec, args.duration, args.dirs, stop)
+        storm.join()
+        wait_for(lambda: count_file.exists() or args.packets_per_sec <= 0, args.duration + 5)
+        packets = int(count_file.read_text()) if count_file.exists() else 0
+        expected = written[0] + packets
+        drained = wait_for(lambda: len(hub.acked) >= expected, args.drain_timeout, step=0.1)
+        sampler.sample()
+        cpu_used = sampler.cpu - cpu_start
+    finally:
+        stop.set()
+        sampler.stop.set()
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGTERM)
+            try:
+                proc.wait(30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        log.close()
+        hub.shutdown()
+
+    with hub.lock:
+        acked = dict(hub.acked)
+        elapsed = max((hub.last_ack or started) - started, 1e-9)
+        events, batches = hub.events, hub.batches
+    report = {
+        "duration": args.duration,
+        "generated": {"file": written[0], "network": packets},
+        "acknowledged": {"file": 0, "network": 0},
+        "drained": drained,
+        "events": events,
+        "batches": batches,
+        "events_per_sec": round(events / elapsed, 1),
+        "latency_ms": {},
+        "cpu_seconds": round(cpu_used, 2),
+        "cpu_percent": round(100 * cpu_used / elapsed, 1),
+        "rss_peak_mb": round(sampler.rss_peak / 2**20, 1),
+        "rss_median_mb": round(percentile(sorted(sampler.rss_samples), 0.5) / 2**20, 1) if sampler.rss_samples else None,
+    }
+    for source in ("file", "network"):
+        latencies = sorted(lat for src, lat in acked.values() if src == source)
+        report["acknowledged"][source] = len(latencies)
+        if latencies:
+            report["latency_ms"][source] = {
+                "p50": round(percentile(latencies, 0.5) * 1000, 1),
+                "p99": round(percentile(latencies, 0.99) * 1000, 1),
+                "max": round(latencies[-1] * 1000, 1),
+            }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"load: {args.duration:g}s, {args.files_per_sec:g} files/s, {args.packets_per_sec:g} packets/s")
+        for source in ("file", "network"):
+            line = f"{source:8} generated {report['generated'][source]:7}  acked {report['acknowledged'][source]:7}"
+            lat = report["latency_ms"].get(source)
+            if lat:
+                line += f"  p50 {lat['p50']:8.1f} ms  p99 {lat['p99']:8.1f} ms  max {lat['max']:8.1f} ms"
+            print(line)
+        print(f"delivered {events} events in {batches} batches, {report['events_per_sec']:.1f} events/s")
+        print(f"daemon CPU {report['cpu_seconds']:.2f}s ({report['cpu_percent']:.1f}%), "
+              f"RSS peak {report['rss_peak_mb']:.1f} MB")
+        if not drained:
+            print(f"[WARNING] not every event was acknowledged within {args.drain_timeout:g}s")
+
+    if args.keep:
+        print(f"scratch directory kept: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if drained else 1)
+
+
+if __name__ == "__main__":
+    main()
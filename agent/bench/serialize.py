@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Per-event CPU cost of the agent's serialization path.
+
+    python3 bench/serialize.py [--events N] [--backend auto|json|orjson]
+
+"dict path" is how events used to travel: json.dumps for the spool,
+again for the log line, json.loads when reading the spool back and
+json.dumps once more inside encrypt_payload. "encoded path" is the
+current one: an Event is encoded once and the same bytes are logged,
+spooled and joined into the upload. AES-GCM is the same for both and is
+left out, so only the serialization cost is compared.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from eventmodel import Event, join_records, set_json_backend  # noqa: E402
+
+BATCH = 200
+
+
+def network_fields(i):
+    return {
+        "interface": "eth0", "src_ip": "10.0.0.1", "dst_ip": "10.0.0.2",
+        "src_port": 40000 + i % 20000, "dst_port": 443, "record": "flow", "protocol": "tcp",
+        "packets": 12, "bytes": 3400, "tcp_flags": "SPAF",
+        "first_seen": "2024-01-01T00:00:00+00:00", "last_seen": "2024-01-01T00:00:01+00:00",
+        "end_reason": "end", "process": "curl", "pid": 4242,
+    }
+
+
+def dict_path(n, log):
+    spool = []
+    for i in range(n):
+        event = network_fields(i)
+        event.update({"device_id": "bench", "event_type": "network",
+                      "timestamp": "2024-01-01T00:00:01+00:00", "id": f"bench-{i}", "seq": i})
+        line = json.dumps(event)
+        log.write(f"[NETWORK EVENT] {json.dumps(event)}\n")
+        spool.append(line.encode("utf-8"))
+    for start in range(0, n, BATCH):
+        batch = [json.loads(r) for r in spool[start:start + BATCH]]
+        json.dumps(batch).encode("utf-8")
+
+
+def encoded_path(n, log):
+    spool = []
+    for i in range(n):
+        event = Event("network", "bench", "2024-01-01T00:00:01+00:00", flat=network_fields(i))
+        data = event.encode(f"bench-{i}", 0, i)
+        log.write(b"[NETWORK EVENT] %s\n" % data)
+        spool.append(data)
+    for start in range(0, n, BATCH):
+        join_records(spool[start:start + BATCH])
+
+
+def measure(fn, n, binary):
+    best = None
+    for _ in range(3):
+        log = io.BytesIO() if binary else io.StringIO()
+        started = time.process_time()
+        fn(n, log)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / n * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--events", type=int, default=50000)
+    parser.add_argument("--backend", default="auto", choices=("auto", "json", "orjson"))
+    args = parser.parse_args()
+
+    backend = set_json_backend(args.backend)
+    old = measure(dict_path, args.events, binary=False)
+    new = measure(encoded_path, args.events, binary=True)
+    print(f"events: {args.events}, json backend: {backend}")
+    print(f"dict path:    {old:7.2f} us/event CPU")
+    print(f"encoded path: {new:7.2f} us/event CPU  ({old / new:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
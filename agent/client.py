@@ -1,13 +1,40 @@
 # hub_client.py
+import os
+import secrets
 import requests
 import yaml
 from pathlib import Path
 
 CONFIG_FILE = Path(__file__).parent / "agent.yaml"
+REGISTRATION_TOKEN_FILE = Path(__file__).parent / "events" / "registration.token"
 
-def fetch_api_key(device_id: str, device_name: str, hub_url: str, secret_token: str):
+def registration_token(path=REGISTRATION_TOKEN_FILE):
+    """
+    Token this agent registers with, created on first use and kept on disk
+    before it is ever sent, so a retry after a lost response proves it is
+    the same agent and gets its key back.
+    """
+    try:
+        return path.read_text().strip()
+    except FileNotFoundError:
+        pass
+    token = secrets.token_urlsafe(32)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return token
+
+def fetch_api_key(device_id: str, device_name: str, hub_url: str, secret_token: str, timeout=10, token=None):
     """
     Request a new API key from the dashboard if agent.yaml does not have one.
+    With `token` (see registration_token) a retry of a registration the hub
+    already stored returns the same key.
+    Raises requests exceptions (HTTPError for 4xx/5xx) so callers can retry.
     """
     url = f"{hub_url}/api/devices/"
     headers = {
@@ -15,23 +42,38 @@ def fetch_api_key(device_id: str, device_name: str, hub_url: str, secret_token:
         "Content-Type": "application/json"
     }
     payload = {"device_id": device_id, "name": device_name}
+    if token:
+        payload["registration_token"] = token
 
-    resp = requests.post(url, json=payload, headers=headers)
+    resp = requests.post(url, json=payload, headers=headers, timeout=timeout)
     if resp.status_code in [200, 201]:
         api_key = resp.json()["api_key"]
         print(f"[INFO] Retrieved API key for {device_id}: {api_key[:6]}...")
-
-        # Save it back to agent.yaml
-        config = yaml.safe_load(CONFIG_FILE.read_text())
-        config["api_key"] = api_key
-        CONFIG_FILE.write_text(yaml.dump(config))
-        return api_key
-    elif resp.status_code == 409:  # Device already exists
-        api_key = resp.json().get("api_key")
-        print(f"[INFO] Device already registered. Using existing API key.")
-        return api_key
     else:
+        resp.raise_for_status()
         raise RuntimeError(f"Failed to fetch API key: {resp.status_code}, {resp.text}")
 
+    # Save it back to agent.yaml
+    config = yaml.safe_load(CONFIG_FILE.read_text())
+    config["api_key"] = api_key
+    save_config(config)
+    return api_key
+
+def save_config(config: dict, path=CONFIG_FILE):
+    """
+    Replace agent.yaml in one step: the running daemon polls it and must
+    never read a half-written file.
+    """
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w") as f:
+        yaml.safe_dump(config, f)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.chmod(tmp, path.stat().st_mode & 0o777)  # agent.yaml holds the api_key
+    except FileNotFoundError:
+        pass
+    os.replace(tmp, path)
+
 def send_event(event_json: dict):
     print("[DEBUG] Event ready to send:", event_json)
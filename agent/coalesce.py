@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import threading
+import time
+
+
+class Coalescer:
+    """
+    Merges bursts of file events on the same path into one event.
+
+    The first event on a path opens an entry; later events within the
+    window add their action to its set of actions (first-seen order),
+    become its latest action and bump its count. An entry is emitted
+    once the path has been quiet for `window` seconds, or at the latest
+    `max_wait` seconds after it was opened, so a file that is written
+    continuously still reports regularly. `max_pending` bounds memory: when
+    exceeded, the oldest entries are emitted early.
+
+    The owner calls flush() periodically (every window/2 or so);
+    emit(path, actions, last_action, count, first_seen, last_seen) is
+    called from add() and flush() with epoch timestamps.
+    """
+
+    def __init__(self, emit, window=0.5, max_wait=5.0, max_pending=10000):
+        self.emit = emit
+        self.window = window
+        self.max_wait = max(max_wait, window)
+        self.max_pending = max_pending
+        self.pending = {}  # path -> [actions, last_action, count, first_seen, last_seen]
+        self.lock = threading.Lock()
+
+    def add(self, path, action, now=None):
+        now = time.time() if now is None else now
+        overflow = []
+        with self.lock:
+            entry = self.pending.get(path)
+            if entry is None:
+                self.pending[path] = [[action], action, 1, now, now]
+                while len(self.pending) > self.max_pending:
+                    oldest = next(iter(self.pending))
+                    overflow.append((oldest, self.pending.pop(oldest)))
+            else:
+                if action not in entry[0]:
+                    entry[0].append(action)
+                entry[1] = action
+                entry[2] += 1
+                entry[4] = now
+        for path, entry in overflow:
+            self.emit(path, *entry)
+
+    def flush(self, force=False, now=None):
+        now = time.time() if now is None else now
+        ready = []
+        with self.lock:
+            for path, entry in list(self.pending.items()):
+                if force or now - entry[4] >= self.window or now - entry[3] >= self.max_wait:
+                    ready.append((path, self.pending.pop(path)))
+        for path, entry in ready:
+            self.emit(path, *entry)
+        return len(ready)
@@ -1,162 +1,1028 @@
 #!/usr/bin/env python3
 import os
+import sys
 import json
-import uuid
 import time
 import yaml
-import subprocess
-import queue
+import signal
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-from threading import Thread
 from pathlib import Path
-from helper import send_event
+from helper import send_batch, get_session
+from client import fetch_api_key, registration_token
+from spool import Spool
+from pathindex import PathFilter
+from filewatch import create_watcher
+from coalesce import Coalescer
+from eventid import EventIds
+from eventmodel import Event, set_json_backend
+from netmon import decode_records as decode_netmon_records
+from procinfo import ProcessCache, FileProcessTracker
+from hashing import FileHasher
+from metrics import Registry, SIZE_BUCKETS, serve_http
+from retry import RetryPolicy, CircuitBreaker, classify, REJECTED, TRANSIENT
 
 # === Paths & Config ===
 SCRIPT_DIR = Path(__file__).parent
 CONFIG_FILE = SCRIPT_DIR / "agent.yaml"
 EVENT_DIR = SCRIPT_DIR / "events"
+SPOOL_DIR = EVENT_DIR / "spool"
 NET_MON = SCRIPT_DIR / "net_mon.bin"
-os.makedirs(EVENT_DIR, exist_ok=True)
-
-FILE_EVENTS_JSON = EVENT_DIR / "file_events.json"
-NETWORK_EVENTS_JSON = EVENT_DIR / "network_events.json"
+os.makedirs(SPOOL_DIR, exist_ok=True)
 
 with open(CONFIG_FILE) as f:
     config = yaml.safe_load(f)
 
 DEVICE_ID = config.get("device_id", "agent-123")
 DEVICE_NAME = config.get("device_name", DEVICE_ID)
-FILE_PATHS = [Path(p) for p in config.get("file_monitor", {}).get("paths", [])]
-FILE_MONITOR_ENABLED = config.get("file_monitor", {}).get("enabled", False)
-NETWORK_MONITOR_ENABLED = config.get("network_monitor", {}).get("enabled", False)
-HUB_BASE_URL = config.get("hub_url", "http://127.0.0.1:5000")
+
+def _config_list(section: dict, key: str) -> list:
+    value = section.get(key) or []
+    if not isinstance(value, list):
+        raise ValueError(f"{key} must be a list, got {value!r}")
+    return value
+
+def file_monitor_settings(fm: dict) -> tuple:
+    """
+    Validated FILE_* settings of a file_monitor section, in the order
+    configure_file_monitor assigns them; raises ValueError or TypeError on
+    an invalid value, so a reload can check everything before applying it.
+    """
+    paths = [Path(p) for p in _config_list(fm, "paths")]
+    # Glob rules, e.g. exclude: ["*.swp", "node_modules/"]; exclude wins over include
+    include = _config_list(fm, "include")
+    exclude = _config_list(fm, "exclude")
+    return (
+        bool(fm.get("enabled", False)),
+        paths,
+        include,
+        exclude,
+        PathFilter(paths, include=include, exclude=exclude),
+        # Repeated actions on one path within the window become one event (0 disables)
+        float(fm.get("coalesce_window", 0.5)),
+        float(fm.get("coalesce_max_wait", 5.0)),
+        # auto (inotify on Linux, else watchdog), inotify, fanotify (mount marks, root only) or watchdog
+        fm.get("backend", "auto"),
+    )
+
+def network_monitor_settings(nm: dict) -> tuple:
+    """Validated NETWORK_* settings of a network_monitor section, like file_monitor_settings."""
+    output = nm.get("output", "binary")
+    if output not in ("binary", "json"):
+        raise ValueError(f"output must be binary or json, got {output!r}")
+    bpf_filter = nm.get("bpf_filter", "") or ""
+    if not isinstance(bpf_filter, str):
+        raise ValueError(f"bpf_filter must be a string, got {bpf_filter!r}")
+    ports = [int(p) for p in _config_list(nm, "ports")]
+    if any(not 0 < p < 65536 for p in ports):
+        raise ValueError(f"ports must be between 1 and 65535, got {ports}")
+    return (
+        nm,
+        bool(nm.get("enabled", False)),
+        # Flow mode: net_mon.bin aggregates packets per 5-tuple and emits one record
+        # when a flow ends, goes idle for flow_idle_timeout or runs past flow_active_timeout
+        bool(nm.get("flow_mode", False)),
+        int(nm.get("flow_table_size", 65536)),
+        int(nm.get("flow_idle_timeout", 30)),
+        int(nm.get("flow_active_timeout", 300)),
+        # "binary" (fixed-size records, default) or "json" (one JSON line per record, for debugging)
+        output,
+        # Capture selection, compiled into the kernel BPF filter: ports (empty = all TCP),
+        # an optional extra BPF expression and an interface allow-list (empty = all up).
+        # Ports and bpf_filter are swapped on the running capture when agent.yaml changes.
+        ports,
+        bpf_filter,
+        [str(i) for i in _config_list(nm, "interfaces")],
+        # Capture tuning; the default snaplen keeps only the headers we parse
+        int(nm.get("snaplen", 128)),
+        int(nm.get("buffer_size", 0)),
+        bool(nm.get("immediate", False)),
+        bool(nm.get("promisc", False)),
+        int(nm.get("stats_interval", 10)),
+    )
+
+def configure_file_monitor(settings: tuple):
+    """Set the FILE_* globals from file_monitor_settings(); re-run on config reload."""
+    global FILE_MONITOR_ENABLED, FILE_PATHS, FILE_INCLUDE, FILE_EXCLUDE, PATH_FILTER
+    global FILE_COALESCE_WINDOW, FILE_COALESCE_MAX_WAIT, FILE_BACKEND
+    (FILE_MONITOR_ENABLED, FILE_PATHS, FILE_INCLUDE, FILE_EXCLUDE, PATH_FILTER,
+     FILE_COALESCE_WINDOW, FILE_COALESCE_MAX_WAIT, FILE_BACKEND) = settings
+
+def configure_network_monitor(settings: tuple):
+    """Set the NETWORK_* globals from network_monitor_settings(); re-run on config reload."""
+    global NETMON_CFG, NETWORK_MONITOR_ENABLED, NETWORK_FLOW_MODE, NETWORK_FLOW_TABLE_SIZE
+    global NETWORK_FLOW_IDLE_TIMEOUT, NETWORK_FLOW_ACTIVE_TIMEOUT, NETWORK_OUTPUT
+    global NETWORK_PORTS, NETWORK_BPF_FILTER, NETWORK_INTERFACES, NETWORK_SNAPLEN
+    global NETWORK_BUFFER_SIZE, NETWORK_IMMEDIATE, NETWORK_PROMISC, NETWORK_STATS_INTERVAL
+    (NETMON_CFG, NETWORK_MONITOR_ENABLED, NETWORK_FLOW_MODE, NETWORK_FLOW_TABLE_SIZE,
+     NETWORK_FLOW_IDLE_TIMEOUT, NETWORK_FLOW_ACTIVE_TIMEOUT, NETWORK_OUTPUT,
+     NETWORK_PORTS, NETWORK_BPF_FILTER, NETWORK_INTERFACES, NETWORK_SNAPLEN,
+     NETWORK_BUFFER_SIZE, NETWORK_IMMEDIATE, NETWORK_PROMISC, NETWORK_STATS_INTERVAL) = settings
+
+configure_file_monitor(file_monitor_settings(config.get("file_monitor", {}) or {}))
+configure_network_monitor(network_monitor_settings(config.get("network_monitor", {}) or {}))
+HUB_BASE_URL = config.get("hub_url", "http://127.0.0.1:5000").rstrip("/")
 EVENT_URL = HUB_BASE_URL + "/api/events/"
+BULK_URL = HUB_BASE_URL + "/api/events/bulk"
+
+# Batching: a batch is flushed when it reaches max events, max bytes,
+# or when the oldest event in it has waited max_delay seconds.
+SENDER_CFG = config.get("sender", {}) or {}
+BATCH_MAX_EVENTS = int(SENDER_CFG.get("batch_max_events", 200))
+BATCH_MAX_BYTES = int(SENDER_CFG.get("batch_max_bytes", 256 * 1024))
+BATCH_MAX_DELAY = float(SENDER_CFG.get("batch_max_delay", 1.0))
+# Uploads run in one lane per event type (order is kept within a lane);
+# concurrency caps how many lanes may have a request in flight at once.
+SENDER_CONCURRENCY = max(1, int(SENDER_CFG.get("concurrency", 4)))
+RETRY_BASE_DELAY = float(SENDER_CFG.get("retry_base_delay", 1.0))
+RETRY_MAX_DELAY = float(SENDER_CFG.get("retry_max_delay", 300.0))
+BREAKER_THRESHOLD = int(SENDER_CFG.get("breaker_threshold", 5))
+BREAKER_COOLDOWN = float(SENDER_CFG.get("breaker_cooldown", 10.0))
+# A batch the hub refuses as a whole (400/401/...) this many times is moved
+# to events/dead_letter/ so it cannot block its lane; 413 splits the batch instead
+SENDER_MAX_REJECTED = max(1, int(SENDER_CFG.get("max_rejected_attempts", 5)))
+DEAD_LETTER_DIR = EVENT_DIR / "dead_letter"
+DEAD_LETTER_MAX_BYTES = int(SENDER_CFG.get("dead_letter_max_bytes", 64 * 1024 * 1024))
+
+# Spool: events are appended to disk per event type and only deleted once
+# the hub has acknowledged them.
+SPOOL_CFG = config.get("spool", {}) or {}
+SPOOL_SEGMENT_BYTES = int(SPOOL_CFG.get("segment_bytes", 4 * 1024 * 1024))
+SPOOL_MAX_BYTES = int(SPOOL_CFG.get("max_bytes", 256 * 1024 * 1024))
+SPOOL_FSYNC = bool(SPOOL_CFG.get("fsync", False))
+
+# Runtime: capture sources feed bounded queues; when a queue is full the
+# source waits, so a slow disk or hub throttles capture instead of memory.
+# On shutdown uploads get shutdown_timeout seconds to drain the spool.
+RUNTIME_CFG = config.get("runtime", {}) or {}
+RUNTIME_QUEUE_SIZE = max(1, int(RUNTIME_CFG.get("queue_size", 10000)))
+RUNTIME_SHUTDOWN_TIMEOUT = float(RUNTIME_CFG.get("shutdown_timeout", 10.0))
+# agent.yaml is checked this often and changes are applied live (0 disables)
+RUNTIME_CONFIG_POLL = float(RUNTIME_CFG.get("config_poll_interval", 2.0))
+# Events are encoded once; "auto" uses orjson when it is installed
+RUNTIME_JSON_BACKEND = set_json_backend(RUNTIME_CFG.get("json_backend", "auto"))
+# Echo every event to stdout (the journal); turn off on busy hosts
+RUNTIME_LOG_EVENTS = bool(RUNTIME_CFG.get("log_events", True))
+
+# Self-metrics in Prometheus text format on "host:port" or "unix:/path"
+# ("" disables), plus an optional periodic health event to the hub
+METRICS_CFG = config.get("metrics", {}) or {}
+METRICS_LISTEN = METRICS_CFG.get("listen", "127.0.0.1:9108") or ""
+METRICS_HEALTH_INTERVAL = float(METRICS_CFG.get("health_interval", 60))
+
+# Process attribution: socket -> pid via /proc for network events, last
+# writer via fanotify for file events, both behind TTL/LRU caches
+PROC_CFG = config.get("process_attribution", {}) or {}
+PROC_ATTRIBUTION_ENABLED = bool(PROC_CFG.get("enabled", True))
+PROC_CACHE_TTL = float(PROC_CFG.get("ttl", 30.0))
+PROC_CACHE_MAX_ENTRIES = int(PROC_CFG.get("max_entries", 65536))
+PROC_MIN_REFRESH = float(PROC_CFG.get("min_refresh", 1.0))
+PROC_FANOTIFY = bool(PROC_CFG.get("fanotify", True))
+
+# Content digests for created/modified files, computed on their own pool
+# and cached per inode by mtime and size
+HASH_CFG = config.get("file_hashing", {}) or {}
+HASH_ENABLED = bool(HASH_CFG.get("enabled", False))
+HASH_ALGORITHM = HASH_CFG.get("algorithm", "sha256")
+HASH_MAX_BYTES = int(HASH_CFG.get("max_bytes", 64 * 2**20))
+HASH_WORKERS = max(1, int(HASH_CFG.get("workers", 2)))
+# Beyond this many events waiting for a digest, events go out without one
+# instead of holding up intake
+HASH_MAX_PENDING = int(HASH_CFG.get("max_pending", 1000))
+HASH_CACHE_ENTRIES = int(HASH_CFG.get("cache_entries", 65536))
+HASH_ACTIONS = {"created", "modified", "closed"}
 
+# Without an api_key the agent registers in the background; capture
+# starts regardless and uploads begin once the hub hands out a key.
+# events/registration.token lets a retry claim the key of a registration
+# whose response was lost; nobody else can
 API_KEY = config.get("api_key", "")
-if not API_KEY:
-    from client import fetch_api_key
-    API_KEY = fetch_api_key(DEVICE_ID, DEVICE_NAME, HUB_BASE_URL, secret_token="super-secret-token")
+REGISTRATION_CFG = config.get("registration", {}) or {}
+REGISTRATION_SECRET = REGISTRATION_CFG.get("secret_token", "super-secret-token")
+REGISTRATION_TIMEOUT = float(REGISTRATION_CFG.get("timeout", 10.0))
 
-EVENT_QUEUE = queue.Queue()
+# Event ids double as the hub's document ids, so a retried upload cannot
+# create duplicates and the hub can spot missing sequence numbers
+EVENT_IDS = EventIds(DEVICE_ID, EVENT_DIR / "sequence.json")
+RETRY_POLICY = RetryPolicy(RETRY_BASE_DELAY, RETRY_MAX_DELAY)
+BREAKER = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN, RETRY_MAX_DELAY)
+get_session(pool_size=SENDER_CONCURRENCY)
+
+PROCESS_CACHE = ProcessCache(
+    ttl=PROC_CACHE_TTL, max_entries=PROC_CACHE_MAX_ENTRIES, min_refresh=PROC_MIN_REFRESH
+) if PROC_ATTRIBUTION_ENABLED else None
+FILE_PROCESSES = FileProcessTracker(
+    PROCESS_CACHE, ttl=PROC_CACHE_TTL, max_entries=PROC_CACHE_MAX_ENTRIES
+) if PROC_ATTRIBUTION_ENABLED and PROC_FANOTIFY else None
+FILE_HASHER = FileHasher(
+    HASH_ALGORITHM, max_bytes=HASH_MAX_BYTES, cache_entries=HASH_CACHE_ENTRIES
+) if HASH_ENABLED else None
+
+METRICS = Registry()
+EVENTS_CAPTURED = METRICS.counter("agent_events_captured_total", "Raw events received from capture sources", ("source",))
+EVENTS_FILTERED = METRICS.counter("agent_events_filtered_total", "Events discarded or merged before the spool", ("source", "reason"))
+EVENTS_SPOOLED = METRICS.counter("agent_events_spooled_total", "Events appended to the spool", ("event_type",))
+EVENTS_DELIVERED = METRICS.counter("agent_events_delivered_total", "Events answered by the hub", ("event_type", "result"))
+EVENTS_DEAD_LETTERED = METRICS.counter("agent_events_dead_lettered_total", "Events given up on after the hub refused their batch",
+                                       ("event_type", "stored"))
+SEND_RETRIES = METRICS.counter("agent_send_retries_total", "Upload attempts that failed and will be retried", ("kind",))
+BATCH_SIZE = METRICS.histogram("agent_batch_size_events", "Events per bulk upload", buckets=SIZE_BUCKETS)
+SEND_LATENCY = METRICS.histogram("agent_send_latency_seconds", "Bulk upload request latency", ("outcome",))
+FILE_HASHES = METRICS.counter("agent_file_hashes_total", "File content hash attempts by outcome", ("result",))
+PCAP_RECEIVED = METRICS.counter("agent_pcap_received_packets_total", "Packets seen by libpcap", ("interface",))
+PCAP_DROPPED = METRICS.counter("agent_pcap_dropped_packets_total", "Packets dropped by the kernel capture buffer", ("interface",))
+METRICS.gauge("agent_registered", "1 once the agent holds an API key for the hub",
+              fn=lambda: 1 if API_KEY else 0)
+METRICS.gauge("agent_breaker_open", "1 while the hub circuit breaker is open or half-open",
+              fn=lambda: 0 if BREAKER.state == BREAKER.CLOSED else 1)
 
 # === Helpers ===
 def utc_timestamp() -> str:
     return datetime.now(timezone.utc).isoformat()
 
-def save_event_locally(event_json: dict, is_file_event: bool):
-    filename = FILE_EVENTS_JSON if is_file_event else NETWORK_EVENTS_JSON
-    with filename.open("a") as f:
-        f.write(json.dumps(event_json) + "\n")
-    print(f"[{'FILE' if is_file_event else 'NETWORK'} EVENT] {json.dumps(event_json)}", flush=True)
-    EVENT_QUEUE.put(event_json)
+def check_records(records):
+    """Drop spool records that cannot be an encoded event; the rest are sent as they are."""
+    batch = []
+    for record in records:
+        if record[:1] == b"{" and record[-1:] == b"}":
+            batch.append(record)
+        else:
+            EVENTS_FILTERED.inc(source="spool", reason="corrupt")
+            print(f"[WARNING] Skipping corrupt spool record: {record[:80]!r}", flush=True)
+    return batch
 
-def event_sender_worker():
-    while True:
-        event_json = EVENT_QUEUE.get()
-        try:
-            resp = send_event(
-                hub_url=EVENT_URL,
-                device_id=DEVICE_ID,
-                api_key=API_KEY,
-                payload_dict=event_json
-            )
-            if resp:
-                print(f"[HUB] Event delivered, status={resp.status_code}", flush=True)
-            else:
-                print("[HUB] Send failed, requeueing event", flush=True)
-                EVENT_QUEUE.put(event_json)
-                time.sleep(5)
-        except Exception as e:
-            print(f"[ERROR] Unexpected in sender worker: {e}", flush=True)
-            EVENT_QUEUE.put(event_json)
-            time.sleep(5)
-        finally:
-            EVENT_QUEUE.task_done()
-
-# === File Monitoring ===
-class FileEventHandler(FileSystemEventHandler):
-    def on_any_event(self, event):
-        if event.is_directory:
-            return
-        if FILE_PATHS and not any(Path(event.src_path).resolve().is_relative_to(p.resolve()) for p in FILE_PATHS):
-            return
+def dead_letter(batch, event_type, reason):
+    """Set aside a batch the hub keeps refusing; kept on disk up to dead_letter_max_bytes in total."""
+    path = DEAD_LETTER_DIR / f"{event_type}.jsonl"
+    size = sum(len(r) + 1 for r in batch)
+    try:
+        os.makedirs(DEAD_LETTER_DIR, exist_ok=True)
+        used = sum(f.stat().st_size for f in DEAD_LETTER_DIR.iterdir())
+        if used + size > DEAD_LETTER_MAX_BYTES:
+            raise OSError("dead_letter_max_bytes reached")
+        with open(path, "ab") as f:
+            f.write(b"".join(r + b"\n" for r in batch))
+        stored = "yes"
+    except OSError as e:
+        stored = "no"
+        print(f"[WARNING] Could not keep dead-lettered events in {path}: {e}", flush=True)
+    EVENTS_DEAD_LETTERED.inc(len(batch), event_type=event_type, stored=stored)
+    print(f"[ERROR] Hub refused {len(batch)} {event_type} events ({reason}), giving up on them"
+          + (f"; saved to {path}" if stored == "yes" else ""), flush=True)
+
+def result_status(result) -> int:
+    """HTTP status of one per-event result; a malformed or missing result counts as 503, so it is retried."""
+    status = result.get("status") if isinstance(result, dict) else None
+    if isinstance(status, int) and not isinstance(status, bool):
+        return status
+    return 503
+
+def report_batch_results(resp, batch, event_type):
+    """Log the per-event results and return the encoded events worth sending again."""
+    try:
+        body = resp.json()
+    except ValueError:
+        body = {}
+    results = body.get("results") if isinstance(body, dict) else None
+    if not isinstance(results, list):
+        results = []
+    results = results[:len(batch)] + [None] * (len(batch) - len(results))
+    statuses = [result_status(r) for r in results]
+    retry = [event for event, status in zip(batch, statuses) if status == 429 or status >= 500]
+    rejected = [(r, status) for r, status in zip(results, statuses) if 300 <= status < 500 and status != 429]
+    EVENTS_DELIVERED.inc(len(batch) - len(retry) - len(rejected), event_type=event_type, result="accepted")
+    EVENTS_DELIVERED.inc(len(rejected), event_type=event_type, result="rejected")
+    print(f"[HUB] Batch delivered, status={resp.status_code}, events={len(batch)}, "
+          f"rejected={len(rejected)}, retry={len(retry)}", flush=True)
+    for r, status in rejected:
+        print(f"[WARNING] Hub rejected event {r.get('id')} ({status}): {r.get('error')}", flush=True)
+    return retry
+
+# === Normalize: raw capture data -> events ===
+def build_file_event(path, actions, action, count, first_seen, last_seen) -> Event:
+    """
+    Runs on the loop, so the writer's name only comes from the cache; an
+    uncached pid leaves `process` None for put_file_event to resolve.
+    """
+    pid = FILE_PROCESSES.writer(path) if FILE_PROCESSES else None
+    hit, proc = PROCESS_CACHE.peek_pid(pid) if pid is not None else (True, None)
+    return Event(
+        "file", DEVICE_ID, utc_timestamp(),
+        details={
+            "path": path,
+            "action": action,
+            "actions": actions,
+            "count": count,
+            "first_seen": datetime.fromtimestamp(first_seen, timezone.utc).isoformat(),
+            "last_seen": datetime.fromtimestamp(last_seen, timezone.utc).isoformat(),
+            "process": (proc["name"] if proc else "unknown") if hit else None,
+            "pid": pid
+        }
+    )
 
-        event_json = {
-            "id": str(uuid.uuid4()),
-            "device_id": DEVICE_ID,
-            "event_type": "file",
-            "details": {
-                "path": str(event.src_path),
-                "action": event.event_type,
-                "process": "unknown"
-            },
-            "timestamp": utc_timestamp()
+CAPTURE_STATS = {}  # interface -> last cumulative (received, dropped)
+
+def build_capture_stats_event(fields: dict) -> Event:
+    """Turn a pcap_stats report from net_mon.bin into a monitor-health event."""
+    iface = fields.get("interface")
+    received, dropped = fields.get("received", 0), fields.get("dropped", 0)
+    prev_received, prev_dropped = CAPTURE_STATS.get(iface, (0, 0))
+    CAPTURE_STATS[iface] = (received, dropped)
+    # Counters are 32-bit and may wrap; treat a decrease as a fresh start
+    received_delta = received - prev_received if received >= prev_received else received
+    dropped_delta = dropped - prev_dropped if dropped >= prev_dropped else dropped
+    seen = received_delta + dropped_delta
+    PCAP_RECEIVED.inc(received_delta, interface=iface)
+    PCAP_DROPPED.inc(dropped_delta, interface=iface)
+    if dropped_delta:
+        print(f"[WARNING] Kernel dropped {dropped_delta} packets on {iface}", flush=True)
+    return Event(
+        "health", DEVICE_ID, utc_timestamp(),
+        details={
+            "source": "net_mon",
+            **fields,
+            "received_delta": received_delta,
+            "dropped_delta": dropped_delta,
+            "drop_ratio": round(dropped_delta / seen, 6) if seen else 0.0
         }
-        save_event_locally(event_json, is_file_event=True)
-
-# === Network Monitoring via C Program ===
-def monitor_network_c(c_program_path: Path):
-    if not c_program_path.exists():
-        print(f"[ERROR] C network monitor not found at {c_program_path}", flush=True)
-        return
-
-    proc = subprocess.Popen(
-        [str(c_program_path)],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        bufsize=1
     )
 
-    for line in proc.stdout:
-        line = line.strip()
-        if not line:
-            continue
+def connection_key(fields: dict) -> tuple:
+    return fields.get("src_ip"), fields.get("src_port"), fields.get("dst_ip"), fields.get("dst_port")
+
+def build_network_event(fields: dict, proc=None) -> Event:
+    """`proc` is the owning process from PROCESS_CACHE, looked up by the caller."""
+    if fields.get("record") == "stats":
+        return build_capture_stats_event(fields)
+    if PROCESS_CACHE:
+        fields["process"] = proc["name"] if proc else "unknown"
+        fields["pid"] = proc["pid"] if proc else None
+    return Event("network", DEVICE_ID, utc_timestamp(), flat=fields)
+
+def network_monitor_args() -> list:
+    args = []
+    if NETWORK_FLOW_MODE:
+        args += [
+            "--flows",
+            "--flow-table-size", str(NETWORK_FLOW_TABLE_SIZE),
+            "--flow-idle-timeout", str(NETWORK_FLOW_IDLE_TIMEOUT),
+            "--flow-active-timeout", str(NETWORK_FLOW_ACTIVE_TIMEOUT),
+        ]
+    if NETWORK_OUTPUT == "binary":
+        args.append("--binary")
+    if NETWORK_PORTS:
+        args += ["--ports", ",".join(str(p) for p in NETWORK_PORTS)]
+    if NETWORK_BPF_FILTER:
+        args += ["--filter", NETWORK_BPF_FILTER]
+    for iface in NETWORK_INTERFACES:
+        args += ["--interface", str(iface)]
+    args += ["--snaplen", str(NETWORK_SNAPLEN), "--stats-interval", str(NETWORK_STATS_INTERVAL)]
+    if NETWORK_BUFFER_SIZE > 0:
+        args += ["--buffer-size", str(NETWORK_BUFFER_SIZE)]
+    if NETWORK_IMMEDIATE:
+        args.append("--immediate")
+    if NETWORK_PROMISC:
+        args.append("--promisc")
+    return args
+
+# === Runtime ===
+class AgentRuntime:
+    """
+    asyncio core of the daemon; every stage below is a task on one loop.
+
+    sources -> raw queue -> normalize -> event queue -> spool -> upload lanes
+
+    Sources are net_mon.bin (read through an asyncio pipe) and the file
+    watcher (whose thread hands events over thread-safely). Noisy paths are
+    filtered at the source, normalize turns raw records into event dicts
+    (coalescing file bursts), spool logs and appends each event to the disk
+    spool of its type, and one upload task per event type sends batches
+    from that spool, one at a time so the hub sees each type in order.
+    Both queues are bounded, so a slow stage makes the sources wait;
+    uploads share a semaphore sized by sender.concurrency and run the
+    blocking HTTP call on a small executor.
+
+    Shutdown stops the sources, pushes everything queued and coalesced into
+    the spool, then gives uploads shutdown_timeout seconds to drain it.
+    Whatever is left stays spooled for the next start.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.raw = asyncio.Queue(RUNTIME_QUEUE_SIZE)
+        self.events = asyncio.Queue(RUNTIME_QUEUE_SIZE)
+        self.upload_slots = asyncio.Semaphore(SENDER_CONCURRENCY)
+        self.stopping = asyncio.Event()
+        self.registered = asyncio.Event()
+        if API_KEY:
+            self.registered.set()
+        self.draining = False  # set once nothing more will be spooled
+        self.lanes = {}       # event_type -> (Spool, asyncio.Event set on append)
+        self.uploaders = []
+        self.stages = []
+        self.file_watcher = None
+        self.watched = set()  # file monitor roots, as configured
+        self.net_proc = None
+        self.net_task = None
+        self.config_stat = None
+        self.coalesced = []
+        # Always present so coalescing can be switched on by a config reload;
+        # bypassed while coalesce_window is 0
+        self.coalescer = Coalescer(self._on_coalesced, FILE_COALESCE_WINDOW, FILE_COALESCE_MAX_WAIT)
+        self.metrics_server = None
+        self.hash_pool = ThreadPoolExecutor(HASH_WORKERS, thread_name_prefix="hash") if FILE_HASHER else None
+        self.hashing = set()  # file events waiting for their digest
+        # One thread: concurrent misses would only queue on the cache lock
+        self.attribution_pool = ThreadPoolExecutor(1, thread_name_prefix="attribution") if PROCESS_CACHE else None
+        METRICS.gauge("agent_hash_pending", "File events waiting for a content hash",
+                      fn=lambda: len(self.hashing))
+        METRICS.gauge("agent_queue_depth", "Items waiting in a runtime queue", ("queue",),
+                      fn=lambda: {("raw",): self.raw.qsize(), ("events",): self.events.qsize()})
+        METRICS.gauge("agent_file_watches", "Directory watches (inotify), mount marks (fanotify) or roots (watchdog)",
+                      fn=lambda: self.file_watcher.watch_count() if self.file_watcher else 0)
+        METRICS.gauge("agent_coalescer_pending", "File paths waiting in the coalescing window",
+                      fn=lambda: len(self.coalescer.pending))
+        METRICS.gauge("agent_spool_pending_bytes", "Spooled bytes not yet acknowledged by the hub", ("event_type",),
+                      fn=lambda: {(t,): spool.pending_bytes() for t, (spool, _) in self.lanes.items()})
+        METRICS.gauge("agent_spool_dropped_segments", "Spool segments discarded to stay under spool.max_bytes", ("event_type",),
+                      fn=lambda: {(t,): spool.dropped_segments for t, (spool, _) in self.lanes.items()})
+
+    # --- sources ---
+    def submit_threadsafe(self, item):
+        """Queue a raw item from a capture thread; blocks that thread while the raw queue is full."""
+        if self.raw.full():
+            asyncio.run_coroutine_threadsafe(self.raw.put(item), self.loop).result()
+        else:
+            self.loop.call_soon_threadsafe(self._put_raw, item)
+
+    def _put_raw(self, item):
         try:
-            event_json = json.loads(line)
-            event_json.update({
-                "id": str(uuid.uuid4()),
-                "device_id": DEVICE_ID,
-                "event_type": "network",
-                "timestamp": utc_timestamp()
-            })
-            save_event_locally(event_json, is_file_event=False)
-        except json.JSONDecodeError:
-            print(f"[WARNING] Could not decode JSON from C monitor: {line}", flush=True)
+            self.raw.put_nowait(item)
+        except asyncio.QueueFull:
+            # Lost the race against another producer; wait like everyone else
+            self.loop.create_task(self.raw.put(item))
 
-# === Main Daemon ===
-def main():
-    print("Daemon started (file + network monitoring).", flush=True)
-    Thread(target=event_sender_worker, daemon=True).start()
+    def on_file_event(self, path, event_type):
+        """Filter a file event on the watcher thread and hand the rest to the runtime."""
+        EVENTS_CAPTURED.inc(source="file")
+        if not PATH_FILTER.match(path):
+            EVENTS_FILTERED.inc(source="file", reason="path_filter")
+            return
+        self.submit_threadsafe(("file", path, event_type, time.time()))
 
-    # File monitoring
-    observers = []
-    if FILE_MONITOR_ENABLED and FILE_PATHS:
+    def start_file_sources(self):
+        roots = [p for p in FILE_PATHS if p.exists()]
+        if FILE_PROCESSES:
+            FILE_PROCESSES.start(roots, loop=self.loop)
+        # One watcher for every root; excluded directories are never watched
+        self.file_watcher = create_watcher(
+            FILE_BACKEND, self.on_file_event, excluded=lambda path: PATH_FILTER.excludes_dir(path)
+        )
+        print(f"[INFO] File watch backend: {self.file_watcher.name}", flush=True)
         for path in FILE_PATHS:
-            if not path.exists():
-                print(f"[WARNING] File path does not exist: {path}", flush=True)
-                continue
-            observer = Observer()
-            observer.schedule(FileEventHandler(), path=str(path), recursive=True)
-            observer.start()
-            observers.append(observer)
-            print(f"[INFO] Started monitoring path: {path}", flush=True)
-
-    # Network monitoring
-    if NETWORK_MONITOR_ENABLED:
-        Thread(target=monitor_network_c, args=(NET_MON,), daemon=True).start()
+            self.watch_path(path)
+        self.file_watcher.start()
+
+    def watch_path(self, path: Path):
+        if str(path) in self.watched:
+            return
+        if not path.exists():
+            print(f"[WARNING] File path does not exist: {path}", flush=True)
+            return
+        if not path.is_dir():
+            # Every backend watches directory trees; watch the parent directory instead
+            print(f"[WARNING] File path is not a directory, not monitoring it: {path}", flush=True)
+            return
+        try:
+            self.file_watcher.add_root(path)
+        except OSError as e:
+            print(f"[WARNING] Cannot monitor {path}: {e}", flush=True)
+            return
+        self.watched.add(str(path))
+        if FILE_PROCESSES:
+            FILE_PROCESSES.add_root(path)
+        print(f"[INFO] Started monitoring path: {path}", flush=True)
+
+    def unwatch_path(self, path: str):
+        if path not in self.watched:
+            return
+        self.watched.discard(path)
+        self.file_watcher.remove_root(path)
+        print(f"[INFO] Stopped monitoring path: {path}", flush=True)
+
+    def start_network(self):
+        self.net_task = asyncio.create_task(self.network_source(), name="network")
+
+    async def stop_network(self):
+        """Stop net_mon.bin and wait until everything it flushed has been queued."""
+        task, proc = self.net_task, self.net_proc
+        self.net_task = None
+        if task is None:
+            return
+        if proc and proc.returncode is None:
+            proc.terminate()  # net_mon.bin flushes its flow table on SIGTERM
+        try:
+            await asyncio.wait_for(task, RUNTIME_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            if proc:
+                proc.kill()
+
+    async def set_capture_filter(self):
+        """Swap ports/bpf_filter on the running capture through net_mon.bin's control channel."""
+        proc = self.net_proc
+        if proc is None or proc.returncode is not None or proc.stdin is None:
+            return False
+        commands = (
+            f"ports {','.join(str(p) for p in NETWORK_PORTS)}\n"
+            f"filter {NETWORK_BPF_FILTER}\n"
+            "apply\n"
+        )
+        try:
+            proc.stdin.write(commands.encode("utf-8"))
+            await proc.stdin.drain()
+        except (ConnectionError, OSError) as e:
+            print(f"[WARNING] Could not update the capture filter: {e}", flush=True)
+            return False
+        return True
+
+    async def network_source(self):
+        if not NET_MON.exists():
+            print(f"[ERROR] C network monitor not found at {NET_MON}", flush=True)
+            return
+        try:
+            proc = self.net_proc = await asyncio.create_subprocess_exec(
+                str(NET_MON), *network_monitor_args(), "--control",
+                stdin=asyncio.subprocess.PIPE,  # filter updates, see set_capture_filter
+                stdout=asyncio.subprocess.PIPE,
+                stderr=None  # diagnostics go straight to the daemon's log
+            )
+        except OSError as e:
+            print(f"[ERROR] Could not start network monitor: {e}", flush=True)
+            return
         print(f"[INFO] Started network monitoring with {NET_MON}", flush=True)
+        stdout = proc.stdout
+        if NETWORK_OUTPUT == "binary":
+            pending = b""
+            while chunk := await stdout.read(64 * 1024):
+                buf = pending + chunk if pending else chunk
+                records, used = decode_netmon_records(buf)
+                pending = buf[used:]
+                EVENTS_CAPTURED.inc(len(records), source="network")
+                for fields in records:
+                    await self.raw.put(("network", fields))
+        else:
+            while line := await stdout.readline():
+                line = line.strip()
+                if not line:
+                    continue
+                EVENTS_CAPTURED.inc(source="network")
+                try:
+                    await self.raw.put(("network", json.loads(line)))
+                except json.JSONDecodeError:
+                    print(f"[WARNING] Could not decode JSON from C monitor: {line!r}", flush=True)
+        code = await proc.wait()
+        if self.net_task is asyncio.current_task():
+            print(f"[WARNING] Network monitor exited with status {code}", flush=True)
 
-    try:
+    # --- normalize ---
+    def _on_coalesced(self, path, actions, action, count, first_seen, last_seen):
+        if count > 1:
+            EVENTS_FILTERED.inc(count - 1, source="file", reason="coalesced")
+        self.coalesced.append(build_file_event(path, actions, action, count, first_seen, last_seen))
+
+    async def _forward_coalesced(self):
+        while self.coalesced:
+            await self.put_file_event(self.coalesced.pop(0))
+
+    async def put_file_event(self, event: Event):
+        """Queue a file event, first handing it to the hash pool when it changed content."""
+        details = event.details
+        if details["process"] is None:
+            # Writer pid not cached yet; /proc/<pid>/comm is read off the loop
+            proc = await self.loop.run_in_executor(
+                self.attribution_pool, PROCESS_CACHE.process_for_pid, details["pid"])
+            details["process"] = proc["name"] if proc else "unknown"
+        if FILE_HASHER and details["action"] in HASH_ACTIONS:
+            if len(self.hashing) < HASH_MAX_PENDING:
+                task = self.loop.create_task(self._hash_file_event(event))
+                self.hashing.add(task)
+                task.add_done_callback(self.hashing.discard)
+                return
+            FILE_HASHES.inc(result="busy")
+            details["hash_skipped"] = "busy"
+        await self.events.put(event)
+
+    async def _hash_file_event(self, event: Event):
+        try:
+            result, fields = await self.loop.run_in_executor(self.hash_pool, FILE_HASHER.hash, event.details["path"])
+        except Exception as e:
+            result, fields = "error", {}
+            print(f"[WARNING] Hashing {event.details['path']} failed: {e}", flush=True)
+        FILE_HASHES.inc(result=result)
+        event.details.update(fields)
+        await self.events.put(event)
+
+    async def normalize_stage(self):
+        while True:
+            item = await self.raw.get()
+            try:
+                if item[0] == "file":
+                    _, path, action, ts = item
+                    if FILE_COALESCE_WINDOW > 0:
+                        self.coalescer.add(path, action, ts)
+                        await self._forward_coalesced()
+                    else:
+                        await self.put_file_event(build_file_event(path, [action], action, 1, ts, ts))
+                else:
+                    fields, proc = item[1], None
+                    if PROCESS_CACHE and fields.get("record") != "stats":
+                        key = connection_key(fields)
+                        hit, proc = PROCESS_CACHE.peek_connection(*key)
+                        if not hit:
+                            # A miss reads /proc; keep it off the loop
+                            proc = await self.loop.run_in_executor(
+                                self.attribution_pool, PROCESS_CACHE.lookup_connection, *key)
+                    await self.events.put(build_network_event(fields, proc))
+            finally:
+                self.raw.task_done()
+
+    async def coalesce_stage(self):
+        while True:
+            await asyncio.sleep(max(FILE_COALESCE_WINDOW / 2, 0.05) if FILE_COALESCE_WINDOW > 0 else 1.0)
+            self.coalescer.flush()
+            await self._forward_coalesced()
+
+    # --- config reload ---
+    def _config_signature(self):
+        try:
+            st = CONFIG_FILE.stat()
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    async def config_stage(self):
+        """Poll agent.yaml and apply changes without restarting capture."""
+        self.config_stat = self._config_signature()
+        while True:
+            await asyncio.sleep(RUNTIME_CONFIG_POLL)
+            signature = self._config_signature()
+            if signature is None or signature == self.config_stat:
+                continue
+            self.config_stat = signature
+            try:
+                with open(CONFIG_FILE) as f:
+                    new_config = yaml.safe_load(f)
+            except (OSError, yaml.YAMLError) as e:
+                print(f"[WARNING] Ignoring unreadable agent.yaml: {e}", flush=True)
+                continue
+            if not isinstance(new_config, dict) or not new_config:
+                # Empty or truncated, e.g. caught mid-write by an editor; never means "disable everything"
+                print("[WARNING] Ignoring agent.yaml without settings, keeping the previous ones", flush=True)
+                continue
+            try:
+                await self.apply_config(new_config)
+            except Exception as e:
+                print(f"[ERROR] Applying agent.yaml failed: {e!r}", flush=True)
+
+    async def apply_config(self, new_config: dict):
+        """
+        Apply the parts of a changed agent.yaml that can change live:
+        watched paths and filters, coalescing, capture ports/bpf_filter,
+        the API key. Other network_monitor settings restart net_mon.bin;
+        everything else only takes effect on the next daemon start.
+        """
+        global config, API_KEY
+        old_fm = config.get("file_monitor", {}) or {}
+        new_fm = new_config.get("file_monitor", {}) or {}
+        old_nm = config.get("network_monitor", {}) or {}
+        new_nm = new_config.get("network_monitor", {}) or {}
+        # Check everything first, so a bad value leaves all settings as they were
+        try:
+            if not isinstance(new_fm, dict) or not isinstance(new_nm, dict):
+                raise ValueError("file_monitor and network_monitor must be mappings")
+            if not isinstance(new_config.get("api_key") or "", str):
+                raise ValueError("api_key must be a string")
+            file_settings = file_monitor_settings(new_fm)
+            network_settings = network_monitor_settings(new_nm)
+        except (TypeError, ValueError) as e:
+            print(f"[WARNING] Ignoring agent.yaml with an invalid setting ({e}), keeping the previous ones", flush=True)
+            return
+        old_config, config = config, new_config
+
+        if new_fm != old_fm:
+            configure_file_monitor(file_settings)
+            self.coalescer.window = FILE_COALESCE_WINDOW
+            self.coalescer.max_wait = max(FILE_COALESCE_MAX_WAIT, FILE_COALESCE_WINDOW)
+            if FILE_COALESCE_WINDOW <= 0:
+                self.coalescer.flush(force=True)
+                await self._forward_coalesced()
+            wanted = {str(p) for p in FILE_PATHS} if FILE_MONITOR_ENABLED else set()
+            if old_fm.get("exclude") != new_fm.get("exclude"):
+                # Watches were pruned by the old exclude rules; register the roots again
+                for path in sorted(self.watched):
+                    self.unwatch_path(path)
+            for path in sorted(self.watched - wanted):
+                self.unwatch_path(path)
+            if wanted and self.file_watcher is None:
+                self.start_file_sources()
+            for path in FILE_PATHS if FILE_MONITOR_ENABLED else []:
+                self.watch_path(path)
+            if old_fm.get("backend", "auto") != FILE_BACKEND:
+                print("[INFO] file_monitor.backend takes effect after a restart", flush=True)
+            print(f"[INFO] Reloaded file_monitor settings, watching {len(self.watched)} paths", flush=True)
+
+        if new_nm != old_nm:
+            configure_network_monitor(network_settings)
+            live = {"ports", "bpf_filter"}
+            needs_restart = {k for k in set(old_nm) | set(new_nm) if old_nm.get(k) != new_nm.get(k)} - live
+            if not NETWORK_MONITOR_ENABLED:
+                await self.stop_network()
+            elif self.net_task is None or needs_restart:
+                if self.net_task is not None:
+                    print(f"[INFO] Restarting network monitor for changed {', '.join(sorted(needs_restart))}", flush=True)
+                await self.stop_network()
+                self.start_network()
+            elif await self.set_capture_filter():
+                print("[INFO] Updated capture filter on the running network monitor", flush=True)
+
+        new_key = new_config.get("api_key", "")
+        if new_key and new_key != API_KEY:
+            API_KEY = new_key
+            self.registered.set()
+
+        live_sections = {"file_monitor", "network_monitor", "api_key"}
+        stale = sorted(k for k in set(old_config) | set(new_config)
+                       if k not in live_sections and old_config.get(k) != new_config.get(k))
+        if stale:
+            print(f"[INFO] agent.yaml changes to {', '.join(stale)} take effect after a restart", flush=True)
+
+    # --- spool ---
+    def lane(self, event_type: str):
+        """Return (spool, ready) for an event type, starting its upload task on first use."""
+        lane = self.lanes.get(event_type)
+        if lane is None:
+            spool = Spool(
+                SPOOL_DIR / event_type,
+                segment_bytes=SPOOL_SEGMENT_BYTES,
+                max_bytes=SPOOL_MAX_BYTES,
+                fsync=SPOOL_FSYNC
+            )
+            ready = asyncio.Event()
+            ready.set()  # there may be a backlog from the last run
+            lane = self.lanes[event_type] = (spool, ready)
+            self.uploaders.append(asyncio.create_task(self.upload_lane(event_type, spool, ready), name=f"upload-{event_type}"))
+        return lane
+
+    async def spool_stage(self):
         while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
+            event = await self.events.get()
+            try:
+                # Numbered here, the one place every event passes, so each
+                # sequence number is spooled exactly once
+                data = event.encode(*EVENT_IDS.next())
+                if RUNTIME_LOG_EVENTS:
+                    sys.stdout.buffer.write(b"[%s EVENT] %s\n" % (event.event_type.upper().encode(), data))
+                    sys.stdout.buffer.flush()
+                spool, ready = self.lane(event.event_type)
+                spool.append(data)
+                ready.set()
+                EVENTS_SPOOLED.inc(event_type=event.event_type)
+            finally:
+                self.events.task_done()
+
+    # --- upload ---
+    async def next_batch(self, spool: Spool, ready: asyncio.Event):
+        """
+        Wait for spooled records, then give the batch up to batch_max_delay
+        to fill. Returns ([], None) once draining and the spool is empty.
+        """
+        records, position, size, deadline = [], None, 0, None
+        while len(records) < BATCH_MAX_EVENTS and size < BATCH_MAX_BYTES:
+            ready.clear()
+            got, pos = spool.read_batch(BATCH_MAX_EVENTS - len(records), BATCH_MAX_BYTES - size, 0, timeout=0)
+            if got:
+                records += got
+                size += sum(len(r) for r in got)
+                position = pos
+                if deadline is None:
+                    deadline = self.loop.time() + BATCH_MAX_DELAY
+                continue
+            if self.draining:
+                break
+            if not records:
+                await ready.wait()
+                continue
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return records, position
+
+    async def deliver_batch(self, batch, event_type):
+        """
+        Send a batch of encoded events until each is accepted or rejected by the hub.
+        The batch stays in hand between attempts, so its events keep their
+        place in the spool and their attempt count. A batch refused as a
+        whole is split on 413 and dead-lettered after max_rejected_attempts,
+        so the lane moves on.
+        """
+        attempt = rejected = 0
+        while batch:
+            while (wait := BREAKER.try_acquire()) > 0:
+                await asyncio.sleep(wait)
+            try:
+                async with self.upload_slots:
+                    started = time.monotonic()
+                    try:
+                        resp = await self.loop.run_in_executor(None, send_batch, BULK_URL, DEVICE_ID, API_KEY, batch)
+                    except Exception:
+                        SEND_LATENCY.observe(time.monotonic() - started, outcome="error")
+                        raise
+                    SEND_LATENCY.observe(time.monotonic() - started, outcome="ok")
+            except Exception as e:
+                kind, retry_after = classify(e)
+                if kind == REJECTED:
+                    BREAKER.record_success()  # hub is up, it just refused us
+                    status = getattr(getattr(e, "response", None), "status_code", None)
+                    if status == 413 and len(batch) > 1:
+                        half = len(batch) // 2
+                        print(f"[HUB] Batch of {len(batch)} events too large, splitting it", flush=True)
+                        await self.deliver_batch(batch[:half], event_type)
+                        await self.deliver_batch(batch[half:], event_type)
+                        return
+                    rejected += 1
+                    if status == 413 or rejected >= SENDER_MAX_REJECTED:
+                        dead_letter(batch, event_type, f"HTTP {status}" if status else e)
+                        return
+                else:
+                    BREAKER.record_failure()
+                SEND_RETRIES.inc(kind=kind)
+                delay = RETRY_POLICY.delay(kind, attempt, retry_after)
+                attempt += 1
+                print(f"[HUB] Send failed ({kind}: {e}), attempt {attempt}, "
+                      f"retrying {len(batch)} events in {delay:.1f}s", flush=True)
+                await asyncio.sleep(delay)
+                continue
+
+            BREAKER.record_success()
+            batch = report_batch_results(resp, batch, event_type)
+            if batch:
+                SEND_RETRIES.inc(kind="partial")
+                delay = RETRY_POLICY.delay(TRANSIENT, attempt)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def upload_lane(self, event_type: str, spool: Spool, ready: asyncio.Event):
+        # One batch at a time, so the hub gets each event type in spool order
+        await self.registered.wait()
+        while True:
+            records, position = await self.next_batch(spool, ready)
+            if not records:
+                return
+            batch = check_records(records)
+            BATCH_SIZE.observe(len(batch))
+            await self.deliver_batch(batch, event_type)
+            spool.ack(position)
+
+    # --- registration ---
+    async def register_stage(self):
+        """Fetch an API key from the hub, retrying with backoff until it works."""
+        global API_KEY
+        attempt = 0
+        while True:
+            try:
+                API_KEY = await self.loop.run_in_executor(None, lambda: fetch_api_key(
+                    DEVICE_ID, DEVICE_NAME, HUB_BASE_URL, REGISTRATION_SECRET, REGISTRATION_TIMEOUT,
+                    token=registration_token(EVENT_DIR / "registration.token")
+                ))
+            except Exception as e:
+                kind, retry_after = classify(e)
+                delay = RETRY_POLICY.delay(kind, attempt, retry_after)
+                attempt += 1
+                print(f"[HUB] Registration failed ({kind}: {e}), attempt {attempt}, "
+                      f"retrying in {delay:.1f}s; events are spooled meanwhile", flush=True)
+                await asyncio.sleep(delay)
+                continue
+            if API_KEY:
+                print(f"[HUB] Registered as {DEVICE_ID}, starting uploads", flush=True)
+                self.registered.set()
+                return
+            attempt += 1
+            await asyncio.sleep(RETRY_POLICY.delay(REJECTED, attempt))
+
+    # --- metrics ---
+    async def start_metrics_server(self):
+        handler = lambda reader, writer: serve_http(METRICS, reader, writer)
+        try:
+            if METRICS_LISTEN.startswith("unix:"):
+                path = METRICS_LISTEN[len("unix:"):]
+                if os.path.exists(path):
+                    os.unlink(path)  # stale socket from an unclean exit
+                self.metrics_server = await asyncio.start_unix_server(handler, path=path)
+                os.chmod(path, 0o660)
+            else:
+                host, _, port = METRICS_LISTEN.rpartition(":")
+                self.metrics_server = await asyncio.start_server(handler, host or "127.0.0.1", int(port))
+        except (OSError, ValueError) as e:
+            print(f"[WARNING] Metrics endpoint {METRICS_LISTEN} unavailable: {e}", flush=True)
+            return
+        print(f"[INFO] Serving metrics on {METRICS_LISTEN}", flush=True)
+
+    async def health_stage(self):
+        """Send the metrics snapshot to the hub as a periodic agent health event."""
+        while True:
+            await asyncio.sleep(METRICS_HEALTH_INTERVAL)
+            await self.events.put(Event("health", DEVICE_ID, utc_timestamp(),
+                                        details={"source": "agent", **METRICS.snapshot()}))
+
+    # --- lifecycle ---
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        # Only blocking hub calls use the executor: the upload slots plus registration
+        self.loop.set_default_executor(ThreadPoolExecutor(SENDER_CONCURRENCY + 1, thread_name_prefix="hub"))
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.stopping.set)
+
+        print("Daemon started (file + network monitoring).", flush=True)
+
+        # Resume delivery of anything spooled before the last shutdown
+        for lane_dir in sorted(SPOOL_DIR.iterdir()):
+            if lane_dir.is_dir():
+                self.lane(lane_dir.name)
+
+        self.stages = [
+            asyncio.create_task(self.normalize_stage(), name="normalize"),
+            asyncio.create_task(self.spool_stage(), name="spool"),
+        ]
+        if METRICS_LISTEN:
+            await self.start_metrics_server()
+        if METRICS_HEALTH_INTERVAL > 0:
+            self.stages.append(asyncio.create_task(self.health_stage(), name="health"))
+        if not self.registered.is_set():
+            self.stages.append(asyncio.create_task(self.register_stage(), name="register"))
+        self.stages.append(asyncio.create_task(self.coalesce_stage(), name="coalesce"))
+        if RUNTIME_CONFIG_POLL > 0:
+            self.stages.append(asyncio.create_task(self.config_stage(), name="config"))
+        if FILE_MONITOR_ENABLED and FILE_PATHS:
+            self.start_file_sources()
+        if NETWORK_MONITOR_ENABLED:
+            self.start_network()
+
+        await self.stopping.wait()
+        await self.shutdown()
+
+    async def shutdown(self):
+        print("Daemon stopping, flushing pending events...", flush=True)
+        if self.metrics_server:
+            self.metrics_server.close()
+        for stage in self.stages:
+            if stage.get_name() == "config":
+                stage.cancel()
+        if self.file_watcher:
+            await self.loop.run_in_executor(None, self.file_watcher.stop)
+        if FILE_PROCESSES:
+            FILE_PROCESSES.stop()
+        await self.stop_network()
+
+        await self.raw.join()
+        self.coalescer.flush(force=True)
+        await self._forward_coalesced()
+        if self.hashing:
+            await asyncio.wait(list(self.hashing))
+        await self.events.join()
+        for stage in self.stages:
+            stage.cancel()
+
+        self.draining = True
+        for _, ready in self.lanes.values():
+            ready.set()
+        if self.uploaders:
+            _, pending = await asyncio.wait(
+                self.uploaders, timeout=RUNTIME_SHUTDOWN_TIMEOUT if self.registered.is_set() else 0
+            )
+            for task in pending:
+                task.cancel()
+            if pending and not self.registered.is_set():
+                print("[WARNING] Not registered with the hub yet, events stay spooled until next start", flush=True)
+            elif pending:
+                print(f"[WARNING] {len(pending)} upload lanes still busy, events stay spooled until next start", flush=True)
+                await asyncio.wait(pending)
+        for spool, _ in self.lanes.values():
+            spool.close()
+        if self.hash_pool:
+            self.hash_pool.shutdown(wait=False)
+        if self.attribution_pool:
+            self.attribution_pool.shutdown(wait=False)
+        EVENT_IDS.close()
         print("Daemon stopped.", flush=True)
-        for obs in observers:
-            obs.stop()
-            obs.join()
+
+# === Main Daemon ===
+def main():
+    asyncio.run(AgentRuntime().run())
 
 if __name__ == "__main__":
     main()
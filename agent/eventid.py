@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import json
+import os
+import threading
+import time
+
+
+class EventIds:
+    """
+    Device-scoped, time-sortable event ids of the form
+    "<device_id>-<stream>-<seq>".
+
+    `stream` is the creation time (ms) of the sequence state, so a device
+    that loses its state (reinstall, wiped disk) starts a new, later stream
+    instead of reusing ids. `seq` counts up from 0 within a stream; both are
+    zero-padded so ids sort lexically in creation order.
+
+    The next sequence number is leased to disk `block` numbers ahead, so
+    ids survive restarts without a write per event. A crash skips the rest
+    of the lease, which the collector then reports as a gap, along with
+    whatever was lost in memory at the time.
+    """
+
+    def __init__(self, device_id, state_path, block=1000, fsync=True):
+        self.device_id = device_id
+        self.state_path = state_path
+        self.block = block
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            self.stream, self.seq = int(state["stream"]), int(state["next"])
+        except (OSError, ValueError, KeyError, TypeError):
+            self.stream, self.seq = time.time_ns() // 1_000_000, 0
+        self.leased = self.seq + block
+        self._save(self.leased)
+
+    def _save(self, next_seq):
+        tmp = f"{self.state_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"device_id": self.device_id, "stream": self.stream, "next": next_seq}, f)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, self.state_path)
+
+    def next(self):
+        """Return (id, stream, seq) for the next event."""
+        with self.lock:
+            seq = self.seq
+            self.seq += 1
+            if self.seq > self.leased:
+                self.leased = seq + self.block
+                self._save(self.leased)
+        return f"{self.device_id}-{self.stream:013d}-{seq:012d}", self.stream, seq
+
+    def close(self):
+        """Record the exact next sequence number, so a clean restart leaves no gap."""
+        with self.lock:
+            self._save(self.seq)
+            self.leased = self.seq
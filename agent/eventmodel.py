@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import json
+
+try:
+    import orjson
+except ImportError:  # optional, only makes encoding faster
+    orjson = None
+
+JSON_BACKEND = "orjson" if orjson else "json"
+
+
+def set_json_backend(name="auto"):
+    """Pick "json", "orjson" or "auto" (orjson when installed); returns the backend in use."""
+    global JSON_BACKEND
+    if name == "orjson" and orjson is None:
+        print("[WARNING] json_backend orjson requested but not installed, using json", flush=True)
+    JSON_BACKEND = "orjson" if orjson and name in ("auto", "orjson") else "json"
+    return JSON_BACKEND
+
+
+def dumps(obj) -> bytes:
+    if JSON_BACKEND == "orjson":
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass  # e.g. a path that is not valid UTF-8; json escapes it
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def join_records(records) -> bytes:
+    """Encoded events -> the encoded JSON list the hub bulk endpoint expects, without re-parsing."""
+    return b"[" + b",".join(records) + b"]"
+
+
+class Event:
+    """
+    One agent event, encoded to JSON exactly once.
+
+    File and health events keep their fields under "details"; network
+    events are flat (the fields sit next to device_id/event_type), as
+    net_mon.bin has always reported them. encode() stamps the id and
+    returns the bytes that the spool, the log line and the upload all
+    reuse; nothing downstream parses or serializes the event again.
+    """
+    __slots__ = ("event_type", "device_id", "timestamp", "details", "flat", "id", "stream", "seq", "encoded")
+
+    def __init__(self, event_type, device_id, timestamp, details=None, flat=None):
+        self.event_type = event_type
+        self.device_id = device_id
+        self.timestamp = timestamp
+        self.details = details
+        self.flat = flat
+        self.id = None
+        self.stream = None
+        self.seq = None
+        self.encoded = None
+
+    def encode(self, event_id=None, stream=None, seq=None) -> bytes:
+        if self.encoded is None:
+            self.id, self.stream, self.seq = event_id, stream, seq
+            doc = self.flat if self.flat is not None else {}
+            doc["device_id"] = self.device_id
+            doc["event_type"] = self.event_type
+            if self.details is not None:
+                doc["details"] = self.details
+            doc["timestamp"] = self.timestamp
+            if event_id is not None:
+                doc["id"], doc["stream"], doc["seq"] = event_id, stream, seq
+            self.encoded = dumps(doc)
+        return self.encoded
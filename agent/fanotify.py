@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import ctypes
+import os
+import select
+import struct
+import threading
+
+# === fanotify(7) constants ===
+FAN_ACCESS = 0x01
+FAN_MODIFY = 0x02
+FAN_CLOSE_WRITE = 0x08
+FAN_CLOSE_NOWRITE = 0x10
+FAN_OPEN = 0x20
+FAN_Q_OVERFLOW = 0x4000
+
+FAN_CLOEXEC = 0x01
+FAN_CLASS_NOTIF = 0x00
+FAN_MARK_ADD = 0x01
+FAN_MARK_REMOVE = 0x02
+FAN_MARK_MOUNT = 0x10
+FAN_NOFD = -1
+AT_FDCWD = -100
+O_LARGEFILE = 0o100000
+
+# struct fanotify_event_metadata
+EVENT_METADATA = struct.Struct("=IBBHQii")
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.fanotify_init.argtypes = [ctypes.c_uint, ctypes.c_uint]
+        libc.fanotify_init.restype = ctypes.c_int
+        libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+        libc.fanotify_mark.restype = ctypes.c_int
+        _libc = libc
+    return _libc
+
+
+class FanotifyWatcher:
+    """
+    Mount-level fanotify listener (Linux, needs CAP_SYS_ADMIN).
+
+    Every event on a marked mount is passed to callback(path, pid, mask),
+    either from an asyncio loop reader or a background thread; events
+    caused by this process are skipped.
+    Raises OSError from the constructor when fanotify is unavailable, so
+    callers can fall back to doing without it.
+    """
+
+    def __init__(self, callback, mask=FAN_MODIFY | FAN_CLOSE_WRITE):
+        self.callback = callback
+        self.mask = mask
+        self.libc = _load_libc()
+        self.fd = self.libc.fanotify_init(FAN_CLASS_NOTIF | FAN_CLOEXEC, os.O_RDONLY | O_LARGEFILE)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"fanotify_init: {os.strerror(err)}")
+        self.own_pid = os.getpid()
+        self.marked = set()
+        self._thread = None
+        self._loop = None
+        self._stop = threading.Event()
+
+    def _mark(self, flags, path):
+        if self.libc.fanotify_mark(self.fd, flags, self.mask, AT_FDCWD, os.fsencode(str(path))) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"fanotify_mark {path}: {os.strerror(err)}")
+
+    def add_mount(self, path):
+        """Watch the whole mount that `path` lives on."""
+        self._mark(FAN_MARK_ADD | FAN_MARK_MOUNT, path)
+        self.marked.add(str(path))
+
+    def remove_mount(self, path):
+        self._mark(FAN_MARK_REMOVE | FAN_MARK_MOUNT, path)
+        self.marked.discard(str(path))
+
+    def fileno(self):
+        return self.fd
+
+    def drain(self):
+        """Read one buffer of pending events and dispatch them; False once the fd is unusable."""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            print(f"[WARNING] fanotify read failed: {e}", flush=True)
+            return False
+        offset = 0
+        while offset + EVENT_METADATA.size <= len(data):
+            event_len, _vers, _res, _meta_len, mask, fd, pid = EVENT_METADATA.unpack_from(data, offset)
+            if event_len < EVENT_METADATA.size:
+                break
+            offset += event_len
+            if fd == FAN_NOFD:
+                if mask & FAN_Q_OVERFLOW:
+                    print("[WARNING] fanotify queue overflow, some file events lost", flush=True)
+                continue
+            try:
+                path = os.readlink(f"/proc/self/fd/{fd}")
+            except OSError:
+                path = None
+            finally:
+                os.close(fd)
+            if path and pid != self.own_pid:
+                self.callback(path, pid, mask)
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            if select.select([self.fd], [], [], 0.5)[0] and not self.drain():
+                break
+
+    def start(self, loop=None):
+        """Dispatch events from `loop` (asyncio add_reader) if given, else from a thread."""
+        if loop is not None:
+            self._loop = loop
+            loop.add_reader(self.fd, self.drain)
+            return
+        self._thread = threading.Thread(target=self._run, name="fanotify", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop dispatching and close the fanotify fd (call from the loop thread when started on a loop)."""
+        self._stop.set()
+        if self._loop is not None:
+            self._loop.remove_reader(self.fd)
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self.fd)
+        self.fd = -1
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+import ctypes
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+from fanotify import FanotifyWatcher, FAN_MODIFY, FAN_CLOSE_WRITE
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # only needed for the watchdog backend
+    Observer = None
+    FileSystemEventHandler = object
+
+# === inotify(7) constants ===
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+# struct inotify_event, followed by `len` bytes of NUL-padded name
+INOTIFY_EVENT = struct.Struct("iIII")
+# Kernel memory per inotify watch on 64-bit (struct inotify_inode_mark plus
+# the pinned inode), as used for sizing fs.inotify.max_user_watches
+KERNEL_BYTES_PER_WATCH = 1080
+CRAWL_CHUNK = 1000  # directories registered per pass before pending events are read
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_init1.restype = ctypes.c_int
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_add_watch.restype = ctypes.c_int
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        libc.inotify_rm_watch.restype = ctypes.c_int
+        _libc = libc
+    return _libc
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _under(path, root):
+    return path == root or path.startswith(root.rstrip("/") + "/")
+
+
+class InotifyTree:
+    """
+    Recursive directory watching on one inotify instance for all roots.
+
+    Directories for which `excluded(path)` is true are never watched, so
+    excluded subtrees cost no watches and no crawl. The initial crawl
+    runs on the watcher thread in chunks of CRAWL_CHUNK directories,
+    reading pending events in between, so the first directories report
+    events while large trees are still being registered. Directories
+    created or moved in later are registered (and scanned for files
+    created before their watch existed) as their events arrive.
+
+    callback(path, event_type) runs on the watcher thread with
+    watchdog's event type names (created, modified, closed, deleted, moved).
+    Raises OSError from the constructor when inotify is unavailable.
+    """
+
+    name = "inotify"
+
+    def __init__(self, callback, excluded=None):
+        self.callback = callback
+        self.excluded = excluded or (lambda path: False)
+        self.libc = _load_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+        self.wake_r, self.wake_w = os.pipe()
+        self.dirs = {}       # wd -> directory path
+        self.wds = {}        # directory path -> wd
+        self.roots = set()
+        self.commands = deque()
+        self.crawl = deque()  # (directory, report new files) still to be registered
+        self.pruned = 0
+        self.overflows = 0
+        self.limit_hit = False
+        self.stopping = threading.Event()
+        self.thread = None
+        self.crawl_started = None
+        self.rss_before = 0
+
+    def watch_count(self):
+        return len(self.dirs)
+
+    # --- called from any thread ---
+    def add_root(self, path):
+        self._command(("add", str(path)))
+
+    def remove_root(self, path):
+        self._command(("remove", str(path)))
+
+    def _command(self, command):
+        self.commands.append(command)
+        os.write(self.wake_w, b"x")
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="inotify", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        os.write(self.wake_w, b"x")
+        if self.thread is not None:
+            self.thread.join()
+        for fd in (self.fd, self.wake_r, self.wake_w):
+            os.close(fd)
+
+    # --- watcher thread ---
+    def _run(self):
+        while not self.stopping.is_set():
+            while self.commands:
+                self._handle_command(self.commands.popleft())
+            if self.crawl:
+                self._crawl_some()
+                timeout = 0
+            else:
+                timeout = None
+            ready = select.select([self.fd, self.wake_r], [], [], timeout)[0]
+            if self.wake_r in ready:
+                os.read(self.wake_r, 4096)
+            if self.fd in ready:
+                self._read_events()
+
+    def _handle_command(self, command):
+        action, path = command
+        if action == "add":
+            if path in self.roots:
+                return
+            self.roots.add(path)
+            if self.crawl_started is None:
+                self.crawl_started, self.rss_before = time.monotonic(), _rss_bytes()
+            self.crawl.append((path, False))
+        else:
+            self.roots.discard(path)
+            self.crawl = deque(item for item in self.crawl if not _under(item[0], path))
+            for directory in [d for d in self.wds if _under(d, path)]:
+                if not any(_under(directory, root) for root in self.roots):
+                    self._unwatch(directory)
+
+    def _crawl_some(self):
+        for _ in range(CRAWL_CHUNK):
+            if not self.crawl:
+                break
+            directory, report = self.crawl.popleft()
+            self._register(directory, report)
+        if not self.crawl and self.crawl_started is not None:
+            self._report_crawl()
+
+    def _register(self, directory, report):
+        if directory in self.wds or self.limit_hit:
+            return
+        if self.excluded(directory):
+            self.pruned += 1
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == 28:  # ENOSPC
+                self.limit_hit = True
+                print(f"[WARNING] inotify watch limit reached at {len(self.dirs)} directories; "
+                      f"raise fs.inotify.max_user_watches or exclude more paths", flush=True)
+            elif err not in (2, 20) or directory in self.roots:
+                # ENOENT/ENOTDIR below a root: gone or replaced meanwhile
+                print(f"[WARNING] Cannot watch {directory}: {os.strerror(err)}", flush=True)
+            return
+        self.dirs[wd] = directory
+        self.wds[directory] = wd
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if is_dir:
+                        self.crawl.append((entry.path, report))
+                    elif report:
+                        # Created before the watch on its directory existed
+                        self.callback(entry.path, "created")
+        except OSError:
+            pass
+
+    def _unwatch(self, directory):
+        wd = self.wds.pop(directory, None)
+        if wd is not None:
+            self.dirs.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def _report_crawl(self):
+        elapsed = time.monotonic() - self.crawl_started
+        rss = max(_rss_bytes() - self.rss_before, 0)
+        print(f"[INFO] inotify: {len(self.dirs)} directory watches on {len(self.roots)} roots "
+              f"({self.pruned} excluded subtrees skipped) in {elapsed:.1f}s, "
+              f"~{len(self.dirs) * KERNEL_BYTES_PER_WATCH / 2**20:.1f} MB kernel memory, "
+              f"+{rss / 2**20:.1f} MB agent RSS", flush=True)
+        self.crawl_started = None
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflows += 1
+                print("[WARNING] inotify queue overflow, some file events lost", flush=True)
+                continue
+            if mask & IN_IGNORED:
+                directory = self.dirs.pop(wd, None)
+                if directory is not None and self.wds.get(directory) == wd:
+                    del self.wds[directory]
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._register(path, True)
+                elif mask & IN_MOVED_FROM:
+                    for moved in [d for d in self.wds if _under(d, path)]:
+                        self._unwatch(moved)
+                continue
+            if mask & IN_CREATE or mask & IN_MOVED_TO:
+                self.callback(path, "created")
+            elif mask & IN_MODIFY:
+                self.callback(path, "modified")
+            elif mask & IN_CLOSE_WRITE:
+                self.callback(path, "closed")
+            elif mask & IN_DELETE:
+                self.callback(path, "deleted")
+            elif mask & IN_MOVED_FROM:
+                self.callback(path, "moved")
+
+
+class FanotifyTree:
+    """
+    Mount-level fanotify marks instead of per-directory watches: one mark
+    per mount holding a root, whatever the size of the tree (Linux, needs
+    CAP_SYS_ADMIN). Mount marks only see content changes, so this backend
+    reports modified and closed events but no creates, deletes or moves.
+    Events outside the roots and in excluded directories are dropped here.
+    """
+
+    name = "fanotify"
+
+    def __init__(self, callback, excluded=None):
+        self.callback = callback
+        self.excluded = excluded or (lambda path: False)
+        self.watcher = FanotifyWatcher(self._on_event, mask=FAN_MODIFY | FAN_CLOSE_WRITE)
+        self.roots = {}   # root realpath -> st_dev
+        self.lock = threading.Lock()
+
+    def watch_count(self):
+        return len(set(self.roots.values()))
+
+    def add_root(self, path):
+        real = os.path.realpath(path)
+        dev = os.stat(real).st_dev
+        with self.lock:
+            if dev not in self.roots.values():
+                self.watcher.add_mount(real)
+            self.roots[real] = dev
+        print(f"[INFO] fanotify: {self.watch_count()} mount marks for {len(self.roots)} roots", flush=True)
+
+    def remove_root(self, path):
+        real = os.path.realpath(path)
+        with self.lock:
+            dev = self.roots.pop(real, None)
+            if dev is not None and dev not in self.roots.values():
+                try:
+                    self.watcher.remove_mount(real)
+                except OSError:
+                    pass  # mount gone
+
+    def _on_event(self, path, pid, mask):
+        with self.lock:
+            roots = list(self.roots)
+        if not any(_under(path, root) for root in roots) or self.excluded(os.path.dirname(path)):
+            return
+        self.callback(path, "closed" if mask & FAN_CLOSE_WRITE else "modified")
+
+    def start(self):
+        self.watcher.start()
+
+    def stop(self):
+        self.watcher.stop()
+
+
+class _WatchdogHandler(FileSystemEventHandler):
+    def __init__(self, callback):
+        self.callback = callback
+
+    def on_any_event(self, event):
+        if not event.is_directory:
+            self.callback(str(event.src_path), event.event_type)
+
+
+class WatchdogTree:
+    """
+    Portable fallback: every root scheduled on one shared watchdog
+    Observer. watchdog watches whole trees, so exclude rules only filter
+    events here, they do not save watches.
+    """
+
+    name = "watchdog"
+
+    def __init__(self, callback, excluded=None):
+        if Observer is None:
+            raise OSError("watchdog is not installed")
+        self.handler = _WatchdogHandler(callback)
+        self.observer = Observer()
+        self.watches = {}   # root -> ObservedWatch
+
+    def watch_count(self):
+        return len(self.watches)
+
+    def add_root(self, path):
+        if str(path) not in self.watches:
+            self.watches[str(path)] = self.observer.schedule(self.handler, path=str(path), recursive=True)
+
+    def remove_root(self, path):
+        watch = self.watches.pop(str(path), None)
+        if watch is not None:
+            self.observer.unschedule(watch)
+
+    def start(self):
+        self.observer.start()
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+BACKENDS = {"inotify": InotifyTree, "fanotify": FanotifyTree, "watchdog": WatchdogTree}
+
+
+def create_watcher(backend, callback, excluded=None):
+    """
+    Build the file watcher for `backend` ("auto", "inotify", "fanotify" or
+    "watchdog"). "auto" is inotify on Linux and watchdog elsewhere; a
+    backend that cannot start falls back to the next one with a warning.
+    """
+    if backend == "auto":
+        order = ["inotify", "watchdog"] if sys.platform.startswith("linux") else ["watchdog"]
+    else:
+        order = [backend] + [b for b in ("inotify", "watchdog") if b != backend]
+    for name in order:
+        try:
+            return BACKENDS[name](callback, excluded)
+        except (OSError, AttributeError, KeyError) as e:
+            print(f"[WARNING] File watch backend {name} unavailable: {e}", flush=True)
+    raise RuntimeError("no file watch backend available")
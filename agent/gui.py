@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
+import os
 import sys
+import codecs
 import yaml
 from pathlib import Path
 from PyQt6.QtWidgets import (
-    QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QTextEdit,
+    QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QPlainTextEdit,
     QLabel, QLineEdit, QFormLayout, QMessageBox, QListWidget, QCheckBox,
-    QFileDialog, QTabWidget, QInputDialog
+    QFileDialog, QTabWidget, QInputDialog, QGroupBox
 )
-from PyQt6.QtCore import QProcess
+from PyQt6.QtCore import QProcess, QTimer, QUrl
+from PyQt6.QtNetwork import QNetworkAccessManager, QNetworkReply, QNetworkRequest
+from logmodel import LogBuffer, LEVELS, parse_metrics, metric_total
 
 # ===== Paths =====
 SCRIPT_DIR = Path(__file__).parent
@@ -15,6 +19,11 @@ CONFIG_FILE = SCRIPT_DIR / "agent.yaml"
 DAEMON_SCRIPT = SCRIPT_DIR / "daemon.py"
 VENV_PYTHON = SCRIPT_DIR.parent / ".venv" / "bin" / "python"  # .venv in parent dir
 
+# ===== Log view =====
+LOG_MAX_LINES = 5000      # ring buffer size; older lines are dropped
+REPAINT_INTERVAL_MS = 250  # new output is painted in batches at this rate
+METRICS_INTERVAL_MS = 2000
+
 
 class IDSAgentUI(QWidget):
     def __init__(self):
@@ -22,6 +31,12 @@ class IDSAgentUI(QWidget):
         self.setWindowTitle("IDS Agent Control")
         self.resize(750, 600)
         self.process: QProcess | None = None
+        self.log = LogBuffer(LOG_MAX_LINES)
+        self.painted_seq = 0  # last LogBuffer line shown in the view
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.metrics = {}
+        self.network = QNetworkAccessManager(self)
+        self.network.finished.connect(self.on_metrics_reply)
 
         # Load config first
         self.config = self.load_config()
@@ -142,23 +157,35 @@ class IDSAgentUI(QWidget):
             self.ports_list.takeItem(self.ports_list.row(item))
 
     def save_config(self):
-        cfg = {
+        # Start from the loaded config so sections the UI does not edit
+        # (e.g. sender batching) survive a save.
+        cfg = dict(self.config)
+        cfg.update({
             "hub_url": self.hub_ip.text().strip(),
             "device_id": self.device_field.text().strip(),
             "api_key": self.apikey_field.text().strip(),
             "file_monitor": {
+                **(self.config.get("file_monitor") or {}),
                 "enabled": self.filemon_enabled.isChecked(),
                 "paths": [self.paths_list.item(i).text() for i in range(self.paths_list.count())]
             },
             "network_monitor": {
+                **(self.config.get("network_monitor") or {}),
                 "enabled": self.network_enabled.isChecked(),
                 "ports": [int(self.ports_list.item(i).text()) for i in range(self.ports_list.count())]
             }
-        }
+        })
 
         try:
-            with open(CONFIG_FILE, "w") as f:
+            # Write a copy and swap it in, so the running daemon never
+            # reloads a half-written agent.yaml
+            tmp = CONFIG_FILE.with_name(CONFIG_FILE.name + ".tmp")
+            with open(tmp, "w") as f:
                 yaml.safe_dump(cfg, f)
+            if CONFIG_FILE.exists():
+                os.chmod(tmp, CONFIG_FILE.stat().st_mode & 0o777)
+            os.replace(tmp, CONFIG_FILE)
+            self.config = cfg
             QMessageBox.information(self, "Config", f"Configuration saved to {CONFIG_FILE}")
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Failed to save config: {e}")
@@ -193,14 +220,59 @@ class IDSAgentUI(QWidget):
         control_layout.addWidget(self.start_btn)
         control_layout.addWidget(self.stop_btn)
 
-        # Logs view
-        self.log_view = QTextEdit()
+        # Live counters, from the daemon's metrics endpoint when it is
+        # reachable and from its log lines otherwise
+        counters_box = QGroupBox("Counters")
+        counters_layout = QFormLayout(counters_box)
+        self.counter_labels = {}
+        for key, title in (
+            ("captured", "Captured (file / network):"),
+            ("filtered", "Filtered or coalesced:"),
+            ("spooled", "Spooled:"),
+            ("delivered", "Delivered (accepted / rejected):"),
+            ("retries", "Upload retries:"),
+            ("backlog", "Queue / spool backlog:"),
+            ("pcap", "Packets seen / dropped:"),
+            ("log", "Log lines (warnings / errors / dropped):"),
+        ):
+            self.counter_labels[key] = QLabel("-")
+            counters_layout.addRow(title, self.counter_labels[key])
+
+        # Filters run on the LogBuffer; the view only shows the result
+        filter_layout = QHBoxLayout()
+        self.level_boxes = {}
+        for level in LEVELS:
+            box = QCheckBox(level.title())
+            box.setChecked(level != "EVENT")  # per-event lines are summarized by the counters
+            box.toggled.connect(self.refilter_log)
+            self.level_boxes[level] = box
+            filter_layout.addWidget(box)
+        self.log_filter = QLineEdit()
+        self.log_filter.setPlaceholderText("Filter text...")
+        self.log_filter.textChanged.connect(self.refilter_log)
+        filter_layout.addWidget(self.log_filter)
+        clear_btn = QPushButton("Clear")
+        clear_btn.clicked.connect(self.clear_log)
+        filter_layout.addWidget(clear_btn)
+
+        # Logs view; a plain text view bounded like the model
+        self.log_view = QPlainTextEdit()
         self.log_view.setReadOnly(True)
+        self.log_view.setMaximumBlockCount(LOG_MAX_LINES)
 
         layout.addLayout(control_layout)
+        layout.addWidget(counters_box)
         layout.addWidget(QLabel("Daemon Logs:"))
+        layout.addLayout(filter_layout)
         layout.addWidget(self.log_view)
 
+        self.repaint_timer = QTimer(self)
+        self.repaint_timer.timeout.connect(self.paint_log)
+        self.repaint_timer.start(REPAINT_INTERVAL_MS)
+        self.metrics_timer = QTimer(self)
+        self.metrics_timer.timeout.connect(self.poll_metrics)
+        self.metrics_timer.start(METRICS_INTERVAL_MS)
+
     # ===== Daemon Control =====
     def start_daemon(self):
         if self.process and self.process.state() != QProcess.ProcessState.NotRunning:
@@ -222,7 +294,7 @@ class IDSAgentUI(QWidget):
             self.process = None
             return
 
-        self.log_view.append("[INFO] Daemon started...")
+        self.log.append("[INFO] Daemon started...")
         self.start_btn.setEnabled(False)
         self.stop_btn.setEnabled(True)
 
@@ -231,15 +303,96 @@ class IDSAgentUI(QWidget):
             self.process.terminate()
             if not self.process.waitForFinished(3000):
                 self.process.kill()
-            self.log_view.append("[INFO] Daemon stopped.")
+            self.log.append("[INFO] Daemon stopped.")
             self.start_btn.setEnabled(True)
             self.stop_btn.setEnabled(False)
             self.process = None
 
     def on_ready_output(self):
+        # Only feeds the model; the view catches up on the next repaint tick
         if self.process:
-            data = self.process.readAllStandardOutput().data().decode("utf-8")
-            self.log_view.append(data.strip())
+            self.log.feed(self.decoder.decode(self.process.readAllStandardOutput().data()))
+
+    # ===== Log model -> view =====
+    def log_filter_args(self):
+        levels = tuple(level for level, box in self.level_boxes.items() if box.isChecked())
+        return levels, self.log_filter.text().strip()
+
+    def paint_log(self):
+        if self.log.seq != self.painted_seq:
+            lines = self.log.since(self.painted_seq, *self.log_filter_args())
+            self.painted_seq = self.log.seq
+            if lines:
+                self.log_view.appendPlainText("\n".join(lines))
+        self.update_counters()
+
+    def refilter_log(self):
+        self.log_view.setPlainText("\n".join(self.log.lines(*self.log_filter_args())))
+        self.painted_seq = self.log.seq
+        self.log_view.verticalScrollBar().setValue(self.log_view.verticalScrollBar().maximum())
+
+    def clear_log(self):
+        self.log.clear()
+        self.log_view.clear()
+        self.painted_seq = self.log.seq
+
+    # ===== Counters =====
+    def metrics_url(self):
+        listen = str((self.config.get("metrics") or {}).get("listen", "127.0.0.1:9108") or "")
+        if not listen or listen.startswith("unix:"):
+            return None
+        return f"http://{listen}/metrics"
+
+    def poll_metrics(self):
+        url = self.metrics_url()
+        if self.process is None or url is None:
+            self.metrics = {}
+            return
+        request = QNetworkRequest(QUrl(url))
+        request.setTransferTimeout(METRICS_INTERVAL_MS)
+        self.network.get(request)
+
+    def on_metrics_reply(self, reply):
+        if reply.error() == QNetworkReply.NetworkError.NoError:
+            self.metrics = parse_metrics(bytes(reply.readAll().data()).decode("utf-8", "replace"))
+        else:
+            self.metrics = {}
+        reply.deleteLater()
+
+    def update_counters(self):
+        m, log = self.metrics, self.log
+
+        def fmt(value):
+            return f"{int(value):,}"
+
+        if m:
+            self.counter_labels["captured"].setText(
+                f"{fmt(metric_total(m, 'agent_events_captured_total', source='file'))} / "
+                f"{fmt(metric_total(m, 'agent_events_captured_total', source='network'))}")
+            self.counter_labels["filtered"].setText(fmt(metric_total(m, "agent_events_filtered_total")))
+            self.counter_labels["spooled"].setText(fmt(metric_total(m, "agent_events_spooled_total")))
+            self.counter_labels["delivered"].setText(
+                f"{fmt(metric_total(m, 'agent_events_delivered_total', result='accepted'))} / "
+                f"{fmt(metric_total(m, 'agent_events_delivered_total', result='rejected'))}")
+            self.counter_labels["retries"].setText(fmt(metric_total(m, "agent_send_retries_total")))
+            self.counter_labels["backlog"].setText(
+                f"{fmt(metric_total(m, 'agent_queue_depth'))} events / "
+                f"{metric_total(m, 'agent_spool_pending_bytes') / 2**20:.1f} MB")
+            self.counter_labels["pcap"].setText(
+                f"{fmt(metric_total(m, 'agent_pcap_received_packets_total'))} / "
+                f"{fmt(metric_total(m, 'agent_pcap_dropped_packets_total'))}")
+        else:
+            events = log.event_counts
+            self.counter_labels["captured"].setText(f"{events.get('file', 0):,} / {events.get('network', 0):,} (from log)")
+            self.counter_labels["spooled"].setText(f"{sum(events.values()):,} (from log)")
+            self.counter_labels["delivered"].setText(
+                f"{log.delivered['events'] - log.delivered['rejected'] - log.delivered['retry']:,} / "
+                f"{log.delivered['rejected']:,} (from log)")
+            self.counter_labels["retries"].setText(f"{log.delivered['retry']:,} (from log)")
+            for key in ("filtered", "backlog", "pcap"):
+                self.counter_labels[key].setText("-")
+        self.counter_labels["log"].setText(
+            f"{log.level_counts['WARNING']:,} / {log.level_counts['ERROR']:,} / {log.dropped:,}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import errno
+import hashlib
+import os
+import stat
+import threading
+
+from procinfo import TTLCache
+
+
+class FileHasher:
+    """
+    Content digests for file events, streamed in `chunk_size` reads.
+
+    Files larger than `max_bytes`, and anything that is not a regular
+    file, are not read. Digests are cached per inode together with the
+    mtime and size they were computed for, so an unchanged file is never
+    read twice and a `touch` (new mtime, same bytes) is reported as
+    content_changed = False. hash() is blocking and thread-safe; the
+    daemon runs it on its own bounded pool.
+    """
+
+    def __init__(self, algorithm="sha256", max_bytes=64 * 2**20, chunk_size=2**20, cache_entries=65536):
+        hashlib.new(algorithm)  # ValueError early for an unknown algorithm
+        self.algorithm = algorithm
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.cache = TTLCache(cache_entries, ttl=float("inf"))  # (dev, ino) -> (mtime_ns, size, digest)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _buffer(self):
+        buf = getattr(self.local, "buf", None)
+        if buf is None:
+            buf = self.local.buf = bytearray(self.chunk_size)
+        return buf
+
+    def hash(self, path):
+        """
+        Returns (result, fields): result is one of hashed, cached,
+        too_large, not_regular, changing or error, fields go into the
+        event details.
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK | os.O_CLOEXEC)
+        except OSError as e:
+            return ("not_regular" if e.errno == errno.ELOOP else "error"), {}  # ELOOP: a symlink
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                return "not_regular", {}
+            key = (st.st_dev, st.st_ino)
+            with self.lock:
+                previous = self.cache.get(key)
+            if previous and previous[:2] == (st.st_mtime_ns, st.st_size):
+                return "cached", {self.algorithm: previous[2], "size": st.st_size, "content_changed": False}
+            if st.st_size > self.max_bytes:
+                return "too_large", {"size": st.st_size, "hash_skipped": "too_large"}
+
+            digest = hashlib.new(self.algorithm)
+            buf = self._buffer()
+            view = memoryview(buf)
+            total = 0
+            while total <= self.max_bytes:
+                n = os.readv(fd, [buf])
+                if n == 0:
+                    break
+                digest.update(view[:n])
+                total += n
+            after = os.fstat(fd)
+            if total > self.max_bytes or (after.st_mtime_ns, after.st_size) != (st.st_mtime_ns, st.st_size):
+                # Still being written; the next close-write event hashes the final content
+                return "changing", {"size": after.st_size, "hash_skipped": "changing"}
+        except OSError:
+            return "error", {}
+        finally:
+            os.close(fd)
+
+        value = digest.hexdigest()
+        with self.lock:
+            self.cache.put(key, (st.st_mtime_ns, st.st_size, value))
+        fields = {self.algorithm: value, "size": st.st_size}
+        if previous:
+            fields["content_changed"] = previous[2] != value
+        return "hashed", fields
@@ -1,21 +1,70 @@
 import json
 import base64
 import os
+import threading
+from functools import lru_cache
 import requests
+from requests.adapters import HTTPAdapter
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from eventmodel import join_records
 
-def encrypt_payload(api_key, payload_dict):
+@lru_cache(maxsize=8)
+def _aead(api_key):
+    return AESGCM(base64.urlsafe_b64decode(api_key))
+
+def encrypt_bytes(api_key, data: bytes):
     """
-    Encrypt a JSON-serializable dictionary using AES-GCM with the API key.
+    Encrypt already-encoded JSON using AES-GCM with the API key.
     Returns a URL-safe base64 encoded string.
     """
-    key = base64.urlsafe_b64decode(api_key)
-    aesgcm = AESGCM(key)
     nonce = os.urandom(12)  # 96-bit nonce for AES-GCM
-    data = json.dumps(payload_dict).encode('utf-8')
-    ct = aesgcm.encrypt(nonce, data, None)
+    ct = _aead(api_key).encrypt(nonce, data, None)
     return base64.urlsafe_b64encode(nonce + ct).decode('utf-8')
 
+def encrypt_payload(api_key, payload_dict):
+    """
+    Encrypt a JSON-serializable dictionary (or list of them) using AES-GCM
+    with the API key.
+    Returns a URL-safe base64 encoded string.
+    """
+    return encrypt_bytes(api_key, json.dumps(payload_dict).encode('utf-8'))
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def get_session(pool_size=4):
+    """
+    Return the process-wide HTTP session, creating it on first use.
+    The session keeps connections alive so consecutive uploads reuse the
+    same TCP/TLS connection; pool_size bounds the connections per host and
+    should match the number of concurrent uploads.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _SESSION = session
+        return _SESSION
+
+def _post_encrypted(url, device_id, encrypted_payload, timeout):
+    headers = {
+        "X-Device-ID": device_id,
+        "Content-Type": "text/plain"  # sending raw encrypted string
+    }
+
+    response = get_session().post(
+        url,
+        headers=headers,
+        data=encrypted_payload,
+        verify=True,  # Ensure TLS verification; set path to CA bundle if needed
+        timeout=timeout
+    )
+    response.raise_for_status()
+    return response
+
 def send_event(hub_url, device_id, api_key, payload_dict, timeout=10):
     """
     Encrypts payload and sends it to the Hub over HTTPS.
@@ -25,26 +74,25 @@ def send_event(hub_url, device_id, api_key, payload_dict, timeout=10):
         Response object from requests
     """
     encrypted_payload = encrypt_payload(api_key, payload_dict)
-
-    headers = {
-        "X-Device-ID": device_id,
-        "Content-Type": "text/plain"  # sending raw encrypted string
-    }
-
     try:
-        response = requests.post(
-            hub_url,
-            headers=headers,
-            data=encrypted_payload,
-            verify=True,  # Ensure TLS verification; set path to CA bundle if needed
-            timeout=timeout
-        )
-        response.raise_for_status()
-        return response
+        return _post_encrypted(hub_url, device_id, encrypted_payload, timeout)
     except requests.exceptions.RequestException as e:
         print(f"[ERROR] Failed to send event: {e}")
         return None
 
+def send_batch(bulk_url, device_id, api_key, records, timeout=10):
+    """
+    Encrypts a list of JSON-encoded events (bytes, as stored in the spool)
+    as a single envelope and sends it to the Hub bulk endpoint
+    (/api/events/bulk). The records are joined, not re-parsed.
+    Returns:
+        Response object from requests; its JSON body holds one result per event
+    Raises:
+        requests.exceptions.RequestException so the caller can classify the failure
+    """
+    encrypted_payload = encrypt_bytes(api_key, join_records(records))
+    return _post_encrypted(bulk_url, device_id, encrypted_payload, timeout)
+
 def create_device(device_id, device_name):
     """
     Generate config and certs for a new device.
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import re
+from collections import deque
+
+LEVELS = ("ERROR", "WARNING", "HUB", "INFO", "EVENT")
+_EVENT_LINE = re.compile(r"^\[(\w+) EVENT\] ")
+_BATCH_LINE = re.compile(r"events=(\d+), rejected=(\d+), retry=(\d+)")
+_SAMPLE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?\s+(\S+)$")
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def line_level(line: str) -> str:
+    """Level of one daemon log line, from the prefix the daemon prints."""
+    if line.startswith("[ERROR]"):
+        return "ERROR"
+    if line.startswith("[WARNING]"):
+        return "WARNING"
+    if line.startswith("[HUB]"):
+        return "HUB"
+    if _EVENT_LINE.match(line):
+        return "EVENT"
+    return "INFO"
+
+
+class LogBuffer:
+    """
+    Ring buffer of daemon log lines for the GUI.
+
+    Holds at most `max_lines` lines; older ones are dropped and counted
+    in `dropped`. Every line gets a sequence number, so a view can ask
+    for just the lines added since its last repaint (since()) and
+    rebuild from the model when the filter changes (lines()). Output
+    arrives in arbitrary chunks; a trailing partial line is held back
+    until its newline arrives.
+    """
+
+    def __init__(self, max_lines=5000):
+        self.entries = deque(maxlen=max_lines)  # (seq, level, text)
+        self.seq = 0
+        self.dropped = 0
+        self.partial = ""
+        self.level_counts = dict.fromkeys(LEVELS, 0)
+        self.event_counts = {}    # event type -> lines seen
+        self.delivered = {"events": 0, "rejected": 0, "retry": 0}
+
+    def feed(self, data: str):
+        data = self.partial + data
+        *complete, self.partial = data.split("\n")
+        for line in complete:
+            self.append(line.rstrip("\r"))
+
+    def append(self, line: str):
+        if not line.strip():
+            return
+        level = line_level(line)
+        self.level_counts[level] += 1
+        if level == "EVENT":
+            event_type = _EVENT_LINE.match(line).group(1).lower()
+            self.event_counts[event_type] = self.event_counts.get(event_type, 0) + 1
+        elif level == "HUB" and "Batch delivered" in line:
+            m = _BATCH_LINE.search(line)
+            if m:
+                for key, value in zip(("events", "rejected", "retry"), m.groups()):
+                    self.delivered[key] += int(value)
+        if len(self.entries) == self.entries.maxlen:
+            self.dropped += 1
+        self.seq += 1
+        self.entries.append((self.seq, level, line))
+
+    @staticmethod
+    def _matches(level, text, levels, needle):
+        return level in levels and (not needle or needle in text.lower())
+
+    def lines(self, levels=LEVELS, needle=""):
+        """Every buffered line passing the level set and the case-insensitive text filter."""
+        needle = needle.lower()
+        return [text for _, level, text in self.entries if self._matches(level, text, levels, needle)]
+
+    def since(self, seq, levels=LEVELS, needle=""):
+        """Lines added after sequence number `seq` that pass the filter, oldest first."""
+        needle = needle.lower()
+        out = []
+        for s, level, text in reversed(self.entries):
+            if s <= seq:
+                break
+            if self._matches(level, text, levels, needle):
+                out.append(text)
+        out.reverse()
+        return out
+
+    def clear(self):
+        self.entries.clear()
+        self.partial = ""
+
+
+def parse_metrics(text: str) -> dict:
+    """Prometheus text format -> {metric name: {frozenset of label items: value}}."""
+    metrics = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        m = _SAMPLE.match(line.strip())
+        if not m:
+            continue
+        name, labels, value = m.groups()
+        try:
+            value = float(value)
+        except ValueError:
+            continue
+        key = frozenset(_LABEL.findall(labels or ""))
+        metrics.setdefault(name, {})[key] = value
+    return metrics
+
+
+def metric_total(metrics: dict, name: str, **labels) -> float:
+    """Sum of `name` over the samples carrying all of `labels`."""
+    wanted = set(labels.items())
+    return sum(v for key, v in metrics.get(name, {}).items() if wanted <= key)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import bisect
+import threading
+
+# Seconds; covers a LAN round trip up to a hub that is timing out
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 500, 1000)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_str(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _fmt(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(n, "") for n in self.labels)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, v) for key, v in sorted(self.values.items())]
+
+
+class Gauge(_Metric):
+    """Settable gauge; with `fn` it is read at scrape time instead (fn returns {label tuple: value})."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), fn=None):
+        super().__init__(name, help_text, labels)
+        self.values = {}
+        self.fn = fn
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.fn is not None:
+            values = self.fn()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return [(self.name, key, v) for key, v in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # label key -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        out = []
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.values.items())
+        for key, counts in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts[:-1]):
+                cumulative += n
+                out.append((self.name + "_bucket", key, cumulative, ("le", _fmt(bound))))
+            out.append((self.name + "_count", key, cumulative))
+            out.append((self.name + "_sum", key, counts[-1]))
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=(), fn=None):
+        return self._add(Gauge(name, help_text, labels, fn))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self.metrics:
+            lines += metric.header()
+            for sample in metric.samples():
+                name, key, value = sample[:3]
+                names, values = metric.labels, key
+                if len(sample) > 3:
+                    names, values = names + (sample[3][0],), key + (sample[3][1],)
+                lines.append(f"{name}{_label_str(names, values)} {_fmt(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """
+        {metric: value} for unlabelled metrics and {metric: {"a,b": value}}
+        for labelled ones, for the periodic health event. Histograms are
+        reduced to their count and sum.
+        """
+        snap = {}
+        for metric in self.metrics:
+            for sample in metric.samples():
+                name, key, value = sample[:3]
+                if name.endswith("_bucket"):
+                    continue
+                if key:
+                    snap.setdefault(name, {})[",".join(str(v) for v in key)] = value
+                else:
+                    snap[name] = value
+        return snap
+
+
+async def serve_http(registry, reader, writer):
+    """Answer one HTTP request with the current metrics and close the connection."""
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # skip headers
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] in (b"/", b"/metrics"):
+            status, body = "200 OK", registry.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body
+        )
+        await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
@@ -1,21 +1,304 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <stdint.h>
 #include <pcap.h>
 #include <arpa/inet.h>
 #include <netinet/ip.h>
 #include <netinet/tcp.h>
 #include <string.h>
 #include <pthread.h>
+#include <signal.h>
+#include <getopt.h>
 #include <time.h>
+#include <sys/time.h>
+#include <net/if.h>
+#include <poll.h>
 
-#define NUM_PORTS 2
-int monitored_ports[NUM_PORTS] = {22, 80}; // SSH & HTTP
+#define MAX_PORTS 256
+#define MAX_INTERFACES 64
+#define TCP_FLAGS_END 14               // TCP header bytes up to and including the flags
+// === Options ===
+static int flow_mode = 0;              // aggregate packets into flow records
+static int flow_table_size = 65536;    // max concurrent flows per interface
+static int flow_idle_timeout = 30;     // seconds without packets before a flow is emitted
+static int flow_active_timeout = 300;  // long-lived flows are emitted (and restarted) this often
+static int binary_output = 0;          // fixed-size netmon_record structs instead of JSON lines
+static int monitored_ports[MAX_PORTS]; // empty means every TCP port
+static int num_ports = 0;
+static const char *extra_filter = NULL;          // user BPF expression, ANDed in
+static const char *allowed_ifaces[MAX_INTERFACES]; // empty means every interface that is up
+static int num_allowed_ifaces = 0;
+static char *filter_exp = NULL;        // current BPF program text, guarded by filter_lock
+static unsigned filter_gen = 0;        // bumped whenever filter_exp is replaced
+static pthread_mutex_t filter_lock = PTHREAD_MUTEX_INITIALIZER;
+static int control_mode = 0;           // accept filter updates on stdin (--control)
+static int snaplen = 128;              // enough for Ethernet + IPv4 + TCP headers with options
+static int promisc = 0;
+static int immediate_mode = 0;         // deliver packets as they arrive instead of per buffer
+static int buffer_size = 0;            // kernel capture buffer in bytes, 0 = libpcap default
+static int read_timeout_ms = 1000;
+static int stats_interval = 10;        // seconds between pcap_stats reports, 0 disables
+
+static volatile sig_atomic_t running = 1;
+static pthread_mutex_t out_lock = PTHREAD_MUTEX_INITIALIZER;
+
+// === Binary output ===
+// One fixed-size record per packet, flow or stats report, native byte order. The daemon
+// decodes these with struct format "=BBBxIIIHHIQQQ" (see agent/netmon.py);
+// keep both in sync.
+// REC_STATS reuses the layout: packets = ps_recv, bytes = ps_drop,
+// first_ns = ps_ifdrop, last_ns = report time (all counters cumulative).
+enum { REC_PACKET = 1, REC_FLOW = 2, REC_STATS = 3 };
+enum { END_NONE = 0, END_FIN_RST, END_IDLE, END_ACTIVE, END_OVERFLOW, END_SHUTDOWN };
+static const char *end_reason_names[] = {"", "end", "idle", "active", "overflow", "shutdown"};
+
+typedef struct __attribute__((packed)) {
+    uint8_t  kind;
+    uint8_t  tcp_flags;
+    uint8_t  end_reason;
+    uint8_t  pad;
+    uint32_t ifindex;
+    uint32_t src_ip, dst_ip;   // host byte order
+    uint16_t src_port, dst_port;
+    uint32_t packets;
+    uint64_t bytes;
+    uint64_t first_ns, last_ns;
+} netmon_record;
+
+_Static_assert(sizeof(netmon_record) == 48, "netmon_record layout changed");
+
+static uint64_t timeval_ns(const struct timeval *tv) {
+    return (uint64_t)tv->tv_sec * 1000000000ull + (uint64_t)tv->tv_usec * 1000ull;
+}
+
+static void write_record(const netmon_record *rec) {
+    pthread_mutex_lock(&out_lock);
+    fwrite(rec, sizeof(*rec), 1, stdout);
+    pthread_mutex_unlock(&out_lock);
+}
+
+// === Flow table ===
+typedef struct {
+    uint32_t src_ip, dst_ip;   // network byte order, as seen on the first packet
+    uint16_t src_port, dst_port;
+} flow_key;
+
+typedef struct {
+    flow_key key;
+    uint64_t packets, bytes;
+    uint8_t tcp_flags;         // OR of all flags seen
+    uint8_t fin_fwd, fin_rev;
+    struct timeval first_seen, last_seen;
+    int next;                  // bucket chain / free list, -1 terminates
+    int used;
+} flow_entry;
+
+typedef struct {
+    flow_entry *entries;
+    int *buckets;
+    int nbuckets;
+    int free_head;
+    int count;
+} flow_table;
 
 typedef struct {
     char *dev;
     int dlt; // Data Link Type
+    uint32_t ifindex;
+    unsigned filter_gen; // filter_exp generation installed on this handle
+    flow_table flows;
 } interface_arg;
 
+static uint32_t flow_hash(const flow_key *k) {
+    // Symmetric so both directions of a connection land in the same bucket
+    uint32_t a = k->src_ip ^ k->dst_ip;
+    uint32_t b = (uint32_t)(k->src_port ^ k->dst_port);
+    uint32_t h = a * 2654435761u ^ (b * 40503u) ^ (k->src_ip + k->dst_ip);
+    return h ^ (h >> 16);
+}
+
+static int flow_init(flow_table *t, int size) {
+    t->nbuckets = size;
+    t->entries = calloc(size, sizeof(flow_entry));
+    t->buckets = malloc(size * sizeof(int));
+    if (!t->entries || !t->buckets) return -1;
+    for (int i = 0; i < size; i++) {
+        t->buckets[i] = -1;
+        t->entries[i].next = i + 1 < size ? i + 1 : -1;
+    }
+    t->free_head = 0;
+    t->count = 0;
+    return 0;
+}
+
+static void flow_free(flow_table *t) {
+    free(t->entries);
+    free(t->buckets);
+}
+
+static void format_time(const struct timeval *tv, char *buf, size_t len) {
+    struct tm tm_info;
+    time_t t = tv->tv_sec;
+    gmtime_r(&t, &tm_info);
+    size_t n = strftime(buf, len, "%Y-%m-%dT%H:%M:%S", &tm_info);
+    snprintf(buf + n, len - n, ".%06ld+00:00", (long)tv->tv_usec);
+}
+
+static void format_flags(uint8_t flags, char *buf) {
+    const char names[] = "FSRPAU";
+    int n = 0;
+    for (int i = 0; i < 6; i++)
+        if (flags & (1 << i)) buf[n++] = names[i];
+    buf[n] = '\0';
+}
+
+static void emit_flow(const interface_arg *iarg, const flow_entry *e, int reason) {
+    if (binary_output) {
+        netmon_record rec = {
+            .kind = REC_FLOW, .tcp_flags = e->tcp_flags, .end_reason = reason,
+            .ifindex = iarg->ifindex,
+            .src_ip = ntohl(e->key.src_ip), .dst_ip = ntohl(e->key.dst_ip),
+            .src_port = e->key.src_port, .dst_port = e->key.dst_port,
+            .packets = (uint32_t)e->packets, .bytes = e->bytes,
+            .first_ns = timeval_ns(&e->first_seen), .last_ns = timeval_ns(&e->last_seen)
+        };
+        write_record(&rec);
+        return;
+    }
+
+    char src[INET_ADDRSTRLEN], dst[INET_ADDRSTRLEN], first[48], last[48], flags[8];
+    inet_ntop(AF_INET, &e->key.src_ip, src, sizeof(src));
+    inet_ntop(AF_INET, &e->key.dst_ip, dst, sizeof(dst));
+    format_time(&e->first_seen, first, sizeof(first));
+    format_time(&e->last_seen, last, sizeof(last));
+    format_flags(e->tcp_flags, flags);
+
+    pthread_mutex_lock(&out_lock);
+    printf("{\"record\":\"flow\",\"interface\":\"%s\",\"protocol\":\"tcp\",\"src_ip\":\"%s\",\"dst_ip\":\"%s\","
+           "\"src_port\":%u,\"dst_port\":%u,\"packets\":%llu,\"bytes\":%llu,\"tcp_flags\":\"%s\","
+           "\"first_seen\":\"%s\",\"last_seen\":\"%s\",\"end_reason\":\"%s\"}\n",
+           iarg->dev, src, dst, e->key.src_port, e->key.dst_port,
+           (unsigned long long)e->packets, (unsigned long long)e->bytes, flags,
+           first, last, end_reason_names[reason]);
+    fflush(stdout);
+    pthread_mutex_unlock(&out_lock);
+}
+
+static void emit_stats(const interface_arg *iarg, pcap_t *handle) {
+    struct pcap_stat ps;
+    if (pcap_stats(handle, &ps) == -1) {
+        fprintf(stderr, "pcap_stats failed on %s: %s\n", iarg->dev, pcap_geterr(handle));
+        return;
+    }
+    struct timeval now;
+    gettimeofday(&now, NULL);
+
+    if (binary_output) {
+        netmon_record rec = {
+            .kind = REC_STATS, .ifindex = iarg->ifindex,
+            .packets = ps.ps_recv, .bytes = ps.ps_drop,
+            .first_ns = ps.ps_ifdrop, .last_ns = timeval_ns(&now)
+        };
+        write_record(&rec);
+        return;
+    }
+
+    char ts[48];
+    format_time(&now, ts, sizeof(ts));
+    pthread_mutex_lock(&out_lock);
+    printf("{\"record\":\"stats\",\"interface\":\"%s\",\"received\":%u,\"dropped\":%u,\"if_dropped\":%u,\"reported_at\":\"%s\"}\n",
+           iarg->dev, ps.ps_recv, ps.ps_drop, ps.ps_ifdrop, ts);
+    fflush(stdout);
+    pthread_mutex_unlock(&out_lock);
+}
+
+static void flow_remove(flow_table *t, int idx) {
+    uint32_t b = flow_hash(&t->entries[idx].key) % t->nbuckets;
+    int *link = &t->buckets[b];
+    while (*link != idx) link = &t->entries[*link].next;
+    *link = t->entries[idx].next;
+    t->entries[idx].used = 0;
+    t->entries[idx].next = t->free_head;
+    t->free_head = idx;
+    t->count--;
+}
+
+static void flow_update(interface_arg *iarg, const flow_key *k, uint8_t flags,
+                        uint32_t len, const struct timeval *ts) {
+    flow_table *t = &iarg->flows;
+    uint32_t b = flow_hash(k) % t->nbuckets;
+    int reverse = 0;
+    int idx;
+    for (idx = t->buckets[b]; idx != -1; idx = t->entries[idx].next) {
+        flow_key *f = &t->entries[idx].key;
+        if (f->src_ip == k->src_ip && f->dst_ip == k->dst_ip &&
+            f->src_port == k->src_port && f->dst_port == k->dst_port) break;
+        if (f->src_ip == k->dst_ip && f->dst_ip == k->src_ip &&
+            f->src_port == k->dst_port && f->dst_port == k->src_port) { reverse = 1; break; }
+    }
+
+    if (idx == -1) {
+        if (t->free_head == -1) {
+            // Table full: report this packet on its own rather than drop it
+            flow_entry single = {.key = *k, .packets = 1, .bytes = len, .tcp_flags = flags,
+                                 .first_seen = *ts, .last_seen = *ts};
+            emit_flow(iarg, &single, END_OVERFLOW);
+            return;
+        }
+        idx = t->free_head;
+        t->free_head = t->entries[idx].next;
+        flow_entry *e = &t->entries[idx];
+        memset(e, 0, sizeof(*e));
+        e->key = *k;
+        e->first_seen = *ts;
+        e->used = 1;
+        e->next = t->buckets[b];
+        t->buckets[b] = idx;
+        t->count++;
+    }
+
+    flow_entry *e = &t->entries[idx];
+    e->packets++;
+    e->bytes += len;
+    e->tcp_flags |= flags;
+    e->last_seen = *ts;
+    if (flags & TH_FIN) {
+        if (reverse) e->fin_rev = 1; else e->fin_fwd = 1;
+    }
+
+    if (flags & TH_RST || (e->fin_fwd && e->fin_rev)) {
+        emit_flow(iarg, e, END_FIN_RST);
+        flow_remove(t, idx);
+    }
+}
+
+// Emit flows that went idle or exceeded the active timeout; force empties the table.
+// flow_remove() only unlinks a slot from its bucket chain, entries never move,
+// so removing slot i while walking the array cannot skip another flow.
+static void flow_sweep(interface_arg *iarg, int force) {
+    flow_table *t = &iarg->flows;
+    struct timeval now;
+    gettimeofday(&now, NULL);
+    for (int i = 0; i < t->nbuckets && t->count > 0; i++) {
+        flow_entry *e = &t->entries[i];
+        if (!e->used) continue;
+        if (force) {
+            emit_flow(iarg, e, END_SHUTDOWN);
+            flow_remove(t, i);
+        } else if (now.tv_sec - e->last_seen.tv_sec >= flow_idle_timeout) {
+            emit_flow(iarg, e, END_IDLE);
+            flow_remove(t, i);
+        } else if (now.tv_sec - e->first_seen.tv_sec >= flow_active_timeout) {
+            emit_flow(iarg, e, END_ACTIVE);
+            e->packets = 0;
+            e->bytes = 0;
+            e->tcp_flags = 0;
+            e->first_seen = now;
+        }
+    }
+}
+
+// === Packet handling ===
 void packet_handler(u_char *args, const struct pcap_pkthdr *header, const u_char *packet) {
     interface_arg *iarg = (interface_arg*)args;
 
@@ -27,73 +310,347 @@ void packet_handler(u_char *args, const struct pcap_pkthdr *header, const u_char
         default:         offset = 0; break;    // fallback
     }
 
+    // Every header is checked against caplen: a small snaplen or long IP
+    // options can cut a packet short before the TCP flags, and those are skipped
+    if (header->caplen < offset + sizeof(struct ip)) return;
     struct ip *iph = (struct ip*)(packet + offset);
     if (iph->ip_p != IPPROTO_TCP) return;
+    unsigned ip_hlen = iph->ip_hl * 4;
+    if (ip_hlen < sizeof(struct ip) || header->caplen < offset + ip_hlen + TCP_FLAGS_END) return;
 
-    struct tcphdr *tcph = (struct tcphdr*)(packet + offset + iph->ip_hl*4);
+    struct tcphdr *tcph = (struct tcphdr*)(packet + offset + ip_hlen);
     int src_port = ntohs(tcph->source);
     int dst_port = ntohs(tcph->dest);
 
-    for (int i = 0; i < NUM_PORTS; i++) {
-        if (src_port == monitored_ports[i] || dst_port == monitored_ports[i]) {
-            char ts[64];
-            time_t t = header->ts.tv_sec;
-            struct tm *tm_info = localtime(&t);
-            strftime(ts, sizeof(ts), "%Y-%m-%d %H:%M:%S", tm_info);
+    // Port selection happens in the kernel BPF filter (see build_filter)
+    if (flow_mode) {
+        flow_key k = {.src_ip = iph->ip_src.s_addr, .dst_ip = iph->ip_dst.s_addr,
+                      .src_port = src_port, .dst_port = dst_port};
+        flow_update(iarg, &k, tcph->th_flags, header->len, &header->ts);
+        return;
+    }
 
-            printf("{\"timestamp\":\"%s\",\"interface\":\"%s\",\"src_ip\":\"%s\",\"dst_ip\":\"%s\",\"src_port\":%d,\"dst_port\":%d,\"packet_size\":%d}\n",
-                   ts, iarg->dev, inet_ntoa(iph->ip_src), inet_ntoa(iph->ip_dst),
-                   src_port, dst_port, header->len);
-            fflush(stdout);
-            break;
-        }
+    if (binary_output) {
+        uint64_t ns = timeval_ns(&header->ts);
+        netmon_record rec = {
+            .kind = REC_PACKET, .tcp_flags = tcph->th_flags, .ifindex = iarg->ifindex,
+            .src_ip = ntohl(iph->ip_src.s_addr), .dst_ip = ntohl(iph->ip_dst.s_addr),
+            .src_port = src_port, .dst_port = dst_port,
+            .packets = 1, .bytes = header->len, .first_ns = ns, .last_ns = ns
+        };
+        write_record(&rec);
+        return;
     }
+
+    char ts[64], src[INET_ADDRSTRLEN], dst[INET_ADDRSTRLEN];
+    time_t t = header->ts.tv_sec;
+    struct tm tm_info;
+    localtime_r(&t, &tm_info);
+    strftime(ts, sizeof(ts), "%Y-%m-%d %H:%M:%S", &tm_info);
+    inet_ntop(AF_INET, &iph->ip_src, src, sizeof(src));
+    inet_ntop(AF_INET, &iph->ip_dst, dst, sizeof(dst));
+
+    pthread_mutex_lock(&out_lock);
+    printf("{\"timestamp\":\"%s\",\"interface\":\"%s\",\"src_ip\":\"%s\",\"dst_ip\":\"%s\",\"src_port\":%d,\"dst_port\":%d,\"packet_size\":%d}\n",
+           ts, iarg->dev, src, dst, src_port, dst_port, header->len);
+    fflush(stdout);
+    pthread_mutex_unlock(&out_lock);
+}
+
+// Compile the current filter_exp and install it on a live handle. pcap_setfilter
+// replaces the kernel filter in place, so capture continues without a gap.
+static int install_filter(pcap_t *handle, interface_arg *iarg) {
+    pthread_mutex_lock(&filter_lock);
+    char *exp = strdup(filter_exp);
+    unsigned gen = filter_gen;
+    pthread_mutex_unlock(&filter_lock);
+    if (!exp) return -1;
+
+    struct bpf_program fp;
+    int rc = 0;
+    if (pcap_compile(handle, &fp, exp, 0, PCAP_NETMASK_UNKNOWN) == -1 ||
+        pcap_setfilter(handle, &fp) == -1) {
+        fprintf(stderr, "Error setting filter '%s' on %s: %s\n", exp, iarg->dev, pcap_geterr(handle));
+        rc = -1;
+    } else {
+        pcap_freecode(&fp);
+        iarg->filter_gen = gen;
+    }
+    free(exp);
+    return rc;
 }
 
 void* monitor_interface(void* arg) {
     interface_arg *iarg = (interface_arg*)arg;
     char errbuf[PCAP_ERRBUF_SIZE];
 
-    pcap_t *handle = pcap_open_live(iarg->dev, BUFSIZ, 1, 1000, errbuf);
+    pcap_t *handle = pcap_create(iarg->dev, errbuf);
     if (!handle) {
         fprintf(stderr, "Couldn't open %s: %s\n", iarg->dev, errbuf);
         free(iarg->dev);
         free(iarg);
         return NULL;
     }
+    pcap_set_snaplen(handle, snaplen);
+    pcap_set_promisc(handle, promisc);
+    pcap_set_timeout(handle, read_timeout_ms);
+    pcap_set_immediate_mode(handle, immediate_mode);
+    if (buffer_size > 0) pcap_set_buffer_size(handle, buffer_size);
+
+    int status = pcap_activate(handle);
+    if (status < 0) {
+        fprintf(stderr, "Couldn't activate %s: %s (%s)\n", iarg->dev,
+                pcap_statustostr(status), pcap_geterr(handle));
+        pcap_close(handle);
+        free(iarg->dev);
+        free(iarg);
+        return NULL;
+    }
+    if (status > 0)
+        fprintf(stderr, "Warning activating %s: %s\n", iarg->dev, pcap_statustostr(status));
+    // Non-blocking reads driven by poll() so flow sweeps and stats reports
+    // run on time even in immediate mode or on idle links.
+    if (pcap_setnonblock(handle, 1, errbuf) == -1)
+        fprintf(stderr, "Couldn't set non-blocking mode on %s: %s\n", iarg->dev, errbuf);
+    struct pollfd pfd = {.fd = pcap_get_selectable_fd(handle), .events = POLLIN};
 
     // Store the data link type
     iarg->dlt = pcap_datalink(handle);
+    iarg->ifindex = if_nametoindex(iarg->dev);
 
-    // Build BPF filter for monitored ports
-    char filter_exp[256] = "";
-    for (int i = 0; i < NUM_PORTS; i++) {
-        char temp[32];
-        sprintf(temp, "tcp port %d", monitored_ports[i]);
-        strcat(filter_exp, temp);
-        if (i != NUM_PORTS - 1) strcat(filter_exp, " or ");
+    if (install_filter(handle, iarg) == -1) {
+        pcap_close(handle);
+        free(iarg->dev);
+        free(iarg);
+        return NULL;
     }
 
-    struct bpf_program fp;
-    if (pcap_compile(handle, &fp, filter_exp, 0, PCAP_NETMASK_UNKNOWN) == -1 ||
-        pcap_setfilter(handle, &fp) == -1) {
-        fprintf(stderr, "Error setting filter '%s' on %s\n", filter_exp, iarg->dev);
+    if (flow_mode && flow_init(&iarg->flows, flow_table_size) == -1) {
+        fprintf(stderr, "Couldn't allocate flow table for %s\n", iarg->dev);
         pcap_close(handle);
         free(iarg->dev);
         free(iarg);
         return NULL;
     }
 
-    printf("Monitoring interface: %s\n", iarg->dev);
-    pcap_loop(handle, -1, packet_handler, (u_char*)iarg);
+    fprintf(stderr, "Monitoring interface: %s (snaplen %d, promisc %d, immediate %d)\n",
+            iarg->dev, snaplen, promisc, immediate_mode);
+    time_t next_stats = time(NULL) + stats_interval;
+    time_t next_sweep = time(NULL) + 1;
+    while (running) {
+        if (pfd.fd >= 0) poll(&pfd, 1, read_timeout_ms);
+        if (pcap_dispatch(handle, -1, packet_handler, (u_char*)iarg) < 0) {
+            fprintf(stderr, "Capture error on %s: %s\n", iarg->dev, pcap_geterr(handle));
+            break;
+        }
+        if (__atomic_load_n(&filter_gen, __ATOMIC_ACQUIRE) != iarg->filter_gen)
+            install_filter(handle, iarg);  // on failure the previous filter stays active
+        time_t now = time(NULL);
+        // Timeouts have one-second resolution; walking the table per dispatch
+        // would cost O(table) per packet in immediate mode
+        if (flow_mode && now >= next_sweep) {
+            flow_sweep(iarg, 0);
+            next_sweep = now + 1;
+        }
+        if (stats_interval > 0 && now >= next_stats) {
+            emit_stats(iarg, handle);
+            next_stats = now + stats_interval;
+        }
+        if (binary_output) {
+            // Records are block-buffered; push them out at least once per read timeout
+            pthread_mutex_lock(&out_lock);
+            fflush(stdout);
+            pthread_mutex_unlock(&out_lock);
+        }
+    }
 
+    if (flow_mode) {
+        flow_sweep(iarg, 1);
+        flow_free(&iarg->flows);
+    }
+    pthread_mutex_lock(&out_lock);
+    fflush(stdout);
+    pthread_mutex_unlock(&out_lock);
     pcap_close(handle);
     free(iarg->dev);
     free(iarg);
     return NULL;
 }
 
-int main() {
+// "ip and tcp [and (port a or port b ...)] [and (extra filter)]"
+static char *build_filter(const int *ports, int nports, const char *extra) {
+    size_t len = 64 + (size_t)nports * 16 + (extra ? strlen(extra) : 0);
+    char *exp = malloc(len);
+    if (!exp) return NULL;
+    int n = snprintf(exp, len, "ip and tcp");
+    for (int i = 0; i < nports; i++)
+        n += snprintf(exp + n, len - n, "%s%d", i == 0 ? " and (port " : " or port ", ports[i]);
+    if (nports) n += snprintf(exp + n, len - n, ")");
+    if (extra && *extra) snprintf(exp + n, len - n, " and (%s)", extra);
+    return exp;
+}
+
+// Parse "P1,P2,..." into ports; *nports is only updated on success
+static int parse_ports(const char *list, int *ports, int *nports) {
+    char *copy = strdup(list);
+    int n = 0;
+    if (!copy) return -1;
+    for (char *tok = strtok(copy, ","); tok; tok = strtok(NULL, ",")) {
+        int port = atoi(tok);
+        if (port < 1 || port > 65535 || n >= MAX_PORTS) {
+            fprintf(stderr, "Invalid or too many ports: %s\n", tok);
+            free(copy);
+            return -1;
+        }
+        ports[n++] = port;
+    }
+    free(copy);
+    *nports = n;
+    return 0;
+}
+
+// === Control channel (--control) ===
+// The daemon writes line commands to stdin to change the filter without a restart:
+//   ports P1,P2,...   (empty list = all TCP)
+//   filter EXPR       (empty = no extra expression)
+//   apply             validate and install on every capture handle
+// An invalid filter is rejected and the running one is kept.
+static void *control_loop(void *arg) {
+    (void)arg;
+    char line[4096];
+    int ports[MAX_PORTS];
+    int nports = num_ports;
+    memcpy(ports, monitored_ports, sizeof(int) * (size_t)num_ports);
+    char *extra = extra_filter ? strdup(extra_filter) : NULL;
+
+    while (running && fgets(line, sizeof(line), stdin)) {
+        line[strcspn(line, "\r\n")] = 0;
+        if (strncmp(line, "ports", 5) == 0 && (line[5] == ' ' || line[5] == 0)) {
+            const char *list = line[5] ? line + 6 : "";
+            if (*list == 0) nports = 0;
+            else parse_ports(list, ports, &nports);
+        } else if (strncmp(line, "filter", 6) == 0 && (line[6] == ' ' || line[6] == 0)) {
+            free(extra);
+            extra = line[6] && line[7] ? strdup(line + 7) : NULL;
+        } else if (strcmp(line, "apply") == 0) {
+            char *exp = build_filter(ports, nports, extra);
+            if (!exp) continue;
+            pcap_t *dead = pcap_open_dead(DLT_EN10MB, snaplen);
+            struct bpf_program fp;
+            if (!dead || pcap_compile(dead, &fp, exp, 0, PCAP_NETMASK_UNKNOWN) == -1) {
+                fprintf(stderr, "Rejected capture filter '%s': %s\n", exp, dead ? pcap_geterr(dead) : "pcap_open_dead failed");
+                free(exp);
+            } else {
+                pcap_freecode(&fp);
+                pthread_mutex_lock(&filter_lock);
+                free(filter_exp);
+                filter_exp = exp;
+                __atomic_store_n(&filter_gen, filter_gen + 1, __ATOMIC_RELEASE);
+                pthread_mutex_unlock(&filter_lock);
+                fprintf(stderr, "Capture filter: %s\n", exp);
+            }
+            if (dead) pcap_close(dead);
+        } else if (*line) {
+            fprintf(stderr, "Unknown control command: %s\n", line);
+        }
+    }
+    free(extra);
+    return NULL;
+}
+
+static int interface_allowed(const char *name) {
+    if (num_allowed_ifaces == 0) return 1;
+    for (int i = 0; i < num_allowed_ifaces; i++)
+        if (strcmp(allowed_ifaces[i], name) == 0) return 1;
+    return 0;
+}
+
+static void handle_signal(int sig) {
+    (void)sig;
+    running = 0;
+}
+
+static void usage(const char *prog) {
+    fprintf(stderr,
+            "Usage: %s [options]\n"
+            "  --flows                  aggregate packets into flow records\n"
+            "  --flow-table-size N      max concurrent flows per interface (default %d)\n"
+            "  --flow-idle-timeout S    emit a flow after S idle seconds (default %d)\n"
+            "  --flow-active-timeout S  emit long-lived flows every S seconds (default %d)\n"
+            "  --binary                 write fixed-size binary records instead of JSON lines\n"
+            "  --ports P1,P2,...        TCP ports to capture (default: all TCP)\n"
+            "  --filter EXPR            extra BPF expression ANDed into the capture filter\n"
+            "  --interface IF           capture only on IF (repeatable; default: all up interfaces)\n"
+            "  --snaplen N              bytes captured per packet, at least 64 (default %d, headers only;\n"
+            "                           packets cut short before the TCP flags are skipped)\n"
+            "  --buffer-size N          kernel capture buffer in bytes (default: libpcap's)\n"
+            "  --immediate              deliver packets immediately instead of per buffer\n"
+            "  --promisc                put interfaces into promiscuous mode\n"
+            "  --stats-interval S       report pcap_stats every S seconds, 0 disables (default %d)\n"
+            "  --control                accept filter updates on stdin (ports/filter/apply lines)\n",
+            prog, flow_table_size, flow_idle_timeout, flow_active_timeout, snaplen, stats_interval);
+}
+
+int main(int argc, char **argv) {
+    static struct option long_opts[] = {
+        {"flows",               no_argument,       0, 'f'},
+        {"flow-table-size",     required_argument, 0, 's'},
+        {"flow-idle-timeout",   required_argument, 0, 'i'},
+        {"flow-active-timeout", required_argument, 0, 'a'},
+        {"binary",              no_argument,       0, 'b'},
+        {"ports",               required_argument, 0, 'p'},
+        {"filter",              required_argument, 0, 'F'},
+        {"interface",           required_argument, 0, 'I'},
+        {"snaplen",             required_argument, 0, 'S'},
+        {"buffer-size",         required_argument, 0, 'B'},
+        {"immediate",           no_argument,       0, 'm'},
+        {"promisc",             no_argument,       0, 'P'},
+        {"stats-interval",      required_argument, 0, 'T'},
+        {"control",             no_argument,       0, 'C'},
+        {"help",                no_argument,       0, 'h'},
+        {0, 0, 0, 0}
+    };
+    int opt;
+    while ((opt = getopt_long(argc, argv, "fs:i:a:bp:F:I:S:B:mPT:Ch", long_opts, NULL)) != -1) {
+        switch (opt) {
+            case 'f': flow_mode = 1; break;
+            case 's': flow_table_size = atoi(optarg); break;
+            case 'i': flow_idle_timeout = atoi(optarg); break;
+            case 'a': flow_active_timeout = atoi(optarg); break;
+            case 'b': binary_output = 1; break;
+            case 'p': if (parse_ports(optarg, monitored_ports, &num_ports) == -1) return 2; break;
+            case 'F': extra_filter = optarg; break;
+            case 'I':
+                if (num_allowed_ifaces >= MAX_INTERFACES) { fprintf(stderr, "Too many interfaces\n"); return 2; }
+                allowed_ifaces[num_allowed_ifaces++] = optarg;
+                break;
+            case 'S': snaplen = atoi(optarg); break;
+            case 'B': buffer_size = atoi(optarg); break;
+            case 'm': immediate_mode = 1; break;
+            case 'P': promisc = 1; break;
+            case 'T': stats_interval = atoi(optarg); break;
+            case 'C': control_mode = 1; break;
+            default:  usage(argv[0]); return opt == 'h' ? 0 : 2;
+        }
+    }
+    if (flow_table_size < 1 || flow_idle_timeout < 1 || flow_active_timeout < 1) {
+        fprintf(stderr, "Flow table size and timeouts must be positive\n");
+        return 2;
+    }
+    if (snaplen < 64 || stats_interval < 0) {
+        fprintf(stderr, "Snaplen must be at least 64 and stats interval non-negative\n");
+        return 2;
+    }
+    filter_exp = build_filter(monitored_ports, num_ports, extra_filter);
+    if (!filter_exp) return 1;
+    fprintf(stderr, "Capture filter: %s\n", filter_exp);
+
+    struct sigaction sa;
+    memset(&sa, 0, sizeof(sa));
+    sa.sa_handler = handle_signal;
+    sigaction(SIGINT, &sa, NULL);
+    sigaction(SIGTERM, &sa, NULL);
+
     pcap_if_t *alldevs, *d;
     char errbuf[PCAP_ERRBUF_SIZE];
 
@@ -107,21 +664,29 @@ int main() {
         return 1;
     }
 
-    pthread_t threads[64];
+    pthread_t threads[MAX_INTERFACES];
     int idx = 0;
 
     // Only monitor active interfaces
-    for (d = alldevs; d != NULL; d = d->next) {
+    for (d = alldevs; d != NULL && idx < MAX_INTERFACES; d = d->next) {
         if (!(d->flags & PCAP_IF_UP)) continue;
+        if (!interface_allowed(d->name)) continue;
 
-        interface_arg *iarg = malloc(sizeof(interface_arg));
+        interface_arg *iarg = calloc(1, sizeof(interface_arg));
         iarg->dev = strdup(d->name);
 
         pthread_create(&threads[idx++], NULL, monitor_interface, iarg);
     }
 
+    if (control_mode) {
+        pthread_t control;
+        if (pthread_create(&control, NULL, control_loop, NULL) == 0)
+            pthread_detach(control);  // blocked in fgets at exit; nothing to clean up
+    }
+
     for (int i = 0; i < idx; i++) pthread_join(threads[i], NULL);
 
     pcap_freealldevs(alldevs);
+    free(filter_exp);
     return 0;
 }
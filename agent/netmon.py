@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+import socket
+import struct
+from datetime import datetime, timezone
+
+# Must match netmon_record in net-mon-libpcap/network_monitor.c
+RECORD = struct.Struct("=BBBxIIIHHIQQQ")
+REC_PACKET = 1
+REC_FLOW = 2
+REC_STATS = 3  # packets = ps_recv, bytes = ps_drop, first_ns = ps_ifdrop, last_ns = report time
+END_REASONS = ("", "end", "idle", "active", "overflow", "shutdown")
+TCP_FLAG_NAMES = "FSRPAU"
+
+_ifnames = {}
+
+
+def interface_name(ifindex: int) -> str:
+    name = _ifnames.get(ifindex)
+    if name is None:
+        try:
+            name = socket.if_indextoname(ifindex)
+        except OSError:
+            name = str(ifindex)
+        _ifnames[ifindex] = name
+    return name
+
+
+def ip_str(addr: int) -> str:
+    return socket.inet_ntoa(addr.to_bytes(4, "big"))
+
+
+def ns_iso(ns: int) -> str:
+    return datetime.fromtimestamp(ns / 1e9, timezone.utc).isoformat()
+
+
+def tcp_flags_str(flags: int) -> str:
+    return "".join(name for bit, name in enumerate(TCP_FLAG_NAMES) if flags & (1 << bit))
+
+
+def decode_records(buf):
+    """
+    Decode every complete record in `buf` (bytes, bytearray or memoryview).
+    Returns (list of event field dicts, number of bytes consumed); the
+    caller keeps the unconsumed tail for the next read.
+    """
+    usable = len(buf) - len(buf) % RECORD.size
+    events = []
+    for kind, flags, reason, ifindex, src, dst, sport, dport, packets, nbytes, first_ns, last_ns in \
+            RECORD.iter_unpack(memoryview(buf)[:usable]):
+        if kind == REC_STATS:
+            events.append({
+                "record": "stats",
+                "interface": interface_name(ifindex),
+                "received": packets,
+                "dropped": nbytes,
+                "if_dropped": first_ns,
+                "reported_at": ns_iso(last_ns),
+            })
+            continue
+        fields = {
+            "interface": interface_name(ifindex),
+            "src_ip": ip_str(src),
+            "dst_ip": ip_str(dst),
+            "src_port": sport,
+            "dst_port": dport,
+        }
+        if kind == REC_FLOW:
+            fields.update({
+                "record": "flow",
+                "protocol": "tcp",
+                "packets": packets,
+                "bytes": nbytes,
+                "tcp_flags": tcp_flags_str(flags),
+                "first_seen": ns_iso(first_ns),
+                "last_seen": ns_iso(last_ns),
+                "end_reason": END_REASONS[reason] if reason < len(END_REASONS) else str(reason),
+            })
+        else:
+            fields["packet_size"] = nbytes
+        events.append(fields)
+    return events, usable
@@ -1,61 +1,99 @@
 #!/usr/bin/env python3
+"""
+Build agent bundles (ids_agent_<device_id>.tar.xz).
+
+    python3 package_agent.py
+        Interactive: asks for one device, as before.
+
+    python3 package_agent.py --inventory devices.csv|devices.yaml [--hub-url URL]
+                             [--out DIR] [--workers N] [--register [--secret TOKEN]]
+        Batch: one bundle per inventory device, built in parallel.
+
+CSV inventories have a header row with device_id and optionally
+device_name, hub_url, api_key; any other column is a dotted agent.yaml
+key whose cell is parsed as YAML (e.g. "network_monitor.ports" = "[22, 443]").
+YAML inventories are {"defaults": {...}, "devices": [{...}, ...]} with
+agent.yaml fragments merged over the defaults.
+
+net_mon.bin is compiled once per network_monitor.c source hash and
+cached under .build_cache/. The files every device shares are packed and
+xz-compressed once; each bundle is that stream plus a small second xz
+stream holding only the device's agent.yaml (tar and xz both read the
+concatenation as one archive).
+"""
+import argparse
+import copy
+import csv
+import hashlib
+import io
+import lzma
 import os
+import re
 import subprocess
 import tarfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import shutil
 import yaml
 
-# === Inputs ===
-hub_url = input("Enter Hub URL (e.g. http://10.0.0.1:5000): ").strip()
-device_name = input("Enter Device Name: ").strip()
-device_id = input(f"Enter Device ID (default {device_name}-NODE): ").strip()
-device_id = device_id or f"{device_name}-NODE"
-
 # === Paths ===
 SRC_DIR = Path(__file__).parent
 BUILD_DIR = SRC_DIR / "agent_build"
-TAR_FILE = SRC_DIR / f"ids_agent_{device_id}.tar.xz"
-
-# === Clean build dir ===
-if BUILD_DIR.exists():
-    shutil.rmtree(BUILD_DIR)
-BUILD_DIR.mkdir()
-
-# === Copy Python agent files ===
-AGENT_FILES = ["daemon.py", "gui.py", "helper.py", "client.py"]
-for f in AGENT_FILES:
-    shutil.copy(SRC_DIR / f, BUILD_DIR / f)
-
-# === Create events dir ===
-(BUILD_DIR / "events").mkdir()
-
-# === Create agent.yaml ===
-agent_yaml = {
-    "hub_url": hub_url,
-    "device_id": device_id,
-    "device_name": device_name,
-    "api_key": "",
-    "file_monitor": {"enabled": False, "paths": []},
-    "network_monitor": {"enabled": True, "ports": []},
-}
-
-with open(BUILD_DIR / "agent.yaml", "w") as f:
-    yaml.safe_dump(agent_yaml, f)
-
-# === Compile C network monitor ===
-net_c = SRC_DIR / "net-mon-libpcap" / "network_monitor.c"
-net_bin = BUILD_DIR / "net_mon.bin"
-
-if not net_c.exists():
-    raise FileNotFoundError(f"{net_c} not found!")
-
-subprocess.run(["gcc", "-O2", "-Wall", "-o", str(net_bin), str(net_c), "-lpcap"], check=True)
-print("[*] Compiled network_monitor.c -> net_mon.bin")
-
-# === Write bootstrap script (install.sh inside tar) ===
-bootstrap = BUILD_DIR / "install.sh"
-bootstrap.write_text(f"""#!/usr/bin/env bash
+CACHE_DIR = SRC_DIR / ".build_cache"
+NET_MON_SRC = SRC_DIR / "net-mon-libpcap" / "network_monitor.c"
+GCC_FLAGS = ["-O2", "-Wall"]
+
+AGENT_FILES = ["daemon.py", "gui.py", "helper.py", "client.py", "spool.py", "retry.py", "pathindex.py", "filewatch.py", "hashing.py", "coalesce.py", "netmon.py", "fanotify.py", "procinfo.py", "metrics.py", "eventid.py", "eventmodel.py", "logmodel.py"]
+DEVICE_ID_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+
+# === Default agent.yaml ===
+def default_agent_yaml(hub_url, device_id, device_name, api_key=""):
+    return {
+        "hub_url": hub_url,
+        "device_id": device_id,
+        "device_name": device_name,
+        "api_key": api_key,
+        "file_monitor": {
+            "enabled": False, "paths": [], "include": [],
+            "exclude": ["*.swp", "*.swx", "*~", "*.tmp", ".git/", "node_modules/", "__pycache__/"],
+            "coalesce_window": 0.5, "coalesce_max_wait": 5.0, "backend": "auto",
+        },
+        "network_monitor": {
+            "enabled": True, "ports": [22, 80], "bpf_filter": "", "interfaces": [],
+            "flow_mode": True, "flow_table_size": 65536, "flow_idle_timeout": 30, "flow_active_timeout": 300,
+            "output": "binary",
+            "snaplen": 128, "buffer_size": 0, "immediate": False, "promisc": False, "stats_interval": 10,
+        },
+        "file_hashing": {
+            "enabled": False, "algorithm": "sha256", "max_bytes": 67108864, "workers": 2,
+            "max_pending": 1000, "cache_entries": 65536,
+        },
+        "process_attribution": {"enabled": True, "fanotify": True, "ttl": 30.0, "max_entries": 65536, "min_refresh": 1.0},
+        "sender": {
+            "batch_max_events": 200, "batch_max_bytes": 262144, "batch_max_delay": 1.0, "concurrency": 4,
+            "retry_base_delay": 1.0, "retry_max_delay": 300.0, "breaker_threshold": 5, "breaker_cooldown": 10.0,
+            "max_rejected_attempts": 5, "dead_letter_max_bytes": 67108864,
+        },
+        "spool": {"segment_bytes": 4194304, "max_bytes": 268435456, "fsync": False},
+        "runtime": {"queue_size": 10000, "shutdown_timeout": 10.0, "json_backend": "auto", "log_events": True,
+                    "config_poll_interval": 2.0},
+        "metrics": {"listen": "127.0.0.1:9108", "health_interval": 60},
+        "registration": {"secret_token": "super-secret-token", "timeout": 10.0},
+    }
+
+def merge(base: dict, override: dict) -> dict:
+    """Recursive dict merge; lists and scalars in `override` replace those in `base`."""
+    out = copy.deepcopy(base)
+    for key, value in (override or {}).items():
+        if isinstance(value, dict) and isinstance(out.get(key), dict):
+            out[key] = merge(out[key], value)
+        else:
+            out[key] = copy.deepcopy(value)
+    return out
+
+# === Bootstrap script (install.sh inside tar) ===
+INSTALL_SH = """#!/usr/bin/env bash
 set -e
 echo "[*] Setting up Python venv..."
 python3 -m venv .venv
@@ -97,17 +135,233 @@ Categories=Utility;Security;
 EOF
 
 echo "=== IDS Agent Setup Complete ==="
-""")
-bootstrap.chmod(0o755)
+"""
+
+# === net_mon.bin, compiled once per source ===
+def net_mon_source_hash():
+    h = hashlib.sha256()
+    h.update(NET_MON_SRC.read_bytes())
+    h.update(" ".join(GCC_FLAGS).encode())
+    return h.hexdigest()[:16]
+
+def build_net_mon():
+    """Return the cached net_mon.bin for the current source, compiling it if needed."""
+    if not NET_MON_SRC.exists():
+        raise FileNotFoundError(f"{NET_MON_SRC} not found!")
+    CACHE_DIR.mkdir(exist_ok=True)
+    cached = CACHE_DIR / f"net_mon-{net_mon_source_hash()}.bin"
+    if cached.exists():
+        print(f"[*] Reusing {cached.name}")
+        return cached
+    tmp = cached.with_suffix(f".tmp{os.getpid()}")
+    subprocess.run(["gcc", *GCC_FLAGS, "-o", str(tmp), str(NET_MON_SRC), "-lpcap"], check=True)
+    os.replace(tmp, cached)
+    print(f"[*] Compiled network_monitor.c -> {cached.name}")
+    return cached
+
+# === Bundles ===
+def shared_files(net_mon):
+    """(archive name, source path) of every file that is the same on all devices."""
+    files = [(f, SRC_DIR / f) for f in AGENT_FILES]
+    files.append(("net_mon.bin", net_mon))
+    req = SRC_DIR / "requirements.txt"
+    if req.exists():
+        files.append(("requirements.txt", req))
+    return files
+
+def _tar_bytes(tar, name, data, mode=0o644):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+def build_shared_stream(net_mon) -> bytes:
+    """The shared part of every bundle: tar members without the end-of-archive blocks, xz-compressed."""
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode="w", format=tarfile.GNU_FORMAT)
+    info = tarfile.TarInfo("./events")
+    info.type, info.mode, info.mtime = tarfile.DIRTYPE, 0o755, int(time.time())
+    tar.addfile(info)
+    for name, path in shared_files(net_mon):
+        tar.add(path, arcname=f"./{name}")
+    _tar_bytes(tar, "./install.sh", INSTALL_SH.encode("utf-8"), mode=0o755)
+    members = buf.getvalue()  # read before close(), which would append the end-of-archive blocks
+    return lzma.compress(members, preset=6)
+
+def device_stream(agent_yaml: dict) -> bytes:
+    """The per-device part: agent.yaml plus the end-of-archive blocks, as its own xz stream."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w", format=tarfile.GNU_FORMAT) as tar:
+        _tar_bytes(tar, "./agent.yaml", yaml.safe_dump(agent_yaml).encode("utf-8"), mode=0o600)
+    return lzma.compress(buf.getvalue(), preset=6)
+
+def bundle_path(out_dir, device_id):
+    return Path(out_dir) / f"ids_agent_{device_id}.tar.xz"
+
+_SHARED = None  # compressed shared stream, loaded once per worker process
+
+def _set_shared(data):
+    global _SHARED
+    _SHARED = data
+
+def _init_worker(shared_path):
+    _set_shared(Path(shared_path).read_bytes())
+
+def _write_bundle(args):
+    out_dir, agent_yaml = args
+    target = bundle_path(out_dir, agent_yaml["device_id"])
+    tmp = target.with_suffix(f".tmp{os.getpid()}")
+    with open(tmp, "wb") as f:
+        f.write(_SHARED)
+        f.write(device_stream(agent_yaml))
+    os.replace(tmp, target)
+    return str(target)
+
+# === Inventory ===
+def load_inventory(path, hub_url=None):
+    """Inventory file -> list of complete agent.yaml dicts, one per device."""
+    path = Path(path)
+    defaults, entries = {}, []
+    if path.suffix.lower() in (".yaml", ".yml"):
+        data = yaml.safe_load(path.read_text()) or {}
+        if isinstance(data, list):
+            data = {"devices": data}
+        defaults = data.get("defaults", {}) or {}
+        entries = data.get("devices", []) or []
+    else:
+        with open(path, newline="") as f:
+            for row in csv.DictReader(f):
+                entry = {}
+                for column, cell in row.items():
+                    if column is None or cell is None or cell.strip() == "":
+                        continue
+                    column = column.strip()
+                    if column in ("device_id", "device_name", "hub_url", "api_key"):
+                        entry[column] = cell.strip()
+                        continue
+                    node = entry
+                    *parents, leaf = column.split(".")
+                    for key in parents:
+                        node = node.setdefault(key, {})
+                    node[leaf] = yaml.safe_load(cell)
+                entries.append(entry)
+
+    devices, seen = [], set()
+    for entry in entries:
+        device_id = str(entry.get("device_id", "")).strip()
+        if not DEVICE_ID_RE.match(device_id):
+            raise ValueError(f"Invalid or missing device_id in inventory entry: {entry}")
+        if device_id in seen:
+            raise ValueError(f"Duplicate device_id in inventory: {device_id}")
+        seen.add(device_id)
+        device_name = str(entry.get("device_name") or device_id)
+        url = entry.get("hub_url") or defaults.get("hub_url") or hub_url
+        if not url:
+            raise ValueError(f"No hub_url for {device_id}; add a column/default or pass --hub-url")
+        agent_yaml = merge(default_agent_yaml(url, device_id, device_name), defaults)
+        agent_yaml = merge(agent_yaml, entry)
+        agent_yaml.update({"hub_url": url, "device_id": device_id, "device_name": device_name})
+        devices.append(agent_yaml)
+    return devices
+
+# === Bulk registration ===
+def register_devices(devices, secret, chunk=200, timeout=30):
+    """Ask each hub for API keys of the devices without one, `chunk` devices per request."""
+    import requests  # only needed with --register
+
+    by_hub = {}
+    for agent_yaml in devices:
+        if not agent_yaml.get("api_key"):
+            by_hub.setdefault(agent_yaml["hub_url"].rstrip("/"), []).append(agent_yaml)
+    for hub, pending in by_hub.items():
+        for start in range(0, len(pending), chunk):
+            batch = pending[start:start + chunk]
+            resp = requests.post(
+                f"{hub}/api/devices/bulk",
+                json=[{"device_id": d["device_id"], "name": d["device_name"]} for d in batch],
+                headers={"X-Internal-Auth": secret, "Content-Type": "application/json"},
+                timeout=timeout,
+            )
+            resp.raise_for_status()
+            results = {r["device_id"]: r for r in resp.json().get("results", [])}
+            for agent_yaml in batch:
+                result = results.get(agent_yaml["device_id"], {})
+                if result.get("api_key"):
+                    agent_yaml["api_key"] = result["api_key"]
+                elif result.get("status") == "exists":
+                    # The hub never hands out the key of an existing device
+                    print(f"[!] {agent_yaml['device_id']} is already registered with {hub}; "
+                          f"put its api_key in the inventory or delete it on the hub first")
+                else:
+                    print(f"[!] {hub} returned no API key for {agent_yaml['device_id']}; "
+                          f"it will register itself on first start")
+        registered = sum(1 for d in pending if d.get("api_key"))
+        print(f"[*] Registered {registered}/{len(pending)} devices with {hub}")
+
+# === Modes ===
+def build_batch(args):
+    devices = load_inventory(args.inventory, args.hub_url)
+    print(f"[*] {len(devices)} devices in {args.inventory}")
+    if args.register:
+        register_devices(devices, args.secret)
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    started = time.monotonic()
+    net_mon = build_net_mon()
+    shared = out_dir / ".shared.tar.xz"
+    shared.write_bytes(build_shared_stream(net_mon))
+    try:
+        with ProcessPoolExecutor(args.workers, initializer=_init_worker, initargs=(str(shared),)) as pool:
+            for n, _ in enumerate(pool.map(_write_bundle, [(str(out_dir), d) for d in devices], chunksize=16), 1):
+                if n % 100 == 0 or n == len(devices):
+                    print(f"[*] {n}/{len(devices)} bundles written")
+    finally:
+        shared.unlink(missing_ok=True)
+    print(f"[*] Created {len(devices)} bundles in {out_dir} ({time.monotonic() - started:.1f}s)")
+    print("[*] Distribute each tar.xz to its node. Extract and run ./install.sh")
+
+def build_interactive():
+    hub_url = input("Enter Hub URL (e.g. http://10.0.0.1:5000): ").strip()
+    device_name = input("Enter Device Name: ").strip()
+    device_id = input(f"Enter Device ID (default {device_name}-NODE): ").strip()
+    device_id = device_id or f"{device_name}-NODE"
+    agent_yaml = default_agent_yaml(hub_url, device_id, device_name)
+    net_mon = build_net_mon()
+
+    # === Unpacked copy in agent_build/ ===
+    if BUILD_DIR.exists():
+        shutil.rmtree(BUILD_DIR)
+    BUILD_DIR.mkdir()
+    (BUILD_DIR / "events").mkdir()
+    for name, path in shared_files(net_mon):
+        shutil.copy(path, BUILD_DIR / name)
+    (BUILD_DIR / "install.sh").write_text(INSTALL_SH)
+    (BUILD_DIR / "install.sh").chmod(0o755)
+    with open(BUILD_DIR / "agent.yaml", "w") as f:
+        yaml.safe_dump(agent_yaml, f)
 
-# === Copy requirements.txt if exists ===
-req = SRC_DIR / "requirements.txt"
-if req.exists():
-    shutil.copy(req, BUILD_DIR / "requirements.txt")
+    # === Create tar.xz ===
+    _set_shared(build_shared_stream(net_mon))
+    tar_file = _write_bundle((str(SRC_DIR), agent_yaml))
+    print(f"[*] Created {tar_file}")
+    print("[*] Distribute this tar.xz to a new node. Extract and run ./install.sh")
 
-# === Create tar.xz ===
-with tarfile.open(TAR_FILE, "w:xz") as tar:
-    tar.add(BUILD_DIR, arcname=".")
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--inventory", help="CSV or YAML device inventory (batch mode)")
+    parser.add_argument("--hub-url", help="hub URL for devices that do not set one")
+    parser.add_argument("--out", default=str(SRC_DIR / "bundles"), help="output directory for batch bundles")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="bundle writer processes")
+    parser.add_argument("--register", action="store_true", help="get API keys from the hub in bulk before packaging")
+    parser.add_argument("--secret", default=os.getenv("INTERNAL_SECRET", "super-secret-token"),
+                        help="X-Internal-Auth secret for --register (default $INTERNAL_SECRET)")
+    args = parser.parse_args()
+    if args.inventory:
+        build_batch(args)
+    else:
+        build_interactive()
 
-print(f"[*] Created {TAR_FILE}")
-print("[*] Distribute this tar.xz to a new node. Extract and run ./install.sh")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import os
+import re
+from pathlib import Path
+
+_END = None  # trie key marking "a watched root ends here"
+
+
+def glob_to_regex(pattern: str) -> str:
+    """
+    Translate one include/exclude glob into a regex searched against a path.
+
+        *.swp          any file or directory component named like this
+        node_modules/  a directory component (everything below it)
+        build/*.o      a relative path, anchored at a component boundary
+        /var/log/*.gz  an absolute path prefix
+
+    `*` and `?` never cross a `/`; `**` does.
+    """
+    dir_only = pattern.endswith("/")
+    body = pattern.rstrip("/")
+    anchored = body.startswith("/")
+
+    core = []
+    i = 0
+    while i < len(body):
+        c = body[i]
+        if body.startswith("**", i):
+            core.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            core.append("[^/]*")
+        elif c == "?":
+            core.append("[^/]")
+        elif c == "[":
+            end = body.find("]", i + 1)
+            if end == -1:
+                core.append(re.escape(c))
+            else:
+                cls = body[i + 1:end]
+                if cls.startswith("!"):
+                    cls = "^" + cls[1:]
+                core.append(f"[{cls}]")
+                i = end
+        else:
+            core.append(re.escape(c))
+        i += 1
+
+    prefix = "^" if anchored else "(?:^|/)"
+    suffix = "/" if dir_only else "(?:/|\\Z)"
+    return prefix + "".join(core) + suffix
+
+
+def compile_globs(patterns):
+    """Combine a list of globs into one compiled regex (None if empty)."""
+    patterns = [p for p in (patterns or []) if p]
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{glob_to_regex(p)})" for p in patterns))
+
+
+class PathFilter:
+    """
+    Decides whether a file event path is worth turning into an event.
+
+    Watched roots are resolved once at startup and stored, both as written
+    and as their realpath, in a trie keyed on path components, so checking
+    an event path is a walk over its components with no syscalls.
+    Include/exclude globs are compiled into one regex each; exclude wins.
+    """
+
+    def __init__(self, roots=(), include=None, exclude=None):
+        self.trie = {}
+        self.roots = []
+        for root in roots:
+            self.add_root(root)
+        self.include = compile_globs(include)
+        self.exclude = compile_globs(exclude)
+
+    def add_root(self, root):
+        root = Path(root)
+        for variant in {os.path.abspath(root), os.path.realpath(root)}:
+            node = self.trie
+            for part in variant.split("/"):
+                if part:
+                    node = node.setdefault(part, {})
+            node[_END] = True
+        self.roots.append(root)
+
+    def under_root(self, path: str) -> bool:
+        if not self.roots:
+            return True
+        node = self.trie
+        if _END in node:
+            return True
+        for part in path.split("/"):
+            if not part or part == ".":
+                continue
+            node = node.get(part)
+            if node is None:
+                return False
+            if _END in node:
+                return True
+        return False
+
+    def excludes_dir(self, path: str) -> bool:
+        """
+        True when nothing below directory `path` can match, so a watcher
+        can skip the whole subtree instead of watching it. Only exclude
+        globs prune; an include glob may still match deeper down.
+        """
+        return self.exclude is not None and self.exclude.search(os.path.normpath(path) + "/") is not None
+
+    def match(self, path: str) -> bool:
+        path = os.path.normpath(path)
+        if self.exclude is not None and self.exclude.search(path):
+            return False
+        if self.include is not None and not self.include.search(path):
+            return False
+        return self.under_root(path)
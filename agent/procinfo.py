@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+import os
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from fanotify import FanotifyWatcher
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, max_entries=65536, ttl=30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None, now=None):
+        entry = self.data.get(key, _MISSING)
+        if entry is not _MISSING:
+            now = time.monotonic() if now is None else now
+            if entry[0] > now:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value, ttl=None, now=None):
+        now = time.monotonic() if now is None else now
+        self.data[key] = (now + (self.ttl if ttl is None else ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_entries:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self.data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def __len__(self):
+        return len(self.data)
+
+
+# === /proc parsing ===
+def _hex_ipv4(hex_addr: str):
+    """Decode a /proc/net/tcp{,6} address; IPv6 is only kept when IPv4-mapped."""
+    if len(hex_addr) == 8:
+        return socket.inet_ntoa(struct.pack("<I", int(hex_addr, 16)))
+    if len(hex_addr) == 32 and hex_addr[:24].upper() == "0000000000000000FFFF0000":
+        return socket.inet_ntoa(struct.pack("<I", int(hex_addr[24:], 16)))
+    return None
+
+
+def read_tcp_table(proc_root="/proc"):
+    """Return {(local_ip, local_port, remote_ip, remote_port): socket inode}."""
+    table = {}
+    for name in ("tcp", "tcp6"):
+        try:
+            with open(f"{proc_root}/net/{name}") as f:
+                next(f, None)  # header
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 10:
+                        continue
+                    local, remote, inode = fields[1], fields[2], int(fields[9])
+                    if inode == 0:
+                        continue
+                    l_ip, l_port = local.split(":")
+                    r_ip, r_port = remote.split(":")
+                    l_ip, r_ip = _hex_ipv4(l_ip), _hex_ipv4(r_ip)
+                    if l_ip is None or r_ip is None:
+                        continue
+                    table[(l_ip, int(l_port, 16), r_ip, int(r_port, 16))] = inode
+        except OSError:
+            continue
+    return table
+
+
+def socket_inodes(pid, proc_root="/proc"):
+    inodes = set()
+    fd_dir = f"{proc_root}/{pid}/fd"
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return inodes
+    for fd in fds:
+        try:
+            target = os.readlink(f"{fd_dir}/{fd}")
+        except OSError:
+            continue
+        if target.startswith("socket:["):
+            inodes.add(int(target[8:-1]))
+    return inodes
+
+
+class ProcessCache:
+    """
+    Attributes connections and pids to processes without a /proc scan per event.
+
+    Connection lookups are served from an LRU/TTL cache. A miss re-reads
+    /proc/net/tcp{,6} and scans the fd tables of pids that are new or whose
+    last scan is older than `ttl`, at most once per `min_refresh` seconds.
+    A socket inode no scanned process owns (opened since its owner was
+    scanned) triggers a rescan that stops at the first pid holding it; an
+    inode that stays unowned (another user's or network namespace's
+    socket) is backed off from `negative_ttl` up to `ttl` seconds before
+    it is searched for again. Unattributable connections are cached as
+    unknown for `negative_ttl` seconds.
+
+    Lookups that miss read /proc and may take a while on a busy host;
+    callers on an event loop use peek_connection()/peek_pid() and run
+    misses in an executor. /proc is read outside `lock`, so peeks never
+    wait for a scan: scans work on a snapshot of the pid table and publish
+    what they found under the lock.
+    """
+
+    def __init__(self, ttl=30.0, max_entries=65536, min_refresh=1.0, negative_ttl=5.0, proc_root="/proc"):
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self.negative_ttl = negative_ttl
+        self.proc_root = proc_root
+        self.connections = TTLCache(max_entries, ttl)   # conn key -> process info or None
+        self.processes = TTLCache(max_entries, ttl)     # pid -> process info
+        self.pid_scans = {}   # pid -> (scanned_at, set of socket inodes)
+        self.inode_pid = {}   # socket inode -> pid
+        self.unowned = TTLCache(max_entries, ttl * 10)  # socket inode -> (retry_at, attempts)
+        self.tcp_table = {}
+        self.last_refresh = 0.0
+        self.refreshes = 0
+        self.owner_rescans = 0
+        self.lock = threading.Lock()
+
+    def peek_pid(self, pid):
+        """(True, info) for a cached pid without touching /proc, or (False, None) on a miss."""
+        with self.lock:
+            info = self.processes.get(pid, _MISSING)
+        return (False, None) if info is _MISSING else (True, info)
+
+    def process_for_pid(self, pid):
+        if pid is None:
+            return None
+        hit, info = self.peek_pid(pid)
+        if hit:
+            return info
+        try:
+            with open(f"{self.proc_root}/{pid}/comm") as f:
+                name = f.read().strip()
+        except OSError:
+            name = "unknown"
+        info = {"pid": pid, "name": name}
+        with self.lock:
+            self.processes.put(pid, info)
+        return info
+
+    # The helpers below only touch the maps and need self.lock; /proc is
+    # read without it
+    def _forget_pid(self, pid):
+        for inode in self.pid_scans.pop(pid, (0.0, ()))[1]:
+            if self.inode_pid.get(inode) == pid:
+                del self.inode_pid[inode]
+
+    def _store_scan(self, pid, inodes, now):
+        self._forget_pid(pid)
+        self.pid_scans[pid] = (now, inodes)
+        for inode in inodes:
+            self.inode_pid[inode] = pid
+
+    def _refresh(self, now):
+        with self.lock:
+            self.last_refresh = now
+            self.refreshes += 1
+            scanned_at = {pid: scan[0] for pid, scan in self.pid_scans.items()}
+        tcp_table = read_tcp_table(self.proc_root)
+        try:
+            live = {int(d) for d in os.listdir(self.proc_root) if d.isdigit()}
+        except OSError:
+            live = None
+        # Incremental: only new pids and pids whose fd table has gone stale
+        scans = {}
+        for pid in live or ():
+            if pid not in scanned_at or now - scanned_at[pid] >= self.ttl:
+                scans[pid] = socket_inodes(pid, self.proc_root)
+        with self.lock:
+            self.tcp_table = tcp_table
+            if live is None:
+                return
+            for pid in set(self.pid_scans) - live:
+                self._forget_pid(pid)
+            for pid, inodes in scans.items():
+                self._store_scan(pid, inodes, now)
+
+    def _find_owner(self, inode, now):
+        """Rescan pids not scanned within `min_refresh` until one holds `inode`, with per-inode backoff."""
+        with self.lock:
+            retry_at, attempts = self.unowned.get(inode, (0.0, 0), now=now)
+            if now < retry_at:
+                return None
+            self.owner_rescans += 1
+            stale = [pid for pid, scan in self.pid_scans.items() if now - scan[0] >= self.min_refresh]
+        for pid in stale:
+            inodes = socket_inodes(pid, self.proc_root)
+            with self.lock:
+                self._store_scan(pid, inodes, now)
+                if inode in inodes:
+                    self.unowned.pop(inode)
+                    return pid
+        with self.lock:
+            backoff = min(self.negative_ttl * 2 ** attempts, self.ttl)
+            self.unowned.put(inode, (now + backoff, attempts + 1), now=now)
+        return None
+
+    def _socket_inode(self, key):
+        for k in (key, (key[2], key[3], key[0], key[1])):
+            inode = self.tcp_table.get(k)
+            if inode is not None:
+                return inode
+        return None
+
+    def _resolve(self, key):
+        return self.inode_pid.get(self._socket_inode(key))
+
+    def peek_connection(self, src_ip, src_port, dst_ip, dst_port):
+        """(True, info) from the cache without touching /proc, or (False, None) on a miss."""
+        with self.lock:
+            info = self.connections.get((src_ip, src_port, dst_ip, dst_port), _MISSING)
+        return (False, None) if info is _MISSING else (True, info)
+
+    def lookup_connection(self, src_ip, src_port, dst_ip, dst_port):
+        key = (src_ip, src_port, dst_ip, dst_port)
+        with self.lock:
+            info = self.connections.get(key, _MISSING)
+            if info is not _MISSING:
+                return info
+            pid = self._resolve(key)
+            now = time.monotonic()
+            refresh = pid is None and now - self.last_refresh >= self.min_refresh
+        if refresh:
+            self._refresh(now)
+            with self.lock:
+                pid = self._resolve(key)
+        if pid is None:
+            with self.lock:
+                inode = self._socket_inode(key)
+            if inode is not None:
+                pid = self._find_owner(inode, now)
+        info = self.process_for_pid(pid)
+        with self.lock:
+            if info is None:
+                self.connections.put(key, None, ttl=self.negative_ttl)
+            else:
+                self.connections.put(key, info)
+        return info
+
+
+class FileProcessTracker:
+    """
+    Remembers which process last wrote each path, fed by mount-level
+    fanotify events, so file events can be attributed with one lookup.
+    """
+
+    def __init__(self, process_cache, ttl=30.0, max_entries=65536):
+        self.process_cache = process_cache
+        self.writers = TTLCache(max_entries, ttl)
+        self.lock = threading.Lock()
+        self.watcher = None
+
+    def _on_event(self, path, pid, mask):
+        with self.lock:
+            self.writers.put(path, pid)
+
+    def start(self, roots, loop=None):
+        """Start listening on the mounts holding `roots`; False if fanotify is unavailable."""
+        try:
+            self.watcher = FanotifyWatcher(self._on_event)
+            for root in roots:
+                self.watcher.add_mount(root)
+        except (OSError, AttributeError) as e:
+            print(f"[WARNING] fanotify unavailable, file events will not be attributed: {e}", flush=True)
+            self.watcher = None
+            return False
+        self.watcher.start(loop)
+        return True
+
+    def stop(self):
+        """Stop listening and close the fanotify fd (from the loop thread when started on a loop)."""
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def add_root(self, root):
+        """Also listen on the mount holding `root` (no-op if fanotify is not running)."""
+        if self.watcher is None:
+            return
+        try:
+            self.watcher.add_mount(root)
+        except OSError as e:
+            print(f"[WARNING] fanotify cannot watch {root}: {e}", flush=True)
+
+    def writer(self, path):
+        """Pid that last wrote `path`, or None; never touches /proc."""
+        with self.lock:
+            return self.writers.get(path)
+
+    def lookup(self, path):
+        return self.process_cache.process_for_pid(self.writer(path))
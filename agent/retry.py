@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import requests
+
+# === Error classes ===
+TRANSIENT = "transient"   # connection error, timeout, 5xx: back off and retry
+THROTTLED = "throttled"   # 429 / 503: hub asked us to slow down, honor Retry-After
+REJECTED = "rejected"     # other 4xx: hub is up but refuses the request, retry a few times
+
+
+def parse_retry_after(value):
+    """Return a Retry-After header (seconds or HTTP-date) as seconds, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def classify(exc):
+    """
+    Map a send failure to (error class, retry_after seconds or None).
+    """
+    response = getattr(exc, "response", None)
+    if isinstance(exc, requests.exceptions.HTTPError) and response is not None:
+        status = response.status_code
+        if status in (429, 503):
+            return THROTTLED, parse_retry_after(response.headers.get("Retry-After"))
+        if status == 408 or status >= 500:
+            return TRANSIENT, None
+        return REJECTED, None
+    return TRANSIENT, None
+
+
+class RetryPolicy:
+    """
+    Capped exponential backoff with jitter.
+    The delay for attempt n is drawn from [d/2, d] with d = min(max_delay, base_delay * 2**n),
+    so agents that failed together do not retry together.
+    """
+
+    def __init__(self, base_delay=1.0, max_delay=300.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, kind, attempt, retry_after=None):
+        # Refused requests back off the same way: the sender gives up on them
+        # after a few attempts, so waiting the full max_delay would only stall
+        # their lane
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        delay = random.uniform(ceiling / 2, ceiling)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Hub-wide circuit breaker shared by all sender lanes.
+
+    closed    -> requests flow; consecutive failures are counted
+    open      -> after `failure_threshold` failures nobody sends until the
+                 cooldown (jittered, doubling up to `max_cooldown`) expires
+    half-open -> one probe request is let through; success closes the
+                 circuit, failure opens it again
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failure_threshold=5, cooldown=10.0, max_cooldown=300.0, probe_poll=0.5):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe_poll = probe_poll
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        Return 0 if the caller may send a request now, otherwise the number
+        of seconds to wait before asking again. Never blocks, so it can be
+        polled from an event loop.
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return 0
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now < self.open_until:
+                    return self.open_until - now
+                self.state = self.HALF_OPEN
+            if not self.probing:
+                self.probing = True
+                return 0
+            return self.probe_poll
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                print("[HUB] Circuit closed, hub reachable again", flush=True)
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+            self.cooldown = self.base_cooldown
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            elif self.failures < self.failure_threshold:
+                return
+            wait = self.cooldown * random.uniform(0.8, 1.2)
+            self.state = self.OPEN
+            self.open_until = time.monotonic() + wait
+            self.probing = False
+            print(f"[HUB] Circuit open after {self.failures} failures, pausing uploads for {wait:.1f}s", flush=True)
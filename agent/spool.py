@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+import bisect
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor.json"
+
+
+class Spool:
+    """
+    Segmented, append-only on-disk event queue.
+
+    Records are newline-terminated byte strings appended to the active
+    segment; once a segment reaches `segment_bytes` a new one is started.
+    `cursor.json` holds the position acknowledged by the hub so far, so a
+    restarted reader resumes right after the last delivered record.
+    Segments that lie wholly before the cursor are deleted on ack, and the
+    oldest segments are dropped (acked or not) if the spool grows past
+    `max_bytes`, which keeps disk use bounded during long hub outages.
+
+    A position is a (segment, byte offset) tuple.
+    """
+
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024,
+                 max_bytes=256 * 1024 * 1024, fsync=False):
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.cond = threading.Condition()
+        self.dropped_segments = 0
+
+        self.segments = sorted(int(p.stem) for p in self.dir.glob(f"*{SEGMENT_SUFFIX}"))
+        if not self.segments:
+            self.segments = [0]
+            self._segment_path(0).touch()
+        self._recover_tail()
+        self.sizes = {seg: self._segment_path(seg).stat().st_size for seg in self.segments}
+
+        self.acked = self._load_cursor()
+        self.read_pos = self.acked
+        self._read_fh = None
+        self._read_seg = None
+        self._read_eof = False
+
+        self._write_fh = self._segment_path(self.segments[-1]).open("ab")
+
+    # === Paths & persistence ===
+    def _segment_path(self, seg):
+        return self.dir / f"{seg:012d}{SEGMENT_SUFFIX}"
+
+    def _recover_tail(self):
+        """Cut a half-written record left behind by a crash off the last segment."""
+        path = self._segment_path(self.segments[-1])
+        data = path.read_bytes()
+        if data and not data.endswith(b"\n"):
+            with path.open("r+b") as f:
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def _load_cursor(self):
+        try:
+            cursor = json.loads((self.dir / CURSOR_FILE).read_text())
+            seg, off = int(cursor["segment"]), int(cursor["offset"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return (self.segments[0], 0)
+        if seg not in self.sizes:
+            # The acked segment is gone (dropped or compacted): resume at the
+            # first segment that still exists after it.
+            i = bisect.bisect_left(self.segments, seg)
+            return (self.segments[min(i, len(self.segments) - 1)], 0)
+        return (seg, min(off, self.sizes[seg]))
+
+    def _save_cursor(self):
+        tmp = self.dir / (CURSOR_FILE + ".tmp")
+        with tmp.open("w") as f:
+            json.dump({"segment": self.acked[0], "offset": self.acked[1]}, f)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, self.dir / CURSOR_FILE)
+
+    # === Writing ===
+    def append(self, record: bytes):
+        with self.cond:
+            if self.sizes[self.segments[-1]] >= self.segment_bytes:
+                self._rotate()
+            self._write_fh.write(record + b"\n")
+            self._write_fh.flush()
+            if self.fsync:
+                os.fsync(self._write_fh.fileno())
+            self.sizes[self.segments[-1]] += len(record) + 1
+            self._enforce_limit()
+            self.cond.notify_all()
+
+    def _rotate(self):
+        self._write_fh.close()
+        seg = self.segments[-1] + 1
+        self.segments.append(seg)
+        self.sizes[seg] = 0
+        self._write_fh = self._segment_path(seg).open("ab")
+
+    def _enforce_limit(self):
+        while len(self.segments) > 1 and sum(self.sizes.values()) > self.max_bytes:
+            seg = self.segments[0]
+            self._remove_segment(seg)
+            self.dropped_segments += 1
+            print(f"[WARNING] Spool {self.dir.name} over {self.max_bytes} bytes, dropped segment {seg}", flush=True)
+            if self.acked[0] <= seg:
+                self.acked = (self.segments[0], 0)
+                self._save_cursor()
+            if self.read_pos[0] <= seg:
+                self._seek((self.segments[0], 0))
+
+    def _remove_segment(self, seg):
+        if self._read_seg == seg:
+            self._read_fh.close()
+            self._read_fh = self._read_seg = None
+        self.segments.remove(seg)
+        del self.sizes[seg]
+        try:
+            self._segment_path(seg).unlink()
+        except FileNotFoundError:
+            pass
+
+    # === Reading ===
+    def _seek(self, pos):
+        if self._read_fh is not None:
+            self._read_fh.close()
+        self._read_fh = self._read_seg = None
+        self.read_pos = pos
+
+    def _read_one(self):
+        while True:
+            seg, off = self.read_pos
+            if self._read_seg != seg:
+                if self._read_fh is not None:
+                    self._read_fh.close()
+                self._read_fh = self._segment_path(seg).open("rb")
+                self._read_fh.seek(off)
+                self._read_seg = seg
+                self._read_eof = False
+            elif self._read_eof:
+                self._read_fh.seek(off)
+                self._read_eof = False
+
+            line = self._read_fh.readline()
+            if line.endswith(b"\n"):
+                self.read_pos = (seg, off + len(line))
+                return line[:-1]
+
+            self._read_eof = True
+            if seg == self.segments[-1]:
+                return None
+            # Older segment fully read: move on to the next one.
+            i = bisect.bisect_right(self.segments, seg)
+            self._seek((self.segments[i], 0))
+
+    def read_batch(self, max_records, max_bytes, max_delay, timeout=None):
+        """
+        Return (records, position) for the next unread records.
+        Blocks until at least one record is available (or `timeout` passes),
+        then waits up to `max_delay` seconds for the batch to fill up.
+        timeout=0 and max_delay=0 make it a non-blocking poll.
+        Records stay in the spool until ack(position) is called.
+        """
+        records = []
+        size = 0
+        deadline = None
+        give_up = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                while len(records) < max_records and size < max_bytes:
+                    record = self._read_one()
+                    if record is None:
+                        break
+                    records.append(record)
+                    size += len(record)
+                if len(records) >= max_records or size >= max_bytes:
+                    break
+                now = time.monotonic()
+                if records:
+                    if deadline is None:
+                        deadline = now + max_delay
+                    if now >= deadline:
+                        break
+                    self.cond.wait(deadline - now)
+                elif give_up is None:
+                    self.cond.wait()
+                elif now >= give_up:
+                    break
+                else:
+                    self.cond.wait(give_up - now)
+            return records, self.read_pos
+
+    def ack(self, position):
+        """Mark everything up to `position` delivered and delete spent segments."""
+        with self.cond:
+            if position[0] not in self.sizes:
+                return
+            self.acked = position
+            self._save_cursor()
+            for seg in [s for s in self.segments if s < position[0]]:
+                self._remove_segment(seg)
+
+    def pending_bytes(self):
+        with self.cond:
+            seg, off = self.acked
+            return sum(size for s, size in self.sizes.items() if s >= seg) - off
+
+    def close(self):
+        with self.cond:
+            self._write_fh.close()
+            self._seek(self.acked)
@@ -3,6 +3,8 @@ from flask import Flask
 from app.models import db
 from app.routes.events import events_bp
 from app.routes.devices import devices_bp
+from app.bulkindexer import create_indexer
+from app.ingestlog import create_ingest_log
 from elasticsearch import Elasticsearch
 import os
 
@@ -33,6 +35,15 @@ def create_app(config_path=None, template_folder=None):
         basic_auth=(es_user, es_pass)
     )
 
+    # Ingest writes go through one bulk indexer per process
+    app.bulk_indexer = create_indexer(app.elasticsearch)
+    # Durable log drained by the indexer workers (indexer.py) in "log" mode
+    app.ingest_log = create_ingest_log()
+    # sync: answer once ES has the documents; async: answer 202 once queued;
+    # log: answer 202 once written to the ingest log
+    app.config["INGEST_ACCEPT_MODE"] = os.getenv("INGEST_ACCEPT_MODE", "sync")
+    app.config["INGEST_WAIT_TIMEOUT"] = float(os.getenv("INGEST_WAIT_TIMEOUT", "30"))
+
     # -----------------------------
     # Register Blueprints
     # -----------------------------
@@ -0,0 +1,220 @@
+# app/bulkindexer.py
+
+from collections import deque
+from elasticsearch import exceptions as es_exceptions
+import json
+import os
+import queue
+import threading
+import time
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class QueueFull(Exception):
+    """The indexer queue is at capacity; the caller should answer 503 so the agent retries."""
+
+class PendingDoc:
+    """One queued document; wait() returns its result once its bulk request completed."""
+    __slots__ = ("action", "doc", "size", "attempts", "result", "done")
+
+    def __init__(self, action, doc, size):
+        self.action = action
+        self.doc = doc
+        self.size = size
+        self.attempts = 0
+        self.result = None
+        self.done = threading.Event()
+
+    def finish(self, result):
+        self.result = result
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """{"status": ..., "result"/"error": ...}, or None if not indexed within `timeout`."""
+        return self.result if self.done.wait(timeout) else None
+
+class BulkIndexer:
+    """
+    Collects documents from all requests and writes them to Elasticsearch
+    through the bulk API from one background thread.
+
+    A bulk request goes out when `max_docs` documents or `max_bytes` of
+    source are queued, or `flush_interval` seconds after the first
+    document of the batch arrived. Items ES answers with 429/5xx (and
+    whole requests that fail to connect) are retried with exponential
+    backoff up to `max_retries` times; 409 on a create is a duplicate and
+    counts as success. The queue holds at most `max_queue` documents;
+    submit() raises QueueFull beyond that.
+    """
+
+    def __init__(self, es, max_docs=500, max_bytes=5 * 2**20, flush_interval=1.0,
+                 max_queue=50000, max_retries=3, retry_backoff=0.5):
+        self.es = es
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.queue = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.in_flight = 0
+        self.latencies = deque(maxlen=1000)  # seconds per bulk request
+        self.counts = {"flushes": 0, "indexed": 0, "duplicates": 0, "failed": 0,
+                       "retried": 0, "rejected_queue_full": 0}
+
+    # --- request side ---
+    def submit(self, action, doc):
+        """Queue one document with its bulk action line; returns a PendingDoc."""
+        self._ensure_started()
+        item = PendingDoc(action, doc, len(json.dumps(doc, default=str)))
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            with self.lock:
+                self.counts["rejected_queue_full"] += 1
+            raise QueueFull(f"indexer queue full ({self.queue.maxsize} documents)")
+        return item
+
+    def _ensure_started(self):
+        # Started on first use and per process, so forked WSGI workers each get their own thread
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, name="es-bulk-indexer", daemon=True)
+                self.thread.start()
+
+    # --- indexer thread ---
+    def _run(self):
+        while True:
+            batch = self._collect()
+            with self.lock:
+                self.in_flight = len(batch)
+            try:
+                self._flush(batch)
+            except Exception as e:  # never let the thread die with documents waiting on it
+                for item in batch:
+                    if not item.done.is_set():
+                        item.finish({"status": 500, "error": f"indexer error: {e}"})
+            with self.lock:
+                self.in_flight = 0
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        size = batch[0].size
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.max_docs and size < self.max_bytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += item.size
+        return batch
+
+    def _flush(self, batch):
+        pending = batch
+        while pending:
+            retry = []
+            operations = []
+            for item in pending:
+                operations.append(item.action)
+                operations.append(item.doc)
+            started = time.monotonic()
+            try:
+                res = self.es.bulk(operations=operations)
+            except (es_exceptions.ConnectionError, es_exceptions.ConnectionTimeout) as e:
+                retry, error = pending, f"Cannot connect to Elasticsearch: {e}"
+            except es_exceptions.AuthenticationException:
+                self._fail(pending, 500, "Elasticsearch authentication failed")
+                return
+            except Exception as e:
+                self._fail(pending, 500, f"Failed to index events: {e}")
+                return
+            else:
+                error = None
+                outcomes = res.get("items", [])
+                for i, item in enumerate(pending):
+                    outcome = outcomes[i] if i < len(outcomes) else {}
+                    outcome = outcome.get("create") or outcome.get("index") or {}
+                    status = outcome.get("status", 500)
+                    if status == 409:
+                        # Already indexed by an earlier attempt of this upload
+                        self._count("duplicates")
+                        item.finish({"status": 200, "result": "duplicate"})
+                    elif 200 <= status < 300:
+                        self._count("indexed")
+                        item.finish({"status": status, "result": outcome.get("result")})
+                    elif status in RETRY_STATUSES:
+                        retry.append(item)
+                        error = outcome.get("error", {}).get("reason", f"status {status}")
+                    else:
+                        self._count("failed")
+                        reason = outcome.get("error", {})
+                        item.finish({"status": status, "error": reason.get("reason", str(reason))})
+            finally:
+                with self.lock:
+                    self.counts["flushes"] += 1
+                    self.latencies.append(time.monotonic() - started)
+
+            pending = []
+            for item in retry:
+                item.attempts += 1
+                if item.attempts > self.max_retries:
+                    self._count("failed")
+                    item.finish({"status": 503, "error": error or "retries exhausted"})
+                else:
+                    pending.append(item)
+            if pending:
+                self._count("retried", len(pending))
+                time.sleep(self.retry_backoff * 2 ** (pending[0].attempts - 1))
+
+    def _fail(self, items, status, error):
+        self._count("failed", len(items))
+        for item in items:
+            item.finish({"status": status, "error": error})
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    # --- metrics ---
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            counts = dict(self.counts)
+            in_flight = self.in_flight
+
+        def pct(q):
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1) if latencies else None
+
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.queue.maxsize,
+            "in_flight": in_flight,
+            **counts,
+            "flush_latency_ms": {
+                "last": round(self.latencies[-1] * 1000, 1) if self.latencies else None,
+                "p50": pct(0.5),
+                "p99": pct(0.99),
+                "max": round(latencies[-1] * 1000, 1) if latencies else None,
+            },
+        }
+
+def create_indexer(es):
+    """BulkIndexer configured from the ES_BULK_* environment variables."""
+    return BulkIndexer(
+        es,
+        max_docs=int(os.getenv("ES_BULK_MAX_DOCS", "500")),
+        max_bytes=int(os.getenv("ES_BULK_MAX_BYTES", str(5 * 2**20))),
+        flush_interval=float(os.getenv("ES_BULK_INTERVAL", "1.0")),
+        max_queue=int(os.getenv("ES_BULK_QUEUE", "50000")),
+        max_retries=int(os.getenv("ES_BULK_RETRIES", "3")),
+        retry_backoff=float(os.getenv("ES_BULK_RETRY_BACKOFF", "0.5")),
+    )
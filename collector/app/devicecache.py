@@ -0,0 +1,95 @@
+# app/devicecache.py
+
+from collections import OrderedDict, namedtuple
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from app.models import Device
+import base64
+import os
+import threading
+import time
+
+# What the ingest path needs from a device: metadata for stamping events
+# and a ready AES-GCM cipher (stateless, safe to share between threads)
+CachedDevice = namedtuple("CachedDevice", ["device_id", "name", "cipher"])
+
+class DeviceCache:
+    """
+    Bounded LRU of device_id -> CachedDevice, filled from Postgres on a miss.
+
+    Entries expire after `ttl` seconds, so a device changed by another
+    process is picked up without an explicit invalidation. Unknown device
+    ids are remembered for `negative_ttl` seconds, so a misconfigured agent
+    retrying in a loop does not turn every request into a query.
+
+    The cache is per process: invalidate() (and the /cache/invalidate
+    endpoint) only reaches the process it runs in, so with several
+    collector workers `ttl` is the bound on how long a deleted or re-keyed
+    device is still accepted by the others.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300.0, negative_ttl=5.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()  # device_id -> (expires_at, CachedDevice or None)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _load(self, device_id):
+        device = Device.query.filter_by(device_id=device_id).first()
+        if device is None:
+            return None
+        cipher = AESGCM(base64.urlsafe_b64decode(device.api_key))
+        return CachedDevice(device.device_id, device.name, cipher)
+
+    def get(self, device_id):
+        """Cached device for `device_id`, or None if it does not exist."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(device_id)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(device_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        device = self._load(device_id)  # outside the lock; concurrent misses may both query
+        ttl = self.ttl if device is not None else self.negative_ttl
+        with self.lock:
+            self.entries[device_id] = (now + ttl, device)
+            self.entries.move_to_end(device_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return device
+
+    def invalidate(self, device_id=None):
+        """Forget one device (after it was deleted or re-keyed), or all of them."""
+        with self.lock:
+            if device_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(device_id, None)
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+DEVICE_CACHE = DeviceCache(
+    max_entries=int(os.getenv("DEVICE_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("DEVICE_CACHE_TTL", "300")),
+    negative_ttl=float(os.getenv("DEVICE_CACHE_NEGATIVE_TTL", "5")),
+)
@@ -0,0 +1,190 @@
+# app/ingestlog.py
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+class LogFull(Exception):
+    """The log holds `max_events` unindexed events; the caller should answer 503 so the agent retries."""
+
+class IngestLog:
+    """
+    Durable log of decrypted events between the HTTP endpoints and the
+    indexer workers, in one SQLite database in WAL mode.
+
+    Every appended event gets an increasing offset; appends take the write
+    lock before inserting, so offsets become visible in order. Workers
+    split the log by `offset % partitions` and each stores the last offset
+    it indexed, so a restarted worker resumes where it stopped. Rows every
+    partition has passed are deleted by truncate(). Events ES rejects for
+    good are moved to `dead_letters` instead of blocking their partition.
+
+    Connections are opened lazily, one per thread and process.
+    """
+
+    def __init__(self, path, max_events=5_000_000, synchronous="FULL"):
+        self.path = path
+        self.max_events = max_events
+        self.synchronous = synchronous
+        self.local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None and self.local.pid == os.getpid():
+            return conn
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS events (
+                offset INTEGER PRIMARY KEY AUTOINCREMENT,
+                received_at REAL NOT NULL,
+                action TEXT NOT NULL,
+                doc TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS consumers (
+                partition INTEGER PRIMARY KEY,
+                offset INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                offset INTEGER PRIMARY KEY,
+                received_at REAL NOT NULL,
+                action TEXT NOT NULL,
+                doc TEXT NOT NULL,
+                status INTEGER,
+                error TEXT,
+                failed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+        self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None and self.local.pid == os.getpid():
+            conn.close()
+        self.local.conn = None
+
+    # --- HTTP side ---
+    def append(self, records):
+        """
+        Durably store [(bulk action, document), ...] in one transaction.
+        Returns the offset of the last record; raises LogFull when the
+        workers are `max_events` behind.
+        """
+        rows = [(time.time(), json.dumps(action), json.dumps(doc, default=str)) for action, doc in records]
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            low, high = conn.execute("SELECT MIN(offset), MAX(offset) FROM events").fetchone()
+            if high is not None and high - low + 1 + len(rows) > self.max_events:
+                raise LogFull(f"ingest log holds {high - low + 1} unindexed events")
+            conn.executemany("INSERT INTO events (received_at, action, doc) VALUES (?, ?, ?)", rows)
+            last = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return last
+
+    # --- worker side ---
+    def assign(self, partitions):
+        """
+        Set up `partitions` consumer offsets. When the worker count changed,
+        every partition restarts from the oldest offset any old one had
+        reached: events may be sent twice, never skipped.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'partitions'").fetchone()
+            if row is None or int(row[0]) != partitions:
+                start = conn.execute("SELECT MIN(offset) FROM consumers").fetchone()[0] or 0
+                conn.execute("DELETE FROM consumers")
+                conn.executemany("INSERT INTO consumers (partition, offset, updated_at) VALUES (?, ?, ?)",
+                                 [(p, start, time.time()) for p in range(partitions)])
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('partitions', ?)", (str(partitions),))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def committed(self, partition):
+        row = self._conn().execute("SELECT offset FROM consumers WHERE partition = ?", (partition,)).fetchone()
+        return row[0] if row else 0
+
+    def read(self, partition, partitions, after, limit):
+        """Up to `limit` (offset, received_at, action, doc) of a partition past offset `after`, oldest first."""
+        rows = self._conn().execute(
+            "SELECT offset, received_at, action, doc FROM events "
+            "WHERE offset > ? AND offset % ? = ? ORDER BY offset LIMIT ?",
+            (after, partitions, partition, limit)
+        ).fetchall()
+        return [(offset, received_at, json.loads(action), json.loads(doc))
+                for offset, received_at, action, doc in rows]
+
+    def commit(self, partition, offset):
+        self._conn().execute("UPDATE consumers SET offset = ?, updated_at = ? WHERE partition = ?",
+                             (offset, time.time(), partition))
+
+    def dead_letter(self, offset, received_at, action, doc, status, error):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (offset, received_at, json.dumps(action), json.dumps(doc, default=str), status, error, time.time())
+        )
+
+    def truncate(self):
+        """Delete events every partition has indexed; returns how many."""
+        cur = self._conn().execute(
+            "DELETE FROM events WHERE offset <= (SELECT MIN(offset) FROM consumers)"
+        )
+        return cur.rowcount
+
+    # --- metrics ---
+    def stats(self):
+        conn = self._conn()
+        now = time.time()
+        low, high = conn.execute("SELECT MIN(offset), MAX(offset) FROM events").fetchone()
+        row = conn.execute("SELECT value FROM meta WHERE key = 'partitions'").fetchone()
+        partitions = int(row[0]) if row else None
+        consumers = []
+        for partition, offset, updated_at in conn.execute(
+                "SELECT partition, offset, updated_at FROM consumers ORDER BY partition").fetchall():
+            oldest = conn.execute(
+                "SELECT received_at FROM events WHERE offset > ? AND offset % ? = ? ORDER BY offset LIMIT 1",
+                (offset, partitions, partition)
+            ).fetchone()
+            consumers.append({
+                "partition": partition,
+                "offset": offset,
+                # Offsets interleave across partitions, so this is an estimate
+                "lag_events": max(0, ((high or 0) - offset) // partitions),
+                "lag_seconds": round(now - oldest[0], 3) if oldest else 0,
+                "last_commit_age": round(now - updated_at, 3),
+            })
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        wal = self.path + "-wal"
+        return {
+            "path": self.path,
+            "head_offset": high or 0,
+            "retained_events": (high - low + 1) if high is not None else 0,
+            "max_events": self.max_events,
+            "partitions": partitions,
+            "consumers": consumers,
+            "dead_letters": conn.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0],
+            "db_bytes": page_count * page_size + (os.path.getsize(wal) if os.path.exists(wal) else 0),
+        }
+
+def create_ingest_log():
+    """IngestLog configured from the INGEST_LOG_* environment variables."""
+    return IngestLog(
+        os.getenv("INGEST_LOG_PATH", "data/ingest-log.db"),
+        max_events=int(os.getenv("INGEST_LOG_MAX_EVENTS", "5000000")),
+        synchronous=os.getenv("INGEST_LOG_SYNC", "FULL"),
+    )
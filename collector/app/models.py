@@ -11,3 +11,14 @@ class Device(db.Model):
     status = db.Column(db.String(20), default="offline")
     api_key = db.Column(db.String(100), unique=True, nullable=False)  # for auth
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
+
+class DeviceRegistration(db.Model):
+    """
+    Hash of the token an agent generated for its own registration request.
+    A retry carrying the same token gets the device's key back; any other
+    caller only learns that the device exists.
+    """
+    __tablename__ = "device_registrations"
+    device_id = db.Column(db.String(50), primary_key=True)
+    token_hash = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
@@ -1,6 +1,9 @@
 from flask import Blueprint, request, jsonify
-from app.models import db, Device
+from app.models import db, Device, DeviceRegistration
+from app.devicecache import DEVICE_CACHE
 import secrets
+import hashlib
+import hmac
 import base64
 import os
 
@@ -16,6 +19,9 @@ def generate_api_key():
     key = secrets.token_bytes(32)
     return base64.urlsafe_b64encode(key).decode('utf-8')
 
+def hash_registration_token(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
 @devices_bp.route("/", methods=["POST"])
 def add_device():
     # Secret check
@@ -30,15 +36,32 @@ def add_device():
     if not device_id:
         return jsonify({"error": "device_id is required"}), 400
 
-    if Device.query.filter_by(device_id=device_id).first():
-        return jsonify({"error": "Device already exists"}), 400
+    # The registration secret is shared by every agent, so an existing
+    # device's key only goes back to the agent holding the token it
+    # registered with (its retry after a lost response)
+    token = data.get("registration_token")
+    existing = Device.query.filter_by(device_id=device_id).first()
+    if existing:
+        registration = db.session.get(DeviceRegistration, device_id)
+        if not (isinstance(token, str) and token and registration
+                and hmac.compare_digest(registration.token_hash, hash_registration_token(token))):
+            return jsonify({"error": "Device already exists"}), 400
+        return jsonify({
+            "status": "device exists",
+            "device_id": device_id,
+            "name": existing.name,
+            "api_key": existing.api_key
+        }), 200
     
     # Generate unique API key for this device
     api_key = generate_api_key()
     
     device = Device(device_id=device_id, name=name, api_key=api_key)
     db.session.add(device)
+    if isinstance(token, str) and token:
+        db.session.merge(DeviceRegistration(device_id=device_id, token_hash=hash_registration_token(token)))
     db.session.commit()
+    DEVICE_CACHE.invalidate(device_id)  # drop a cached "unknown device"
     
     return jsonify({
         "status": "device added",
@@ -46,3 +69,62 @@ def add_device():
         "name": device.name,
         "api_key": api_key
     }), 200
+
+@devices_bp.route("/bulk", methods=["POST"])
+def add_devices_bulk():
+    """
+    Register many devices in one request (used by package_agent.py --register).
+    Body: [{"device_id": ..., "name": ...}, ...]. Devices that already exist
+    keep their key and are reported as "exists" without it, so re-running a
+    provisioning batch is safe but cannot read another device's key.
+    """
+    auth = request.headers.get("X-Internal-Auth")
+    if auth != INTERNAL_SECRET:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        return jsonify({"error": "Body must be a list of devices"}), 400
+
+    wanted = {}
+    for entry in data:
+        device_id = entry.get("device_id") if isinstance(entry, dict) else None
+        if not device_id:
+            return jsonify({"error": "device_id is required for every device"}), 400
+        wanted[device_id] = entry.get("name", "Unnamed Device")
+
+    existing = {d.device_id: d for d in Device.query.filter(Device.device_id.in_(list(wanted))).all()}
+    results = []
+    for device_id, name in wanted.items():
+        device = existing.get(device_id)
+        if device is not None:
+            results.append({"device_id": device_id, "status": "exists"})
+            continue
+        device = Device(device_id=device_id, name=name, api_key=generate_api_key())
+        db.session.add(device)
+        results.append({"device_id": device_id, "status": "device added", "api_key": device.api_key})
+    db.session.commit()
+    for result in results:
+        if result["status"] == "device added":
+            DEVICE_CACHE.invalidate(result["device_id"])
+
+    return jsonify({"status": "success", "results": results}), 200
+
+@devices_bp.route("/cache", methods=["GET"])
+def device_cache_stats():
+    """Hit/miss counters of the ingest device cache in this process."""
+    if request.headers.get("X-Internal-Auth") != INTERNAL_SECRET:
+        return jsonify({"error": "Unauthorized"}), 403
+    return jsonify(DEVICE_CACHE.stats()), 200
+
+@devices_bp.route("/cache/invalidate", methods=["POST"])
+def device_cache_invalidate():
+    """
+    Drop a device from this process's cache, e.g. after the dashboard deleted it.
+    Body: {"device_id": ...}; without a device_id the whole cache is cleared.
+    """
+    if request.headers.get("X-Internal-Auth") != INTERNAL_SECRET:
+        return jsonify({"error": "Unauthorized"}), 403
+    data = request.get_json(silent=True) or {}
+    DEVICE_CACHE.invalidate(data.get("device_id"))
+    return jsonify({"status": "invalidated", "device_id": data.get("device_id")}), 200
@@ -1,22 +1,19 @@
 # app/routes/events.py
 
 from flask import Blueprint, request, jsonify, current_app
-from app.models import Device
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-import base64, json
+from app.routes.devices import INTERNAL_SECRET
+from app.devicecache import DEVICE_CACHE
+from app.bulkindexer import QueueFull
+from app.ingestlog import LogFull
+import base64, json, time
 from datetime import datetime, timezone
 from elasticsearch import Elasticsearch, exceptions as es_exceptions
 
 events_bp = Blueprint("events", __name__)
 
-def decrypt_payload(api_key, encrypted_payload):
-    """
-    Decrypt AES-GCM payload using device API key.
-    `encrypted_payload` should be base64 URL-safe encoded.
-    """
+def decrypt_with(aesgcm, encrypted_payload):
+    """Decrypt a base64 URL-safe AES-GCM payload with a ready cipher."""
     try:
-        key = base64.urlsafe_b64decode(api_key)
-        aesgcm = AESGCM(key)
         encrypted_bytes = base64.urlsafe_b64decode(encrypted_payload)
         nonce = encrypted_bytes[:12]
         ct = encrypted_bytes[12:]
@@ -25,55 +22,254 @@ def decrypt_payload(api_key, encrypted_payload):
     except Exception as e:
         raise ValueError(f"Decryption failed: {e}")
 
-@events_bp.route("/", methods=["POST"])
-def receive_event():
+INDEX_MAP = {
+    "file": "file-events",
+    "network": "network-events",
+    "health": "agent-health"
+}
+
+def prepare_event(payload, device):
     """
-    Receive encrypted event payloads from agents.
-    Headers:
-        X-Device-ID : ID of the device
-    Body:
-        raw encrypted payload (AES-GCM, base64)
+    Stamp a decrypted event with device metadata and pick its index.
+    `timestamp` stays the agent's capture time, since spooled events may
+    arrive hours later; `received_at` is when the hub got them.
+    Returns (index_name, payload); index_name is None for an invalid event_type.
+    """
+    payload["device_id"] = device.device_id
+    payload["device_name"] = device.name
+    payload["received_at"] = datetime.now(timezone.utc).isoformat()
+    if not payload.get("timestamp") or not isinstance(payload["timestamp"], str):
+        payload["timestamp"] = payload["received_at"]
+    return INDEX_MAP.get(payload.get("event_type")), payload
+
+def index_action(index_name, event):
+    """
+    Bulk action for an event. Agent-assigned ids become the document _id and
+    are created, not overwritten, so a retried upload cannot duplicate them.
+    """
+    if event.get("id"):
+        return {"create": {"_index": index_name, "_id": str(event["id"])}}
+    return {"index": {"_index": index_name}}
+
+def load_device_payload():
+    """
+    Resolve the sending device and decrypt the request body.
+    Returns (device, payload, None) or (None, None, error_response).
     """
     encrypted_payload = request.get_data(as_text=True)
     device_id = request.headers.get("X-Device-ID")
     if not device_id:
-        return jsonify({"error": "Missing X-Device-ID header"}), 400
+        return None, None, (jsonify({"error": "Missing X-Device-ID header"}), 400)
 
-    # Validate device in Postgres
-    device = Device.query.filter_by(device_id=device_id).first()
+    # Validate device (Postgres, behind the device cache)
+    device = DEVICE_CACHE.get(device_id)
     if not device:
-        return jsonify({"error": "Unknown device"}), 400
+        return None, None, (jsonify({"error": "Unknown device"}), 400)
 
     # Decrypt payload
     try:
-        payload = decrypt_payload(device.api_key, encrypted_payload)
+        payload = decrypt_with(device.cipher, encrypted_payload)
     except Exception as e:
-        return jsonify({"error": str(e)}), 400
+        return None, None, (jsonify({"error": str(e)}), 400)
 
-    # Add metadata
-    payload["device_id"] = device_id
-    payload["device_name"] = device.name
-    payload["timestamp"] = datetime.now(timezone.utc).isoformat()
+    return device, payload, None
 
-    # Index to Elasticsearch
-    es: Elasticsearch = current_app.elasticsearch
-    index_map = {
-        "file": "file-events",
-        "network": "network-events"
-    }
-    event_type = payload.get("event_type")
-    index_name = index_map.get(event_type)
+@events_bp.route("/", methods=["POST"])
+def receive_event():
+    """
+    Receive encrypted event payloads from agents.
+    Headers:
+        X-Device-ID : ID of the device
+    Body:
+        raw encrypted payload (AES-GCM, base64)
+    """
+    device, payload, error = load_device_payload()
+    if error:
+        return error
 
+    index_name, payload = prepare_event(payload, device)
     if not index_name:
         return jsonify({"error": "Invalid event_type"}), 400
 
+    if current_app.config["INGEST_ACCEPT_MODE"] == "log":
+        try:
+            current_app.ingest_log.append([(index_action(index_name, payload), payload)])
+        except LogFull as e:
+            return jsonify({"error": str(e)}), 503, {"Retry-After": "5"}
+        except Exception as e:
+            return jsonify({"error": f"Failed to queue event: {e}"}), 500
+        return jsonify({"status": "accepted"}), 202
+
+    try:
+        pending = current_app.bulk_indexer.submit(index_action(index_name, payload), payload)
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
+    if current_app.config["INGEST_ACCEPT_MODE"] == "async":
+        return jsonify({"status": "accepted"}), 202
+
+    result = pending.wait(current_app.config["INGEST_WAIT_TIMEOUT"])
+    if result is None:
+        return jsonify({"error": "Timed out waiting for Elasticsearch"}), 503
+    if "error" in result:
+        return jsonify({"error": result["error"]}), result["status"]
+    return jsonify({"status": "success", "es_result": result["result"]}), result["status"]
+
+@events_bp.route("/bulk", methods=["POST"])
+def receive_events_bulk():
+    """
+    Receive a batch of events from an agent in one encrypted envelope.
+    Headers:
+        X-Device-ID : ID of the device
+    Body:
+        raw encrypted payload (AES-GCM, base64) of a JSON list of events
+    Returns one result per event, in request order.
+    """
+    device, events, error = load_device_payload()
+    if error:
+        return error
+    if not isinstance(events, list):
+        return jsonify({"error": "Bulk payload must be a list of events"}), 400
+
+    results = [None] * len(events)
+    records = []
+    for i, event in enumerate(events):
+        if not isinstance(event, dict):
+            results[i] = {"id": None, "status": 400, "error": "Event must be an object"}
+            continue
+        index_name, event = prepare_event(event, device)
+        if not index_name:
+            results[i] = {"id": event.get("id"), "status": 400, "error": "Invalid event_type"}
+            continue
+        records.append((i, index_action(index_name, event), event))
+
+    mode = current_app.config["INGEST_ACCEPT_MODE"]
+    if mode == "log":
+        try:
+            if records:
+                current_app.ingest_log.append([(action, event) for _, action, event in records])
+            outcome = {"status": 202, "result": "accepted"}
+        except LogFull as e:
+            # The agent keeps these events spooled and retries them
+            outcome = {"status": 503, "error": str(e)}
+        except Exception as e:
+            outcome = {"status": 500, "error": f"Failed to queue event: {e}"}
+        for i, _, event in records:
+            results[i] = {"id": event.get("id"), **outcome}
+        return jsonify({"status": "success", "results": results}), 200
+
+    pending = []
+    for i, action, event in records:
+        try:
+            pending.append((i, current_app.bulk_indexer.submit(action, event)))
+        except QueueFull as e:
+            # The agent keeps this event spooled and retries it
+            results[i] = {"id": event.get("id"), "status": 503, "error": str(e)}
+
+    deadline = time.monotonic() + current_app.config["INGEST_WAIT_TIMEOUT"]
+    for i, doc in pending:
+        result = {"id": events[i].get("id")}
+        if mode == "async":
+            result.update({"status": 202, "result": "accepted"})
+        else:
+            outcome = doc.wait(max(0, deadline - time.monotonic()))
+            result.update(outcome or {"status": 503, "error": "Timed out waiting for Elasticsearch"})
+        results[i] = result
+
+    return jsonify({"status": "success", "results": results}), 200
+
+@events_bp.route("/gaps/<device_id>", methods=["GET"])
+def sequence_gaps(device_id):
+    """
+    Report missing sequence numbers for a device, per id stream.
+    Headers:
+        X-Internal-Auth : internal secret
+    Query:
+        interval : bucket size used to locate gaps (default 10000)
+    A gap means events the agent numbered never reached Elasticsearch:
+    spool overflow, an unclean agent shutdown, or documents deleted since.
+    """
+    if request.headers.get("X-Internal-Auth") != INTERNAL_SECRET:
+        return jsonify({"error": "Unauthorized"}), 403
+    try:
+        interval = max(1, int(request.args.get("interval", 10000)))
+    except ValueError:
+        return jsonify({"error": "interval must be an integer"}), 400
+
+    es: Elasticsearch = current_app.elasticsearch
     try:
-        res = es.index(index=index_name, document=payload)
-    except es_exceptions.AuthenticationException:
-        return jsonify({"error": "Elasticsearch authentication failed"}), 500
+        res = es.search(
+            index=",".join(INDEX_MAP.values()),
+            ignore_unavailable=True,
+            size=0,
+            query={"bool": {"filter": [
+                {"term": {"device_id.keyword": device_id}},
+                {"exists": {"field": "seq"}}
+            ]}},
+            aggs={"streams": {
+                "terms": {"field": "stream", "size": 100, "order": {"_key": "asc"}},
+                "aggs": {
+                    "min_seq": {"min": {"field": "seq"}},
+                    "max_seq": {"max": {"field": "seq"}},
+                    "ranges": {"histogram": {"field": "seq", "interval": interval, "min_doc_count": 0}}
+                }
+            }}
+        )
     except es_exceptions.ConnectionError:
         return jsonify({"error": "Cannot connect to Elasticsearch"}), 500
     except Exception as e:
-        return jsonify({"error": f"Failed to index event: {e}"}), 500
+        return jsonify({"error": f"Failed to query events: {e}"}), 500
 
-    return jsonify({"status": "success", "es_result": res.get("result")}), 201
+    streams = []
+    for bucket in res.get("aggregations", {}).get("streams", {}).get("buckets", []):
+        low, high = int(bucket["min_seq"]["value"]), int(bucket["max_seq"]["value"])
+        gaps = []
+        for r in bucket["ranges"]["buckets"]:
+            start, end = max(int(r["key"]), low), min(int(r["key"]) + interval - 1, high)
+            missing = (end - start + 1) - r["doc_count"]
+            if missing > 0:
+                gaps.append({"from": start, "to": end, "missing": missing})
+        streams.append({
+            "stream": bucket["key"],
+            "first_seq": low,
+            "last_seq": high,
+            "received": bucket["doc_count"],
+            "missing": (high - low + 1) - bucket["doc_count"],
+            "gaps": gaps
+        })
+
+    return jsonify({
+        "device_id": device_id,
+        "missing": sum(s["missing"] for s in streams),
+        "streams": streams
+    }), 200
+
+@events_bp.route("/indexer", methods=["GET"])
+def indexer_stats():
+    """
+    Bulk indexer state: queue depth, documents in flight, per-outcome
+    counts and bulk request latency.
+    Headers:
+        X-Internal-Auth : internal secret
+    """
+    if request.headers.get("X-Internal-Auth") != INTERNAL_SECRET:
+        return jsonify({"error": "Unauthorized"}), 403
+    return jsonify({
+        "accept_mode": current_app.config["INGEST_ACCEPT_MODE"],
+        **current_app.bulk_indexer.stats()
+    }), 200
+
+@events_bp.route("/ingest-log", methods=["GET"])
+def ingest_log_stats():
+    """
+    Ingest log state: head offset, retained events, and per-worker
+    committed offset, lag and time since its last commit.
+    Headers:
+        X-Internal-Auth : internal secret
+    """
+    if request.headers.get("X-Internal-Auth") != INTERNAL_SECRET:
+        return jsonify({"error": "Unauthorized"}), 403
+    try:
+        stats = current_app.ingest_log.stats()
+    except Exception as e:
+        return jsonify({"error": f"Failed to read ingest log: {e}"}), 500
+    return jsonify({"accept_mode": current_app.config["INGEST_ACCEPT_MODE"], **stats}), 200
@@ -0,0 +1,110 @@
+"""
+Indexer workers: drain the collector's ingest log into Elasticsearch.
+
+Run next to wsgi.py when the collector uses INGEST_ACCEPT_MODE=log:
+
+    python indexer.py
+
+Starts INGEST_WORKERS processes, each owning one partition of the log.
+A worker only commits its offset once every event of a batch is indexed,
+a duplicate, or moved to dead_letters, so ES being down just grows the
+lag and a restarted worker resumes at its committed offset.
+"""
+from app import create_app
+from app.bulkindexer import RETRY_STATUSES
+from app.ingestlog import create_ingest_log
+import multiprocessing
+import os
+import signal
+import time
+
+WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+BATCH = int(os.getenv("INGEST_WORKER_BATCH", "1000"))
+IDLE_SLEEP = float(os.getenv("INGEST_WORKER_IDLE", "0.5"))
+MAX_BACKOFF = float(os.getenv("INGEST_WORKER_MAX_BACKOFF", "30"))
+TRUNCATE_INTERVAL = float(os.getenv("INGEST_LOG_TRUNCATE_INTERVAL", "30"))
+HEARTBEAT = 5.0
+
+def index_batch(log, indexer, rows, partition):
+    """Index rows until none is left retriable; permanent rejections go to dead_letters."""
+    backoff = 1.0
+    while rows:
+        pending = [(row, indexer.submit(row[2], row[3])) for row in rows]
+        rows = []
+        for row, doc in pending:
+            result = doc.wait()
+            if result["status"] in RETRY_STATUSES or result["status"] >= 500:
+                rows.append(row)
+                error = result.get("error")
+            elif "error" in result:
+                print(f"[WARNING] indexer {partition}: offset {row[0]} rejected "
+                      f"({result['status']}): {result['error']}", flush=True)
+                log.dead_letter(*row, result["status"], result["error"])
+        if rows:
+            print(f"[WARNING] indexer {partition}: {len(rows)} events not indexed "
+                  f"({error}), retrying in {backoff:.0f}s", flush=True)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+def drain(partition, partitions):
+    # The parent stops workers with SIGTERM; offsets are committed per batch, so exiting anywhere is safe
+    signal.signal(signal.SIGTERM, lambda *_: os._exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    app = create_app()
+    log, indexer = app.ingest_log, app.bulk_indexer
+    offset = log.committed(partition)
+    print(f"[INFO] indexer {partition}/{partitions}: resuming after offset {offset}", flush=True)
+    last_commit = last_truncate = time.monotonic()
+    while True:
+        rows = log.read(partition, partitions, offset, BATCH)
+        if rows:
+            index_batch(log, indexer, rows, partition)
+            offset = rows[-1][0]
+            log.commit(partition, offset)
+            last_commit = time.monotonic()
+            continue
+
+        now = time.monotonic()
+        if now - last_commit >= HEARTBEAT:
+            log.commit(partition, offset)  # keeps last_commit_age meaningful while idle
+            last_commit = now
+        if partition == 0 and now - last_truncate >= TRUNCATE_INTERVAL:
+            deleted = log.truncate()
+            if deleted:
+                print(f"[INFO] indexer: truncated {deleted} indexed events from the log", flush=True)
+            last_truncate = now
+        time.sleep(IDLE_SLEEP)
+
+def main():
+    log = create_ingest_log()
+    log.assign(WORKERS)
+    log.close()
+
+    workers = {}
+    def start(partition):
+        p = multiprocessing.Process(target=drain, args=(partition, WORKERS), name=f"indexer-{partition}")
+        p.start()
+        workers[partition] = p
+
+    def shutdown(*_):
+        for p in workers.values():
+            p.terminate()
+        for p in workers.values():
+            p.join(10)
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    for partition in range(WORKERS):
+        start(partition)
+    print(f"[INFO] {WORKERS} indexer workers draining {log.path}", flush=True)
+
+    while True:
+        time.sleep(1)
+        for partition, p in list(workers.items()):
+            if not p.is_alive():
+                print(f"[WARNING] indexer {partition} exited ({p.exitcode}), restarting", flush=True)
+                start(partition)
+
+if __name__ == "__main__":
+    main()
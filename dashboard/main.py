@@ -16,6 +16,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 # Import collector app, models
 from app import create_app
 from app.models import db, Device
+from app.devicecache import DEVICE_CACHE
 
 # -----------------------------
 # JWT CONFIG
@@ -68,6 +69,21 @@ def create_device(device_id, device_name):
     }
     return config, certs
 
+def invalidate_collector_cache(device_id):
+    """
+    Tell the collector to forget a device it may have cached. Best effort:
+    if the collector is unreachable its cache entry still expires after
+    DEVICE_CACHE_TTL seconds. The request reaches one collector process; a
+    collector running several worker processes needs a short
+    DEVICE_CACHE_TTL to bound how long the others keep the device.
+    """
+    url = os.getenv("COLLECTOR_URL", "http://127.0.0.1:5000") + "/api/devices/cache/invalidate"
+    headers = {"X-Internal-Auth": os.getenv("INTERNAL_SECRET", "super-secret-token")}
+    try:
+        requests.post(url, json={"device_id": device_id}, headers=headers, timeout=2).raise_for_status()
+    except requests.RequestException as e:
+        logging.warning(f"Could not invalidate collector cache for {device_id}: {e}")
+
 def add_device_via_api(device_id, device_name):
     url = "http://127.0.0.1:5000/api/devices/"
     headers = {
@@ -184,6 +200,9 @@ def create_dashboard_app():
             if device:
                 db.session.delete(device)
                 db.session.commit()
+                # Stop accepting its events right away, here and in the collector
+                DEVICE_CACHE.invalidate(device_id)
+                invalidate_collector_cache(device_id)
                 flash(f"Device '{device.name}' deleted", "success")
             else:
                 flash("Device not found", "error")